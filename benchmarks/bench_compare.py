@@ -0,0 +1,122 @@
+#!/usr/bin/python3 -ttu
+
+# Benchmark of the ways hardlinkpy compares the contents of two files, the old
+# read() loop against split_identical_files(), which a scan uses.
+#
+# Two identical files are created for each size and compared repeatedly, so
+# the files are read from the page cache and the benchmark measures the cost
+# of the comparison loop itself rather than of the storage.
+#
+# Run it from the top of the source tree:
+#   $ python3 benchmarks/bench_compare.py --sizes 64K 16M 256M
+#
+# split_identical_files() is not faster at every size.  Speedup over the old
+# read() loop of
+#   $ python3 benchmarks/bench_compare.py --sizes 4K 64K 1M 16M --repeat 200
+# on ext4, with the files in the page cache, over three runs:
+#
+#         size  speedup
+#           4K    0.50x - 0.72x
+#          64K    0.57x - 0.65x
+#           1M    3.06x - 3.99x
+#          16M    1.01x - 1.08x
+#
+# The numbers vary from run to run and from machine to machine, so measure
+# before relying on them.  Below about 1 MiB the files are read in one or two
+# chunks, and the fixed cost of splitting the files up (the scan state, the
+# buffer pool, the counters and the groups of files) is more than the old
+# loop spends on the comparison.  From 1 MiB on no bytes object is allocated
+# for each chunk, which is where split_identical_files() is faster.  Files
+# which have to be read from storage take far longer than the difference.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hardlinkpy.hardlink as hardlink  # noqa: E402
+
+
+def compare_with_read(*, filename1: str, filename2: str) -> bool:
+    """The comparison loop hardlinkpy used before the readinto() backend"""
+    with open(filename1, "rb") as file1:
+        with open(filename2, "rb") as file2:
+            while True:
+                buffer1 = file1.read(hardlink.BUFFER_SIZE)
+                buffer2 = file2.read(hardlink.BUFFER_SIZE)
+                if buffer1 != buffer2:
+                    return False
+                if not buffer1:
+                    return True
+
+
+def parse_size(size: str) -> int:
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if size[-1:].upper() in multipliers:
+        return int(size[:-1]) * multipliers[size[-1:].upper()]
+    return int(size)
+
+
+def best_time(*, function: Callable[[], bool], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        assert function()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main(passed_args: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=["4K", "64K", "1M", "16M", "256M"],
+        help="File sizes to benchmark, with an optional K, M or G suffix",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Best of this many runs is reported"
+    )
+    args = parser.parse_args(passed_args)
+
+    print(f"{'size':>12} {'read() MiB/s':>14} {'split MiB/s':>14} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        hardlink_args = hardlink.make_args(directories=[temp_dir])
+        for size_arg in args.sizes:
+            size = parse_size(size_arg)
+            filename1 = os.path.join(temp_dir, "file1")
+            filename2 = os.path.join(temp_dir, "file2")
+            data = os.urandom(size)
+            for filename in (filename1, filename2):
+                with open(filename, "wb") as out_file:
+                    out_file.write(data)
+            del data
+
+            read_time = best_time(
+                function=lambda: compare_with_read(
+                    filename1=filename1, filename2=filename2
+                ),
+                repeat=args.repeat,
+            )
+            split_time = best_time(
+                function=lambda: hardlink.split_identical_files(
+                    filenames=[filename1, filename2], args=hardlink_args
+                )
+                == [[filename1, filename2]],
+                repeat=args.repeat,
+            )
+            mebibytes = 2 * size / 1024 ** 2
+            print(
+                f"{size_arg:>12} {mebibytes / read_time:>14,.0f}"
+                f" {mebibytes / split_time:>14,.0f}"
+                f" {read_time / split_time:>7.2f}x"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,96 @@
+#!/usr/bin/python3 -ttu
+
+# Benchmark of the memory used to hold the information of collected files.
+#
+# Creates the records which hardlinkpy keeps for every regular file found,
+# once with a full os.stat_result and once with the compact StatInfo, and
+# reports the peak memory used per million files.
+#
+# Run it from the top of the source tree:
+#   $ python3 benchmarks/bench_memory.py --files 1000000
+
+import argparse
+import os
+import sys
+import tracemalloc
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hardlinkpy.hardlink as hardlink  # noqa: E402
+
+
+def make_stat_result(index: int) -> os.stat_result:
+    """Make a stat result with realistic values which are unique per file"""
+    mtime_ns = 1_554_498_398_123_456_789 + index * 1_000_003
+    ctime_ns = mtime_ns + 7
+    # os.stat() creates new int objects for every file, even when the values
+    # are the same as for other files.
+    same = index * 0
+    return os.stat_result(
+        (
+            0o100644 + same,
+            12_345_678 + index,
+            2049 + same,
+            1,
+            1000 + same,
+            1000 + same,
+            40_000 + index,
+            mtime_ns // 1_000_000_000,
+            mtime_ns // 1_000_000_000,
+            ctime_ns // 1_000_000_000,
+        ),
+        {
+            "st_atime": mtime_ns / 1e9,
+            "st_mtime": mtime_ns / 1e9,
+            "st_ctime": ctime_ns / 1e9,
+            "st_atime_ns": mtime_ns,
+            "st_mtime_ns": mtime_ns,
+            "st_ctime_ns": ctime_ns,
+            "st_blksize": 4096,
+            "st_blocks": 80,
+        },
+    )
+
+
+def peak_memory(*, count: int, make_record: Callable[[int], hardlink.StatLike]) -> int:
+    """The peak memory used to hold `count` records, without their filenames"""
+    filenames = [
+        f"/srv/backup/{index // 1000:06d}/{index:09d}.dat" for index in range(count)
+    ]
+    tracemalloc.start()
+    records: List[hardlink.FileInfo] = []
+    for index in range(count):
+        records.append(
+            hardlink.FileInfo(filename=filenames[index], stat_info=make_record(index))
+        )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(passed_args: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--files", type=int, default=1_000_000, help="Number of files to create"
+    )
+    args = parser.parse_args(passed_args)
+
+    per_million = 1_000_000 / args.files
+    for name, make_record in (
+        ("os.stat_result", make_stat_result),
+        ("StatInfo", lambda index: hardlink.StatInfo(make_stat_result(index))),
+    ):
+        peak = peak_memory(count=args.files, make_record=make_record)
+        print(
+            "{:<16}: {} per million files ({} bytes per file)".format(
+                name,
+                hardlink.humanize_number(int(peak * per_million)),
+                peak // args.files,
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,303 @@
+#!/usr/bin/python3 -ttu
+
+# Benchmark of whole runs of hardlinkpy over generated directory trees.
+#
+# A tree is generated deterministically from a seed for each scenario, and the
+# real main() is run over it in a separate process, so the peak memory of the
+# run is not mixed up with the memory used to generate the tree.  The numbers
+# come from the metrics written with --metrics-json.
+#
+# Run it from the top of the source tree:
+#   $ python3 benchmarks/bench_tree.py
+#   $ python3 benchmarks/bench_tree.py --scenario near-duplicates --files 20000
+#   $ python3 benchmarks/bench_tree.py --save before.json
+#   $ python3 benchmarks/bench_tree.py --compare-to before.json
+#
+# Options after "--" are passed on to hardlinkpy, for example:
+#   $ python3 benchmarks/bench_tree.py -- --compare-workers 4
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, NamedTuple, Optional
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import hardlinkpy.hardlink as hardlink  # noqa: E402
+
+# All the generated files have this modification time, so only their sizes and
+# contents decide which files are candidates.
+TIMESTAMP = 1_262_865_563
+
+BLOCK_SIZE = 4096
+
+
+class TreeSpec(NamedTuple):
+    # How many files are created.
+    files: int
+    # The sizes of the files are distributed log-uniformly between these.
+    min_size: int
+    max_size: int
+    # The share of the files which are copies of an earlier file.
+    duplicate_ratio: float
+    # The share of the files which have the same size as an earlier file, but
+    # differ from it in one byte which the sample digest does not look at.
+    near_duplicate_ratio: float
+    # The share of the files which are already hardlinked to an earlier file.
+    hardlink_ratio: float
+    # How many files are in each directory, and how many directories are in
+    # each directory.
+    fanout: int
+    seed: int = 0
+
+
+SCENARIOS: Dict[str, TreeSpec] = {
+    "small-files": TreeSpec(
+        files=20_000,
+        min_size=1,
+        max_size=16 * 1024,
+        duplicate_ratio=0.3,
+        near_duplicate_ratio=0.05,
+        hardlink_ratio=0.0,
+        fanout=32,
+    ),
+    "large-files": TreeSpec(
+        files=200,
+        min_size=1024 ** 2,
+        max_size=64 * 1024 ** 2,
+        duplicate_ratio=0.5,
+        near_duplicate_ratio=0.1,
+        hardlink_ratio=0.0,
+        fanout=16,
+    ),
+    "near-duplicates": TreeSpec(
+        files=2_000,
+        min_size=64 * 1024,
+        max_size=1024 ** 2,
+        duplicate_ratio=0.1,
+        near_duplicate_ratio=0.6,
+        hardlink_ratio=0.0,
+        fanout=32,
+    ),
+    # Like a tree of rsnapshot backups, where most files are already
+    # hardlinked to the same file in an earlier snapshot.
+    "snapshots": TreeSpec(
+        files=30_000,
+        min_size=1,
+        max_size=256 * 1024,
+        duplicate_ratio=0.05,
+        near_duplicate_ratio=0.01,
+        hardlink_ratio=0.9,
+        fanout=64,
+    ),
+}
+
+
+class Result(NamedTuple):
+    scenario: str
+    files: int
+    seconds: float
+    files_per_second: float
+    bytes_read_per_second: float
+    peak_rss_bytes: int
+
+
+def make_data(*, seed: int, size: int) -> bytes:
+    """Make data of `size` bytes which is unique for each seed"""
+    block = (
+        random.Random(seed).getrandbits(BLOCK_SIZE * 8).to_bytes(BLOCK_SIZE, "little")
+    )
+    return (block * (size // BLOCK_SIZE + 1))[:size]
+
+
+def directory_of(*, root: str, index: int, fanout: int) -> str:
+    """The directory of the file with this index, `fanout` files per directory"""
+    parts = []
+    directory_index = index // fanout
+    while directory_index:
+        directory_index, part = divmod(directory_index - 1, fanout)
+        parts.append(f"d{part:03d}")
+    return os.path.join(root, *reversed(parts))
+
+
+class WrittenFile(NamedTuple):
+    filename: str
+    size: int
+    seed: int
+
+
+def generate_tree(*, root: str, spec: TreeSpec) -> int:
+    """Generate the files of a tree, returning how many bytes were written"""
+    rng = random.Random(spec.seed)
+    written: List[WrittenFile] = []
+    bytes_written = 0
+    for index in range(spec.files):
+        directory = directory_of(root=root, index=index, fanout=spec.fanout)
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, f"f{index:07d}.dat")
+
+        choice = rng.random()
+        if written and choice < spec.hardlink_ratio:
+            os.link(rng.choice(written).filename, filename)
+            continue
+        choice -= spec.hardlink_ratio
+        changed_offset = None
+        if written and choice < spec.duplicate_ratio + spec.near_duplicate_ratio:
+            original = rng.choice(written)
+            size, seed = original.size, original.seed
+            if choice >= spec.duplicate_ratio and size:
+                # A quarter into the file is between the samples of the head
+                # and of the middle, so the difference is only found by
+                # reading the whole file.
+                changed_offset = size // 4
+        else:
+            log_size = rng.uniform(math.log(spec.min_size), math.log(spec.max_size))
+            size = int(math.exp(log_size))
+            seed = rng.getrandbits(64)
+
+        data = make_data(seed=seed, size=size)
+        if changed_offset is not None:
+            changed = bytearray(data)
+            changed[changed_offset] ^= 0xFF
+            data = bytes(changed)
+        with open(filename, "wb") as out_file:
+            out_file.write(data)
+        os.utime(filename, (TIMESTAMP, TIMESTAMP))
+        bytes_written += len(data)
+        written.append(WrittenFile(filename=filename, size=size, seed=seed))
+    return bytes_written
+
+
+def run_hardlink(*, root: str, hardlink_options: List[str]) -> Dict[str, Any]:
+    """Run main() of hardlinkpy in its own process and return its metrics"""
+    with tempfile.NamedTemporaryFile(suffix=".json") as metrics_file:
+        command = [
+            sys.executable,
+            "-c",
+            "import sys; import hardlinkpy.hardlink as h; sys.exit(h.main())",
+            "--quiet",
+            "--metrics-json",
+            metrics_file.name,
+        ]
+        subprocess.run(command + hardlink_options + [root], check=True, cwd=ROOT_DIR)
+        with open(metrics_file.name) as in_file:
+            metrics: Dict[str, Any] = json.load(in_file)
+    return metrics
+
+
+def run_scenario(
+    *, name: str, spec: TreeSpec, repeat: int, hardlink_options: List[str]
+) -> Result:
+    """Run a scenario `repeat` times on fresh trees and keep the fastest run"""
+    best: Optional[Result] = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as root:
+            generate_tree(root=root, spec=spec)
+            metrics = run_hardlink(root=root, hardlink_options=hardlink_options)
+        # The run time measured by hardlinkpy leaves out starting Python.
+        seconds = metrics["run_seconds"]
+        compare_seconds = metrics["phase_seconds"]["compare"] or 1e-9
+        result = Result(
+            scenario=name,
+            files=metrics["regular_files"],
+            seconds=seconds,
+            files_per_second=metrics["regular_files"] / seconds,
+            bytes_read_per_second=metrics["bytes_read"] / compare_seconds,
+            peak_rss_bytes=metrics["peak_rss_bytes"] or 0,
+        )
+        if best is None or result.seconds < best.seconds:
+            best = result
+    assert best is not None
+    return best
+
+
+def print_results(
+    *, results: List[Result], baseline: Optional[Dict[str, Dict[str, float]]]
+) -> None:
+    print(
+        f"{'scenario':<16} {'files':>8} {'seconds':>8} {'files/s':>10}"
+        f" {'read/s':>20} {'peak RSS':>20}"
+    )
+    for result in results:
+        line = (
+            f"{result.scenario:<16} {result.files:>8,} {result.seconds:>8.2f}"
+            f" {result.files_per_second:>10,.0f}"
+            f" {hardlink.humanize_number(int(result.bytes_read_per_second)):>20}"
+            f" {hardlink.humanize_number(result.peak_rss_bytes):>20}"
+        )
+        if baseline is not None and result.scenario in baseline:
+            before = baseline[result.scenario]["files_per_second"]
+            change = (result.files_per_second - before) / before * 100
+            line += f"  {change:+.1f}% files/s"
+        print(line)
+
+
+def main(passed_args: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scenario",
+        choices=sorted(SCENARIOS),
+        action="append",
+        help="Scenarios to run (default: all of them)",
+    )
+    parser.add_argument("--files", type=int, help="Override the number of files")
+    parser.add_argument("--min-size", type=int, help="Override the smallest size")
+    parser.add_argument("--max-size", type=int, help="Override the largest size")
+    parser.add_argument("--duplicate-ratio", type=float)
+    parser.add_argument("--near-duplicate-ratio", type=float)
+    parser.add_argument("--hardlink-ratio", type=float)
+    parser.add_argument("--fanout", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Best of this many runs is reported"
+    )
+    parser.add_argument("--save", metavar="FILE", help="Save the results as JSON")
+    parser.add_argument(
+        "--compare-to", metavar="FILE", help="Compare to results saved with --save"
+    )
+    parser.add_argument(
+        "hardlink_options", nargs="*", help="Options passed on to hardlinkpy"
+    )
+    args = parser.parse_args(passed_args)
+
+    overrides = {
+        field: getattr(args, field)
+        for field in TreeSpec._fields
+        if getattr(args, field, None) is not None
+    }
+    baseline = None
+    if args.compare_to:
+        with open(args.compare_to) as in_file:
+            baseline = json.load(in_file)
+
+    results = []
+    for name in args.scenario or sorted(SCENARIOS):
+        spec = SCENARIOS[name]._replace(**overrides)
+        results.append(
+            run_scenario(
+                name=name,
+                spec=spec,
+                repeat=args.repeat,
+                hardlink_options=args.hardlink_options,
+            )
+        )
+    print_results(results=results, baseline=baseline)
+
+    if args.save:
+        with open(args.save, "w") as out_file:
+            json.dump(
+                {result.scenario: result._asdict() for result in results},
+                out_file,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
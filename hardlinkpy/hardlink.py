@@ -37,236 +37,1061 @@
 # <jakub@redhat.com>
 #
 # ------------------------------------------------------------------------
-#
-# TODO(jlvillal):
-#   *   Thinking it might make sense to walk the entire tree first and collect
-#       up all the file information before starting to do comparisons.  Thought
-#       here is we could find all the files which are hardlinked to each other
-#       and then do a comparison.  If they are identical then hardlink
-#       everything at once.
 
 import argparse
+import collections
+import concurrent.futures
+import contextvars
+import cProfile
+import errno
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import marshal
+import mmap
+import multiprocessing
 import os
 import re
+import sqlite3
 import stat
+import struct
 import sys
+import tempfile
+import threading
 import time
-from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None  # type: ignore
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore
+
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
+
+
+class StatInfo(object):
+    """The parts of the stat() information of a file which are used.
+
+    An os.stat_result holds many fields and float objects for every file,
+    while this only holds the fields needed to find and hardlink identical
+    files.  The fields have the same names as in os.stat_result.
+    """
+
+    __slots__ = (
+        "st_mode",
+        "st_ino",
+        "st_dev",
+        "st_nlink",
+        "st_uid",
+        "st_gid",
+        "st_size",
+        "st_mtime_ns",
+        "st_blocks",
+    )
+
+    st_mode: int
+    st_ino: int
+    st_dev: int
+    st_nlink: int
+    st_uid: int
+    st_gid: int
+    st_size: int
+    st_mtime_ns: int
+    st_blocks: int
+
+    # The mode, device, owner and group of most files are the same as those of
+    # many other files, so one int object is shared for each value.
+    _shared_values: Dict[int, int] = {}
+
+    def __init__(self, stat_result: os.stat_result) -> None:
+        share = self._shared_values.setdefault
+        self.st_mode = share(stat_result.st_mode, stat_result.st_mode)
+        self.st_ino = stat_result.st_ino
+        self.st_dev = share(stat_result.st_dev, stat_result.st_dev)
+        self.st_nlink = stat_result.st_nlink
+        self.st_uid = share(stat_result.st_uid, stat_result.st_uid)
+        self.st_gid = share(stat_result.st_gid, stat_result.st_gid)
+        self.st_size = stat_result.st_size
+        self.st_mtime_ns = stat_result.st_mtime_ns
+        # Not every platform has st_blocks.
+        self.st_blocks = getattr(stat_result, "st_blocks", 0)
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 1e9
+
+    @classmethod
+    def to_record(cls, stat_info: "StatLike") -> List[int]:
+        """Return the fields as a list, for saving them in a checkpoint"""
+        return [getattr(stat_info, name) for name in cls.__slots__]
+
+    @classmethod
+    def from_record(cls, record: List[int]) -> "StatInfo":
+        """Create a StatInfo from a list returned by to_record()"""
+        stat_info = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, record):
+            setattr(stat_info, name, value)
+        return stat_info
+
+
+# Either kind of stat() information can be used by the functions below.
+StatLike = Union[os.stat_result, StatInfo]
 
 
 class FileInfo(NamedTuple):
     filename: str
-    stat_info: os.stat_result
+    stat_info: StatLike
 
 
-# MAX_HASHES must be a power of 2, so that MAX_HASHES - 1 will be a value with
-# all bits set to 1
-MAX_HASHES = 2 ** 17
-assert (MAX_HASHES & (MAX_HASHES - 1)) == 0, "MAX_HASHES must be a power of 2"
-MAX_HASHES_MINUS_1 = MAX_HASHES - 1
+class InodeGroup(object):
+    """The files found for one inode, in the order they were found."""
 
+    __slots__ = ("stat_info", "filenames")
 
-# Hash functions
-# Create a hash from a file's size and time values
-def hash_size_time(*, size: int, time: float) -> int:
-    return (size ^ int(time)) & (MAX_HASHES_MINUS_1)
+    def __init__(self, *, filename: str, stat_info: StatLike) -> None:
+        self.stat_info = stat_info
+        self.filenames = [filename]
 
+    @property
+    def file_info(self) -> FileInfo:
+        return FileInfo(filename=self.filenames[0], stat_info=self.stat_info)
 
-def hash_size(size: int) -> int:
-    return (size) & (MAX_HASHES_MINUS_1)
 
+# The key of an inode in inode_index.  With --filenames-equal only files of an
+# inode with the same name are grouped together.
+InodeKey = Tuple[object, ...]
+
+
+# How many bytes are read from each of the head, middle and tail of a file to
+# create its sample digest.
+SAMPLE_SIZE = 4096
+
+# The most files which are kept open at the same time when comparing a group of
+# files, by each compare worker.  Fewer are kept open when the limit on open
+# files of the process is too low for all of the workers, see max_open_files().
+MAX_OPEN_FILES = 256
+
+# How many of the files which the process may open are left for everything
+# else than comparing files, like the directories kept open by DirectoryFds.
+OPEN_FILES_HEADROOM = 128
+
+# How often opening a file is tried again when the process is out of file
+# descriptors, which other compare workers may be about to close, and how many
+# seconds are waited before each try.
+OPEN_FILE_RETRIES = 10
+OPEN_FILE_RETRY_DELAY = 0.1
+
+# Files are compared in chunks which start at FIRST_CHUNK_SIZE, so files which
+# differ early are told apart cheaply, and grow by CHUNK_GROWTH up to the
+# --max-chunk-size, which is BUFFER_SIZE by default.
+FIRST_CHUNK_SIZE = 64 * 1024
+CHUNK_GROWTH = 2
+BUFFER_SIZE = 1024 * 1024
+
+# How many of the buffers used to compare files are kept for reuse by each
+# thread.
+MAX_POOLED_BUFFERS = 4
+
+# The upper bounds of the buckets of the histogram of how many inodes are in
+# each list of candidates.
+CANDIDATE_BUCKETS = (2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# The sample digests of files, by (st_dev, st_ino).  None if the file could not
+# be read.
+SampleDigests = Dict[Tuple[int, int], Optional[bytes]]
 
-def hash_value(*, size: int, time: float, notimestamp: bool) -> int:
-    if notimestamp:
-        return hash_size(size)
-    else:
-        return hash_size_time(size=size, time=time)
+
+# The key of a file in file_index.  Files are only eligible to be hardlinked
+# to each other if they have the same key.
+IndexKey = Tuple[object, ...]
+
+
+def index_key(*, file_info: FileInfo, args: argparse.Namespace) -> IndexKey:
+    """Create the file_index key of a file
+
+    The key holds everything which has to be equal for files to be hardlinked,
+    except for their contents: the device and the size, and depending on the
+    options the mode, the owner, the modification time and the filename.
+    """
+    stat_info = file_info.stat_info
+    key: IndexKey = (stat_info.st_dev, stat_info.st_size)
+    if not args.content_only:
+        key += (stat_info.st_mode, stat_info.st_uid, stat_info.st_gid)
+        if not args.notimestamp:
+            key += (stat_info.st_mtime_ns,)
+    if args.samename:
+        key += (os.path.basename(file_info.filename),)
+    return key
 
 
 # If two files have the same inode and are on the same device then they are
 # already hardlinked.
-def is_already_hardlinked(*, st1: os.stat_result, st2: os.stat_result) -> bool:
+def is_already_hardlinked(*, st1: StatLike, st2: StatLike) -> bool:
     result = (st1.st_ino == st2.st_ino) and (st1.st_dev == st2.st_dev)
     return result
 
 
-# Determine if a file is eligibile for hardlinking.  Files will only be
-# considered for hardlinking if this function returns true.
-def eligible_for_hardlink(
-    *, st1: os.stat_result, st2: os.stat_result, args: argparse.Namespace
-) -> bool:
+# O_DIRECT is only available on some systems, like Linux.
+O_DIRECT = getattr(os, "O_DIRECT", 0)
 
-    # Must meet the following
-    # criteria:
-    # * NOT already hard linked to each other
-    # * sizes are equal
-    # * size is greater than or equal to args.min_size
-    # * file modes are equal OR we are comparing content only
-    # * owner user ids are equal OR we are comparing content only
-    # * owner group ids are equal OR we are comparing content only
-    # * modified times are equal OR date hashing is off OR we are comparing
-    #   content only
-    # * device is the same
-
-    # * sizes are equal
-    if not (st1.st_size == st2.st_size):
-        return False
 
-    # * size is greater than or equal to args.min_size
-    # The size should always be greater than or equal to the min size as the
-    # caller should ensure that, but to be safe we check anyway.
-    if st1.st_size < args.min_size:
-        return False
+def advise(*, fd: int, offset: int, length: int, advice: str) -> None:
+    """Give the kernel a posix_fadvise() hint, where the system supports it
 
-    if not args.content_only:
-        # * file modes are equal
-        if not (st1.st_mode == st2.st_mode):
-            return False
+    `advice` is the name of the hint without its POSIX_FADV_ prefix.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    os.posix_fadvise(fd, offset, length, getattr(os, f"POSIX_FADV_{advice}"))
+    current_state().stats.did_syscalls(1)
 
-        # * owner user ids are equal
-        if not (st1.st_uid == st2.st_uid):
-            return False
 
-        # * owner group ids are equal
-        if not (st1.st_gid == st2.st_gid):
-            return False
+def open_direct(path: str, flags: int) -> int:
+    """Open a file with O_DIRECT, or without it if the file system refuses it"""
+    try:
+        return os.open(path, flags | O_DIRECT)
+    except OSError as exc:
+        if exc.errno != errno.EINVAL:
+            raise
+    return os.open(path, flags)
 
-    if not args.content_only and not args.notimestamp:
-        # * modified times are equal
-        if not (st1.st_mtime == st2.st_mtime):
-            return False
 
-    # * device is the same
-    if not (st1.st_dev == st2.st_dev):
-        return False
+class UncachedFile(io.FileIO):
+    """A file which is read without filling the page cache.
 
-    # * NOT already hard linked to each other
-    # The files should not be hardlinked to each other as the caller should
-    # ensure that, but to be safe we check anyway.
-    if is_already_hardlinked(st1=st1, st2=st2):
-        return False
+    The kernel is told that the file is read sequentially, to read the next
+    chunk ahead while the current one is compared, and to drop each chunk
+    from the page cache once it has been read.  Pages of the file which were
+    cached before it was read are dropped too.
 
-    return True
+    With `direct` the file is opened with O_DIRECT if the file system
+    supports it, so the page cache isn't used at all.  It must then be read
+    with readinto() into buffers which are aligned to pages.
+    """
 
+    def __init__(self, filename: str, *, direct: bool = False) -> None:
+        super().__init__(filename, "rb", opener=open_direct if direct else None)
+        self.offset = 0
+        advise(fd=self.fileno(), offset=0, length=0, advice="SEQUENTIAL")
 
-def are_file_contents_equal(
-    *, filename1: str, filename2: str, args: argparse.Namespace
-) -> bool:
-    """Determine if the contents of two files are equal.
+    def readinto(self, buffer: Any) -> Optional[int]:
+        fd, length = self.fileno(), len(buffer)
+        advise(fd=fd, offset=self.offset + length, length=length, advice="WILLNEED")
+        count = super().readinto(buffer)
+        if count:
+            advise(fd=fd, offset=self.offset, length=count, advice="DONTNEED")
+            self.offset = self.offset + count
+        return count
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self.offset = super().seek(offset, whence)
+        return self.offset
+
+    def close(self) -> None:
+        if not self.closed:
+            # Also drop what was read with read() and what was read ahead.
+            advise(fd=self.fileno(), offset=0, length=0, advice="DONTNEED")
+        super().close()
+
+
+def open_for_reading(*, filename: str, direct: bool = False) -> io.FileIO:
+    """Open a file to read it without buffering, following the cache policy
+
+    `direct` allows O_DIRECT with the "direct" cache policy, the file must
+    then only be read with readinto() into buffers from take_buffer().
+    """
+    cache_policy = current_state().cache_policy
+    if cache_policy == "keep":
+        return open(filename, "rb", buffering=0)
+    return UncachedFile(filename, direct=direct and cache_policy == "direct")
+
+
+class Timers(object):
+    """The number of calls and the total time of each @timed function"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.timers: Dict[str, List[float]] = {}
+
+    def add(self, *, name: str, elapsed: float) -> None:
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += elapsed
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+# Time the calls of a function on the hot path for --profile.  The calls are
+# only timed for scans with Timers, other scans just check that they have none.
+def timed(function: F) -> F:
+    name = function.__name__
+
+    @functools.wraps(function)
+    def timed_function(*args: Any, **kwargs: Any) -> Any:
+        timers = current_state().timers
+        if timers is None:
+            return function(*args, **kwargs)
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timers.add(name=name, elapsed=time.perf_counter() - start_time)
+
+    return cast(F, timed_function)
+
+
+# Each thread has its own pool of buffers for reading files.  Reusing the
+# buffers is much faster than having read() create new bytes objects, which
+# costs a memory allocation and page faults for every chunk.
+_thread_data = threading.local()
+
+
+# O_DIRECT needs buffers which are aligned to pages, which a bytearray isn't.
+Buffer = Union[bytearray, mmap.mmap]
+
+
+def next_chunk_size(size: int = 0) -> int:
+    """The size of the chunk to read after one of `size`, or of the first one"""
+    state = current_state()
+    max_chunk_size = state.max_chunk_size
+    if not size and state.read_order == "disk":
+        # Seeking between the files costs more than reading too much.
+        return max_chunk_size
+    if not size:
+        return min(FIRST_CHUNK_SIZE, max_chunk_size)
+    return min(size * CHUNK_GROWTH, max_chunk_size)
+
+
+def get_buffer_pool() -> List[Buffer]:
+    """Get the pool of buffers of the current thread
 
-    **!! This function assumes that the file sizes of the two files are
-    equal.
+    The buffers can hold the largest chunk, and are aligned to pages with the
+    "direct" cache policy.
     """
+    state = current_state()
+    name = f"{state.cache_policy}_{state.max_chunk_size}_buffer_pool"
+    if not hasattr(_thread_data, name):
+        setattr(_thread_data, name, [])
+    buffer_pool: List[Buffer] = getattr(_thread_data, name)
+    return buffer_pool
 
+
+def take_buffer(*, buffer_pool: List[Buffer]) -> Buffer:
+    """Take a buffer from a pool, or create one if the pool is empty"""
+    if buffer_pool:
+        return buffer_pool.pop()
+    state = current_state()
+    if state.cache_policy == "direct":
+        # Anonymous memory maps start at a page boundary.
+        return mmap.mmap(-1, state.max_chunk_size)
+    return bytearray(state.max_chunk_size)
+
+
+def release_buffers(*, buffer_pool: List[Buffer], buffers: List[Buffer]) -> None:
+    """Put buffers back into a pool, keeping at most MAX_POOLED_BUFFERS"""
+    buffer_pool.extend(buffers[: max(0, MAX_POOLED_BUFFERS - len(buffer_pool))])
+
+
+def readinto_buffer(*, in_file: io.FileIO, buffer: Buffer, size: int) -> int:
+    """Read `size` bytes of a file into a buffer, returning how many were read.
+
+    Less than `size` is only read at the end of the file.
+    """
+    length = 0
+    with memoryview(buffer) as view:
+        while length < size:
+            count = in_file.readinto(view[length:size])
+            if not count:
+                break
+            length = length + count
+    return length
+
+
+def are_buffers_equal(*, buffer1: Buffer, buffer2: Buffer, length: int) -> bool:
+    """Compare the first `length` bytes of two buffers without copying them."""
+    if isinstance(buffer1, mmap.mmap):
+        # A memory map has no startswith(), copying the bytes out of it is
+        # still much faster than comparing memoryviews.
+        return buffer1[:length] == buffer2[:length]
+    with memoryview(buffer2) as view:
+        # Comparing memoryviews is done one item at a time, startswith() uses
+        # memcmp().
+        return buffer1.startswith(view[:length])
+
+
+@timed
+def split_identical_files(
+    *, filenames: List[str], args: argparse.Namespace
+) -> List[List[str]]:
+    """Split a list of files up into lists of files with identical contents.
+
+    All of the files are read together, one chunk at a time.  After each chunk
+    the files are split up by the contents of that chunk, and a file is closed
+    as soon as no other file has the same contents.  So each file is read at
+    most once, no matter how many different contents there are.
+
+    Every file which could be read is in exactly one of the returned lists, in
+    the same order as in `filenames`.
+
+    **!! This function assumes that the file sizes of the files are equal.
+    """
+    if len(filenames) > current_state().max_open_files:
+        return split_many_identical_files(filenames=filenames, args=args)
+
+    open_files = open_files_to_compare(filenames)
+    if open_files is None:
+        # Out of file descriptors, which is no reason to leave the files out.
+        return split_many_identical_files(filenames=filenames, args=args)
+
+    if args.show_progress:
+        print(f"Comparing: {filenames[0]}")
+        for filename in filenames[1:]:
+            print(f"     to  : {filename}")
+    current_state().stats.did_comparison(len(filenames) - 1)
+
+    identical_files: List[List[str]] = []
     try:
-        # Open our two files
-        with open(filename1, "rb") as file1:
-            with open(filename2, "rb") as file2:
-                gStats.did_comparison()
-                if args.show_progress:
-                    print(f"Comparing: {filename1}")
-                    print(f"     to  : {filename2}")
-                buffer_size = 1024 * 1024
+        buffer_pool = get_buffer_pool()
+        # The lists of files which have been identical so far.
+        unfinished = [list(open_files)]
+        size = next_chunk_size()
+        while unfinished:
+            still_unfinished = []
+            for same_files in unfinished:
+                for length, chunk_files in read_next_chunks(
+                    filenames=same_files,
+                    open_files=open_files,
+                    buffer_pool=buffer_pool,
+                    size=size,
+                ):
+                    if length < size or len(chunk_files) == 1:
+                        identical_files.append(chunk_files)
+                        for filename in chunk_files:
+                            open_files.pop(filename).close()
+                    else:
+                        still_unfinished.append(chunk_files)
+            unfinished = still_unfinished
+            size = next_chunk_size(size)
+    finally:
+        for open_file in open_files.values():
+            open_file.close()
+
+    order = {filename: index for index, filename in enumerate(filenames)}
+    return sorted(identical_files, key=lambda files: order[files[0]])
+
+
+def open_files_to_compare(filenames: List[str]) -> Optional[Dict[str, io.FileIO]]:
+    """Open files to compare them, leaving out the files which can't be opened.
+
+    Returns None, with none of the files open, if the process or the system
+    ran out of file descriptors.
+    """
+    open_files: Dict[str, io.FileIO] = {}
+    for filename in filenames:
+        try:
+            open_files[filename] = open_for_reading(filename=filename, direct=True)
+        except OSError as exc:
+            if exc.errno in (errno.EMFILE, errno.ENFILE):
+                for open_file in open_files.values():
+                    open_file.close()
+                return None
+            print(f"Error opening file in split_identical_files(): {filename}")
+            print("When an exception occurred: {}".format(exc))
+        else:
+            current_state().stats.opened_file()
+    return open_files
+
+
+def max_open_files(*, workers: int) -> int:
+    """The most files which each of `workers` compare workers keeps open
+
+    The limit on open files of the process, RLIMIT_NOFILE, is shared by the
+    workers after leaving OPEN_FILES_HEADROOM files for the rest of the scan.
+    """
+    if resource is None:
+        return MAX_OPEN_FILES
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return MAX_OPEN_FILES
+    # At least two files, or files could not be compared at all.
+    return max(2, min(MAX_OPEN_FILES, (soft_limit - OPEN_FILES_HEADROOM) // workers))
+
+
+def read_next_chunks(
+    *,
+    filenames: List[str],
+    open_files: Dict[str, io.FileIO],
+    buffer_pool: List[Buffer],
+    size: int,
+) -> List[Tuple[int, List[str]]]:
+    """Read the next chunk of `size` bytes of each file and group the files by it.
+
+    Returns the length of each different chunk read, with the files which had
+    that chunk.  The chunks are read into buffers taken from buffer_pool, and
+    the buffers are put back into it afterwards.  A file which can't be read
+    is closed and left out.
+    """
+    chunks: List[Tuple[Buffer, int, List[str]]] = []
+    for filename in filenames:
+        buffer = take_buffer(buffer_pool=buffer_pool)
+        try:
+            length = readinto_buffer(
+                in_file=open_files[filename], buffer=buffer, size=size
+            )
+        except OSError as exc:
+            print(f"Error reading file: {filename}")
+            print("When an exception occurred: {}".format(exc))
+            open_files.pop(filename).close()
+            release_buffers(buffer_pool=buffer_pool, buffers=[buffer])
+            continue
+        current_state().stats.did_read(length)
+        for chunk_buffer, chunk_length, chunk_files in chunks:
+            if chunk_length == length and are_buffers_equal(
+                buffer1=chunk_buffer, buffer2=buffer, length=length
+            ):
+                chunk_files.append(filename)
+                release_buffers(buffer_pool=buffer_pool, buffers=[buffer])
+                break
+        else:
+            chunks.append((buffer, length, [filename]))
+    release_buffers(
+        buffer_pool=buffer_pool, buffers=[chunk_buffer for chunk_buffer, _, _ in chunks]
+    )
+    return [(length, chunk_files) for _, length, chunk_files in chunks]
+
+
+@timed
+def split_many_identical_files(
+    *, filenames: List[str], args: argparse.Namespace
+) -> List[List[str]]:
+    """Split up more files than can be kept open at the same time.
+
+    The files are split up by a digest of their full contents, reading one
+    file at a time, so each file is still read only once.  Like the digests
+    of split_inode_groups_by_digest(), files with the same digest are taken
+    to be identical without comparing them byte for byte.
+    """
+    if args.show_progress:
+        print(f"Comparing by digest: {filenames[0]}")
+        for filename in filenames[1:]:
+            print(f"               to  : {filename}")
+    current_state().stats.did_comparison(len(filenames) - 1)
+    files_by_digest: Dict[bytes, List[str]] = {}
+    for filename in filenames:
+        try:
+            digest = file_digest_retrying(filename=filename)
+        except OSError as exc:
+            print(f"Error reading file: {filename}")
+            print("When an exception occurred: {}".format(exc))
+            continue
+        files_by_digest.setdefault(digest, []).append(filename)
+    return list(files_by_digest.values())
+
+
+def file_digest_retrying(*, filename: str) -> bytes:
+    """Like file_digest(), but try again while out of file descriptors"""
+    for _ in range(OPEN_FILE_RETRIES):
+        try:
+            return file_digest(filename=filename)
+        except OSError as exc:
+            if exc.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+        time.sleep(OPEN_FILE_RETRY_DELAY)
+    return file_digest(filename=filename)
+
+
+@timed
+def file_digest(*, filename: str) -> bytes:
+    """Create a digest of the full contents of a file."""
+    hasher = hashlib.blake2b()
+    buffer_pool = get_buffer_pool()
+    buffer = take_buffer(buffer_pool=buffer_pool)
+    # The whole file is read, so there is no point in starting with small chunks.
+    size = current_state().max_chunk_size
+    try:
+        with open_for_reading(filename=filename, direct=True) as in_file:
+            current_state().stats.opened_file()
+            with memoryview(buffer) as view:
                 while True:
-                    buffer1 = file1.read(buffer_size)
-                    buffer2 = file2.read(buffer_size)
-                    if buffer1 != buffer2:
-                        return False
+                    length = readinto_buffer(in_file=in_file, buffer=buffer, size=size)
+                    hasher.update(view[:length])
+                    current_state().stats.did_read(length)
+                    if length < size:
+                        break
+    finally:
+        release_buffers(buffer_pool=buffer_pool, buffers=[buffer])
+    return hasher.digest()
 
-                    if not buffer1:
-                        return True
-    except (OSError, PermissionError) as exc:
-        print("Error opening file in are_file_contents_equal()")
-        print("Was attempting to open:")
-        print(f"file1: {filename1}")
-        print(f"file2: {filename2}")
-        print("When an exception occurred: {}".format(exc))
-    return False
 
+@timed
+def sample_digest(*, filename: str, size: int) -> bytes:
+    """Create a digest from samples of the head, middle and tail of a file.
 
-# Determines if two files should be hard linked together.
-def are_files_hardlinkable(
-    *, file_info_1: FileInfo, file_info_2: FileInfo, args: argparse.Namespace
-) -> bool:
+    Files which are identical will have the same sample digest, so files with
+    different sample digests don't need to have their full contents compared.
+    Small files are read completely.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    # The samples aren't aligned for O_DIRECT.
+    with open_for_reading(filename=filename) as in_file:
+        current_state().stats.opened_file()
+        if size <= SAMPLE_SIZE * 3:
+            data = in_file.read()
+            hasher.update(data)
+            current_state().stats.did_read(len(data))
+        else:
+            for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                in_file.seek(offset)
+                data = in_file.read(SAMPLE_SIZE)
+                hasher.update(data)
+                # The seek and the read
+                current_state().stats.did_read(len(data), reads=2)
+    return hasher.digest()
+
+
+def get_sample_digest(
+    *, file_info: FileInfo, sample_digests: SampleDigests
+) -> Optional[bytes]:
+    """Get the sample digest of a file, only reading it the first time.
+
+    If there is a digest cache then the sample digest is taken from it when
+    possible, and stored in it when the file had to be read.
+    """
+    stat_info = file_info.stat_info
+    key = (stat_info.st_dev, stat_info.st_ino)
+    if key in sample_digests:
+        return sample_digests[key]
+
+    sample_digests[key] = None
+    digest_cache = current_state().digest_cache
+    cached_digests = digest_cache.lookup(stat_info) if digest_cache else None
+    if cached_digests is not None:
+        current_state().stats.found_cached_digest()
+        sample_digests[key] = cached_digests.sample_digest
+        return cached_digests.sample_digest
+    try:
+        sample_digests[key] = sample_digest(
+            filename=file_info.filename, size=stat_info.st_size
+        )
+    except OSError as exc:
+        print(f"Error reading sample of file: {file_info.filename}")
+        print("When an exception occurred: {}".format(exc))
+    else:
+        if digest_cache is not None:
+            digest_cache.store(stat_info, sample_digest=sample_digests[key])
+    return sample_digests[key]
 
-    # See if the files are eligible for hardlinking
-    if not eligible_for_hardlink(
-        st1=file_info_1.stat_info, st2=file_info_2.stat_info, args=args
-    ):
-        return False
 
-    if args.samename:
-        # Check if the base filenames are the same
-        basename1 = os.path.basename(file_info_1.filename)
-        basename2 = os.path.basename(file_info_2.filename)
-        if basename1 != basename2:
-            return False
+def get_file_digest(*, file_info: FileInfo, sample_digests: SampleDigests) -> bytes:
+    """Get the digest of the full contents of a file from the digest cache.
 
-    return are_file_contents_equal(
-        filename1=file_info_1.filename, filename2=file_info_2.filename, args=args
+    If the digest isn't in the cache the file is read and its digest is stored
+    in the cache.  The sample digest of the file must already be known.
+    """
+    digest_cache = current_state().digest_cache
+    assert digest_cache is not None
+    stat_info = file_info.stat_info
+    cached_digests = digest_cache.lookup(stat_info)
+    if cached_digests is not None and cached_digests.full_digest is not None:
+        current_state().stats.found_cached_digest()
+        return cached_digests.full_digest
+    full_digest = file_digest(filename=file_info.filename)
+    digest_cache.store(
+        stat_info,
+        sample_digest=sample_digests[(stat_info.st_dev, stat_info.st_ino)],
+        full_digest=full_digest,
     )
+    return full_digest
 
 
 # Hardlink two files together
+class LinkAction(NamedTuple):
+    sourcefile: str
+    destfile: str
+    # The size of the file, which is saved if it was hardlinked.
+    size: int
+    # False if hardlinking the file failed.
+    linked: bool
+
+
+@timed
 def hardlink_files(
     *,
     sourcefile: str,
     destfile: str,
-    stat_info: os.stat_result,
+    stat_info: StatLike,
     args: argparse.Namespace,
 ) -> bool:
+    if args.dry_run:
+        result = True
+    elif args.link_strategy == "rename":
+        result = rename_and_link(sourcefile=sourcefile, destfile=destfile)
+        current_state().stats.did_syscalls(3)
+    else:
+        result = link_and_rename(sourcefile=sourcefile, destfile=destfile)
+        current_state().stats.did_syscalls(3)
+    if result:
+        # update our stats
+        current_state().stats.did_hardlink(sourcefile, destfile, stat_info)
+        if args.show_progress:
+            if args.dry_run:
+                print("Did NOT link.  Dry run")
+            size = stat_info.st_size
+            print(f"Linked: {sourcefile}")
+            print(f"    to: {destfile}, saved {size}")
+    return result
+
+
+# Rename the destination out of the way, link the source to it and then remove
+# the renamed destination.  The destination does not exist for a short time.
+# How many temporary names are tried before giving up on a link.
+TEMP_NAME_ATTEMPTS = 16
+
+
+def temporary_name(name: str) -> str:
+    """Return a random name for a temporary file next to `name`
+
+    The names are random so a temporary file left behind by an interrupted
+    run does not get in the way of later runs.
+    """
+    return "{}.$$$___cleanit___{}$$$".format(name, os.urandom(6).hex())
+
+
+def rename_and_link(*, sourcefile: str, destfile: str) -> bool:
     # rename the destination file to save it
-    temp_name = destfile + ".$$$___cleanit___$$$"
+    temp_name = temporary_name(destfile)
     try:
-        if not args.dry_run:
-            os.rename(destfile, temp_name)
+        os.rename(destfile, temp_name)
     except OSError as error:
         print(f"Failed to rename: {destfile} to {temp_name}")
         print(error)
-        result = False
-    else:
-        # Now link the sourcefile to the destination file
+        return False
+
+    # Now link the sourcefile to the destination file
+    try:
+        os.link(sourcefile, destfile)
+    except:  # noqa TODO(fix this bare except)
+        too_many_links = is_too_many_links(sys.exc_info()[1])
+        if not too_many_links:
+            logging.exception(f"Failed to hardlink: {sourcefile} to {destfile}")
+        # Try to recover
         try:
-            if not args.dry_run:
-                os.link(sourcefile, destfile)
+            os.rename(temp_name, destfile)
         except:  # noqa TODO(fix this bare except)
-            logging.exception(f"Failed to hardlink: {sourcefile} to {destfile}")
-            # Try to recover
-            try:
-                os.rename(temp_name, destfile)
-            except:  # noqa TODO(fix this bare except)
-                logging.exception(
-                    "BAD BAD - failed to rename back {} to {}".format(
-                        temp_name, destfile
-                    )
+            logging.exception(
+                "BAD BAD - failed to rename back {} to {}".format(temp_name, destfile)
+            )
+        if too_many_links:
+            raise
+        return False
+
+    # hard link succeeded
+    # Delete the renamed version since we don't need it.
+    try:
+        os.unlink(temp_name)
+    except FileNotFoundError:
+        # If our temporary file disappears under us, ignore it.
+        # Probably an rsync is running and deleted it.
+        logging.warning(f"Temporary file vanished: {temp_name}")
+    return True
+
+
+# Link the source to a temporary name next to the destination and then rename
+# it over the destination.  The destination always exists, and the names are
+# resolved relative to open directories so each link costs three operations,
+# with the check that the temporary link is gone.
+def link_and_rename(*, sourcefile: str, destfile: str) -> bool:
+    source_dir, source_name = os.path.split(sourcefile)
+    dest_dir, dest_name = os.path.split(destfile)
+    directory_fds = current_state().directory_fds
+    try:
+        source_dir_fd = directory_fds.get(source_dir)
+        dest_dir_fd = directory_fds.get(dest_dir)
+    except OSError as exc:
+        print(f"Failed to open directory of: {sourcefile} or {destfile}")
+        print("When an exception occurred: {}".format(exc))
+        return False
+    if dest_dir_fd is None:
+        # Without dir_fd support the names are resolved from the full paths.
+        source_name, dest_name = sourcefile, destfile
+
+    try:
+        temp_name = link_temporary_name(
+            source_name=source_name,
+            source_dir_fd=source_dir_fd,
+            dest_name=dest_name,
+            dest_dir_fd=dest_dir_fd,
+        )
+    except OSError as exc:
+        if is_too_many_links(exc):
+            raise
+        print(f"Failed to hardlink: {sourcefile} to {destfile}")
+        print("When an exception occurred: {}".format(exc))
+        return False
+
+    try:
+        os.rename(temp_name, dest_name, src_dir_fd=dest_dir_fd, dst_dir_fd=dest_dir_fd)
+    except OSError as exc:
+        print(f"Failed to rename: {temp_name} to {destfile}")
+        print("When an exception occurred: {}".format(exc))
+        remove_temporary_link(temp_name=temp_name, dest_dir_fd=dest_dir_fd)
+        return False
+
+    # Renaming a link over another link to the same inode does nothing, the
+    # temporary link is then still there and the destination wasn't relinked.
+    try:
+        os.lstat(temp_name, dir_fd=dest_dir_fd)
+    except FileNotFoundError:
+        return True
+    remove_temporary_link(temp_name=temp_name, dest_dir_fd=dest_dir_fd)
+    return False
+
+
+def link_temporary_name(
+    *,
+    source_name: str,
+    source_dir_fd: Optional[int],
+    dest_name: str,
+    dest_dir_fd: Optional[int],
+) -> str:
+    """Link the source to an unused temporary name next to the destination
+
+    Returns the temporary name.  Raises OSError if linking fails, or if no
+    unused name is found in TEMP_NAME_ATTEMPTS tries.
+    """
+    for _ in range(TEMP_NAME_ATTEMPTS):
+        temp_name = temporary_name(dest_name)
+        try:
+            os.link(
+                source_name, temp_name, src_dir_fd=source_dir_fd, dst_dir_fd=dest_dir_fd
+            )
+        except FileExistsError:
+            continue
+        return temp_name
+    raise FileExistsError(
+        errno.EEXIST, "No unused temporary name found next to", dest_name
+    )
+
+
+def remove_temporary_link(*, temp_name: str, dest_dir_fd: Optional[int]) -> None:
+    try:
+        os.unlink(temp_name, dir_fd=dest_dir_fd)
+    except OSError:
+        logging.exception(f"Failed to remove temporary link: {temp_name}")
+
+
+def is_too_many_links(exc: Optional[BaseException]) -> bool:
+    """Whether hardlinking failed as the source has the most links it can have
+
+    The link functions raise this error instead of returning False, so that
+    the files can be linked to another source instead.
+    """
+    return isinstance(exc, OSError) and exc.errno == errno.EMLINK
+
+
+class DirectoryFds(object):
+    """Open directories, so names in them are resolved without their path.
+
+    At most max_open directories are kept open, the least recently used
+    directory is closed first.  get() returns None if the platform does not
+    support the dir_fd arguments of os.link() and os.rename().
+    """
+
+    def __init__(self, *, max_open: int = 64) -> None:
+        self.max_open = max_open
+        self.supported = {os.link, os.rename, os.unlink} <= os.supports_dir_fd
+        self.fds: "collections.OrderedDict[str, int]" = collections.OrderedDict()
+
+    def get(self, directory: str) -> Optional[int]:
+        if not self.supported:
+            return None
+        directory = directory or "."
+        fd = self.fds.get(directory)
+        if fd is not None:
+            self.fds.move_to_end(directory)
+            return fd
+        if len(self.fds) >= self.max_open:
+            _, old_fd = self.fds.popitem(last=False)
+            os.close(old_fd)
+        fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        current_state().stats.did_syscalls(1)
+        self.fds[directory] = fd
+        return fd
+
+    def close(self) -> None:
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
+
+def split_inode_groups(
+    *, inode_groups: List[InodeGroup], args: argparse.Namespace
+) -> List[List[InodeGroup]]:
+    """Split up candidate inodes into lists of inodes with identical contents.
+
+    Only the first file of each inode group is read.  The inodes are first
+    split up by their sample digests and then by their full contents.  Only
+    the lists which have more than one inode are returned.
+
+    If there is a digest cache the inodes are split up by the digests of their
+    full contents instead, so inodes with cached digests are not read at all.
+    """
+    sample_digests: SampleDigests = {}
+    groups_by_digest: Dict[bytes, List[InodeGroup]] = {}
+    for inode_group in in_read_order(inode_groups):
+        digest = get_sample_digest(
+            file_info=inode_group.file_info, sample_digests=sample_digests
+        )
+        if digest is not None:
+            groups_by_digest.setdefault(digest, []).append(inode_group)
+
+    identical_groups: List[List[InodeGroup]] = []
+    for same_sample_groups in groups_by_digest.values():
+        if len(same_sample_groups) == 1:
+            current_state().stats.rejected_by_sample()
+            continue
+        if current_state().digest_cache is not None:
+            identical_groups.extend(
+                split_inode_groups_by_digest(
+                    inode_groups=same_sample_groups, sample_digests=sample_digests
                 )
-            result = False
-        else:
-            # hard link succeeded
-            # Delete the renamed version since we don't need it.
-            if not args.dry_run:
-                try:
-                    os.unlink(temp_name)
-                except FileNotFoundError:
-                    # If our temporary file disappears under us, ignore it.
-                    # Probably an rsync is running and deleted it.
-                    logging.warning(f"Temporary file vanished: {temp_name}")
-                    pass
-            # update our stats
-            gStats.did_hardlink(sourcefile, destfile, stat_info)
-            if args.show_progress:
-                if args.dry_run:
-                    print("Did NOT link.  Dry run")
-                size = stat_info.st_size
-                print(f"Linked: {sourcefile}")
-                print(f"    to: {destfile}, saved {size}")
-            result = True
-    return result
+            )
+            continue
+        groups_by_filename = {group.filenames[0]: group for group in same_sample_groups}
+        for filenames in split_identical_files(
+            filenames=list(groups_by_filename), args=args
+        ):
+            if len(filenames) == 1:
+                current_state().stats.rejected_by_content()
+                continue
+            identical_groups.append(
+                [groups_by_filename[filename] for filename in filenames]
+            )
+    # The inodes of each list are in the order they were found again.
+    found_order = {id(group): index for index, group in enumerate(inode_groups)}
+    return [
+        sorted(same_groups, key=lambda inode_group: found_order[id(inode_group)])
+        for same_groups in identical_groups
+    ]
+
+
+def in_read_order(inode_groups: List[InodeGroup]) -> List[InodeGroup]:
+    """Return the inodes in the order in which they are read, see --read-order"""
+    if current_state().read_order != "disk":
+        return inode_groups
+    return sorted(inode_groups, key=physical_offset)
+
+
+# The FS_IOC_FIEMAP ioctl of Linux, and the layouts of its struct fiemap and of
+# one struct fiemap_extent.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_MAX_OFFSET = 0xFFFFFFFFFFFFFFFF
+FIEMAP_FORMAT = "=QQIIII"
+FIEMAP_EXTENT_FORMAT = "=QQQQQIIII"
+
+
+def physical_offset(inode_group: InodeGroup) -> int:
+    """Return where the data of an inode starts on the disk, for --read-order
+
+    The first extent of the file is asked for with FIEMAP.  Where that isn't
+    supported, the inode number is used, as file systems usually put the
+    data of inodes with close numbers close together.
+    """
+    stat_info = inode_group.stat_info
+    key = (stat_info.st_dev, stat_info.st_ino)
+    physical_offsets = current_state().physical_offsets
+    if key not in physical_offsets:
+        physical_offsets[key] = (
+            first_extent_offset(inode_group.filenames[0]) or stat_info.st_ino
+        )
+    return physical_offsets[key]
+
+
+def first_extent_offset(filename: str) -> Optional[int]:
+    """Return the physical offset of the first extent of a file, if known"""
+    if fcntl is None:
+        return None
+    # The extents from the start to the end of the file, at most one of them
+    request = struct.pack(FIEMAP_FORMAT, 0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0) + bytes(
+        struct.calcsize(FIEMAP_EXTENT_FORMAT)
+    )
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            result = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+            # Opening, the ioctl and closing
+            current_state().stats.did_syscalls(3)
+    except OSError:
+        return None
+    mapped_extents = struct.unpack_from(FIEMAP_FORMAT, result)[3]
+    if not mapped_extents:
+        # The file has no data on the disk.
+        return None
+    offset: int = struct.unpack_from(
+        FIEMAP_EXTENT_FORMAT, result, struct.calcsize(FIEMAP_FORMAT)
+    )[1]
+    return offset
+
+
+def split_inode_groups_by_digest(
+    *, inode_groups: List[InodeGroup], sample_digests: SampleDigests
+) -> List[List[InodeGroup]]:
+    """Split up inodes by the digests of their full contents.
+
+    Only the lists which have more than one inode are returned.
+    """
+    groups_by_digest: Dict[bytes, List[InodeGroup]] = {}
+    for inode_group in in_read_order(inode_groups):
+        try:
+            digest = get_file_digest(
+                file_info=inode_group.file_info, sample_digests=sample_digests
+            )
+        except OSError as exc:
+            print(f"Error reading file: {inode_group.filenames[0]}")
+            print("When an exception occurred: {}".format(exc))
+            continue
+        groups_by_digest.setdefault(digest, []).append(inode_group)
+
+    identical_groups = []
+    for same_digest_groups in groups_by_digest.values():
+        if len(same_digest_groups) == 1:
+            current_state().stats.rejected_by_content()
+            continue
+        current_state().stats.did_comparison(len(same_digest_groups) - 1)
+        identical_groups.append(same_digest_groups)
+    return identical_groups
 
 
 def hardlink_identical_files(
-    *, dir_entry: os.DirEntry, args: argparse.Namespace
+    *, inode_groups: List[InodeGroup], args: argparse.Namespace
 ) -> None:
     """hardlink identical files
 
@@ -287,72 +1112,1120 @@ def hardlink_identical_files(
 
         Walk the directory tree building up a list of the files.
 
-     For each file, generate a simple hash based on the size and modified time.
+     For each file, look up its inode in inode_index.  If the inode has been
+     seen before, the file is simply added to the files of that inode.
+     Otherwise create a key from the criteria above which don't need the file
+     contents, and add the new inode to the list of inodes with that key.
+
+     Once the whole tree has been walked, go through each list of inodes which
+     share a key and compare the contents of the inodes all at once.  All the
+     files of an inode which is identical to an inode found earlier are
+     hardlinked to the file of the earlier inode.
 
-     For any other files which share this hash make sure that they are not
-     identical to this file.  If they are identical then hardlink the files.
+    `inode_groups` is the list of inodes which share a key.
+    """
 
-     Add the file info to the list of files that have the same hash value.
-     """
+    identical_files = find_identical_files(inode_groups=inode_groups, args=args)
+    link_identical_files(identical_files=identical_files, args=args)
 
-    for exclude in args.excludes:
-        if re.search(exclude, dir_entry.path):
-            return
 
-    stat_info = dir_entry.stat(follow_symlinks=False)
-    # Is it a regular file?
-    if stat.S_ISREG(stat_info.st_mode):
-        # Create the hash for the file.
-        file_hash = hash_value(
-            size=stat_info.st_size,
-            time=stat_info.st_mtime,
-            notimestamp=(args.notimestamp or args.content_only),
+class IdenticalFiles(NamedTuple):
+    # The inodes which were compared, in the order they were found.
+    inode_groups: List[InodeGroup]
+    # The lists of inodes which have identical contents.
+    identical_groups: List[List[InodeGroup]]
+
+
+def find_identical_files(
+    *, inode_groups: List[InodeGroup], args: argparse.Namespace
+) -> IdenticalFiles:
+    """Find the inodes with identical contents in a list of inodes.
+
+    All the inodes have the same index key, so every inode is eligible to be
+    hardlinked to every other one.  Nothing is hardlinked, so this function is
+    safe to call from several threads at the same time.
+    """
+    return IdenticalFiles(
+        inode_groups=inode_groups,
+        identical_groups=split_inode_groups(inode_groups=inode_groups, args=args),
+    )
+
+
+def link_identical_files(
+    *, identical_files: IdenticalFiles, args: argparse.Namespace
+) -> List[LinkAction]:
+    """Hardlink the identical files found by find_identical_files()
+
+    All the files of each list of identical inodes are hardlinked to a file of
+    the inode chosen by order_by_source(). If that inode gets as many links as
+    the file system allows, the files which are still to be linked are linked
+    to the file which could not be linked instead.  Returns what was
+    hardlinked.
+    """
+    link_actions: List[LinkAction] = []
+    linked_inode_groups = set()
+    for identical_groups in identical_files.identical_groups:
+        source_group, *other_groups = order_by_source(
+            inode_groups=identical_groups, args=args
+        )
+        for inode_group in other_groups:
+            linked_inode_groups.add(id(inode_group))
+            merged_inode = merge_inode_group(
+                source_group=source_group, inode_group=inode_group, args=args
+            )
+            link_actions.extend(merged_inode.link_actions)
+            if merged_inode.unlinked is not None:
+                source_group = merged_inode.unlinked
+
+    for inode_group in identical_files.inode_groups:
+        if id(inode_group) not in linked_inode_groups:
+            found_existing_hardlinks(inode_group=inode_group)
+    return link_actions
+
+
+def order_by_source(
+    *, inode_groups: List[InodeGroup], args: argparse.Namespace
+) -> List[InodeGroup]:
+    """Put the inode which identical inodes are hardlinked to first
+
+    That is the inode with a file under the earliest --prefer-root, and then
+    the inode with the most links, so the fewest files have to be relinked
+    and the blocks of the other inodes can be freed.  Otherwise the first
+    inode found is kept.
+    """
+
+    def preference(inode_group: InodeGroup) -> Tuple[int, int, int]:
+        return (
+            preferred_root_index(filenames=inode_group.filenames, args=args),
+            -inode_group.stat_info.st_nlink,
+            -len(inode_group.filenames),
+        )
+
+    source_group = min(inode_groups, key=preference)
+    return [source_group] + [
+        inode_group for inode_group in inode_groups if inode_group is not source_group
+    ]
+
+
+def preferred_root_index(*, filenames: List[str], args: argparse.Namespace) -> int:
+    """The index of the first --prefer-root with one of the files under it"""
+    for index, root in enumerate(args.prefer_roots):
+        prefix = os.path.join(root, "")
+        if any(filename.startswith(prefix) for filename in filenames):
+            return index
+    return len(args.prefer_roots)
+
+
+class MergedInode(NamedTuple):
+    link_actions: List[LinkAction]
+    # The files of the inode which were not relinked as the source inode has
+    # as many links as the file system allows, or None if there are none.
+    unlinked: Optional[InodeGroup]
+
+
+def merge_inode_group(
+    *, source_group: InodeGroup, inode_group: InodeGroup, args: argparse.Namespace
+) -> MergedInode:
+    """Hardlink every file of an inode to the first file of source_group
+
+    The blocks of the inode are only freed if all of its links were found and
+    relinked, otherwise a link outside of the directories still holds them.
+    """
+    sourcefile = source_group.filenames[0]
+    link_actions = []
+    unlinked = None
+    for index, filename in enumerate(inode_group.filenames):
+        try:
+            linked = hardlink_files(
+                sourcefile=sourcefile,
+                destfile=filename,
+                stat_info=source_group.stat_info,
+                args=args,
+            )
+        except OSError as exc:
+            if not is_too_many_links(exc):
+                raise
+            if args.show_progress:
+                print(f"Too many links to: {sourcefile}")
+                print(f"  linking files to: {filename} instead")
+            unlinked = InodeGroup(filename=filename, stat_info=inode_group.stat_info)
+            unlinked.filenames = inode_group.filenames[index:]
+            break
+        link_actions.append(
+            LinkAction(
+                sourcefile=sourcefile,
+                destfile=filename,
+                size=source_group.stat_info.st_size,
+                linked=linked,
+            )
+        )
+    stat_info = inode_group.stat_info
+    stats = current_state().stats
+    linked_count = sum(link_action.linked for link_action in link_actions)
+    if linked_count and linked_count >= stat_info.st_nlink:
+        stats.merged_inode(blocks_freed=stat_info.st_blocks)
+    elif linked_count:
+        stats.merged_inode(blocks_freed=0)
+    return MergedInode(link_actions=link_actions, unlinked=unlinked)
+
+
+def found_existing_hardlinks(*, inode_group: InodeGroup) -> None:
+    """Record the files of an inode which were already hardlinked together"""
+    stats = current_state().stats
+    source_filename = inode_group.filenames[0]
+    for filename in inode_group.filenames[1:]:
+        stats.found_hardlink(source_filename, filename, inode_group.stat_info)
+
+
+class DirectoryScan(NamedTuple):
+    # The files which are candidates for hardlinking, in alphabetical order.
+    # Their stat() information has already been retrieved.
+    files: List[os.DirEntry]
+    # The directories found, in alphabetical order.
+    subdirectories: List[str]
+    # How many stat() calls were made, and how long they took.
+    stat_calls: int = 0
+    stat_time: float = 0.0
+    # The ignore rules for the directory, which also apply to its
+    # subdirectories.
+    ignore_rules: "IgnoreRules" = ()
+
+
+class IgnoreRule(NamedTuple):
+    # The directory of the ignore file, ending with a "/".
+    base: str
+    # Matches the paths relative to base which the rule applies to.
+    regex: Pattern[str]
+    # The rule starts with "!" and includes the paths again.
+    negate: bool
+    # The rule ends with "/" and only applies to directories.
+    directory_only: bool
+
+
+# The ignore rules for a directory, a later rule overrides an earlier one.
+IgnoreRules = Tuple[IgnoreRule, ...]
+
+
+def compile_excludes(excludes: List[str]) -> List[Pattern[str]]:
+    """Compile the --exclude regular expressions
+
+    Each expression is compiled on its own, so its flags, groups and
+    backreferences mean what they would mean alone.  The expressions without
+    flags or groups are then joined into one, so paths are searched once
+    for all of them.  Raises re.error for an invalid expression.
+    """
+    plain_flags = re.compile("").flags
+    patterns = [re.compile(exclude) for exclude in excludes]
+    plain = [
+        pattern.pattern
+        for pattern in patterns
+        if pattern.groups == 0 and pattern.flags == plain_flags
+    ]
+    others = [
+        pattern
+        for pattern in patterns
+        if pattern.groups != 0 or pattern.flags != plain_flags
+    ]
+    if not plain:
+        return others
+    return [re.compile("|".join(f"(?:{exclude})" for exclude in plain))] + others
+
+
+def gitignore_regex(pattern: str) -> str:
+    """Translate a gitignore style glob pattern into a regular expression"""
+    regex = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            regex.append("(?:.*/)?")
+            index += 3
+        elif pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+        elif pattern[index] == "*":
+            regex.append("[^/]*")
+            index += 1
+        elif pattern[index] == "?":
+            regex.append("[^/]")
+            index += 1
+        elif pattern[index] == "[" and "]" in pattern[index + 2 :]:  # noqa: E203
+            end = pattern.index("]", index + 2)
+            characters = pattern[index + 1 : end]  # noqa: E203
+            if characters.startswith("!"):
+                characters = "^" + characters[1:]
+            regex.append("[" + characters.replace("\\", "\\\\") + "]")
+            index = end + 1
+        elif pattern[index] == "\\" and index + 1 < len(pattern):
+            regex.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            regex.append(re.escape(pattern[index]))
+            index += 1
+    return "".join(regex)
+
+
+def read_ignore_file(*, filename: str, base: str) -> List[IgnoreRule]:
+    """Read the rules of a gitignore style file in the directory `base`"""
+    rules: List[IgnoreRule] = []
+    try:
+        with open(filename) as in_file:
+            lines = in_file.read().splitlines()
+    except (OSError, UnicodeDecodeError) as exc:
+        print(f"Error reading ignore file: {filename}")
+        print("When an exception occurred: {}".format(exc))
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A pattern with a "/" is relative to the directory of the ignore
+        # file, otherwise it matches a name in any directory below it.
+        prefix = "" if "/" in line else "(?:.*/)?"
+        regex = re.compile(prefix + gitignore_regex(line.lstrip("/")) + "$")
+        rules.append(
+            IgnoreRule(
+                base=base, regex=regex, negate=negate, directory_only=directory_only
+            )
+        )
+    return rules
+
+
+def is_ignored(*, path: str, is_dir: bool, ignore_rules: IgnoreRules) -> bool:
+    """Determine if the last ignore rule which matches a path ignores it"""
+    for rule in reversed(ignore_rules):
+        if rule.directory_only and not is_dir:
+            continue
+        base_length = len(rule.base)
+        if path.startswith(rule.base) and rule.regex.match(path, base_length):
+            return not rule.negate
+    return False
+
+
+def is_excluded(
+    *, path: str, is_dir: bool, args: argparse.Namespace, ignore_rules: IgnoreRules
+) -> bool:
+    """Determine if a path is excluded by --exclude, by an ignore file or
+    because it is the mount point of another device worker
+
+    The --exclude expressions are matched against the path of a directory
+    with a "/" added, so "/node_modules/" excludes the node_modules
+    directories themselves and not only the files in them.
+    """
+    excluded_path = path + "/" if is_dir else path
+    if any(pattern.search(excluded_path) for pattern in args.exclude_patterns):
+        return True
+    if is_dir and path in args.pruned_directories:
+        # Another device worker scans it.
+        return True
+    return bool(ignore_rules) and is_ignored(
+        path=path, is_dir=is_dir, ignore_rules=ignore_rules
+    )
+
+
+def inherited_ignore_rules(*, directory: str, args: argparse.Namespace) -> IgnoreRules:
+    """Read the ignore rules of the directories above `directory`
+
+    Only the directories from the top directory given on the command line
+    down to the parent of `directory` are read.
+    """
+    if not args.ignore_file:
+        return ()
+    rules: List[IgnoreRule] = []
+    for top_directory in args.top_directories:
+        if directory.startswith(top_directory + "/"):
+            relative_path = os.path.relpath(directory, top_directory)
+            parent = top_directory
+            for part in relative_path.split("/"):
+                ignore_file = os.path.join(parent, args.ignore_file)
+                if os.path.isfile(ignore_file):
+                    rules.extend(
+                        read_ignore_file(filename=ignore_file, base=parent + "/")
+                    )
+                parent = os.path.join(parent, part)
+            break
+    return tuple(rules)
+
+
+# Regular expressions for files which are ignored
+# mirror.pl files.  These are the files that start with ".in."
+MIRROR_PL_REGEX = re.compile(r"^\.in\.")
+# RSYNC files.  These are files that have the format .FILENAME.??????
+RSYNC_TEMP_REGEX = re.compile((r"^\..*\.\?{6,6}$"))
+
+
+@timed
+def scan_directory(
+    *, directory: str, args: argparse.Namespace, ignore_rules: IgnoreRules = ()
+) -> Optional[DirectoryScan]:
+    """Scan a single directory
+
+    Files and directories which are excluded or ignored are left out before
+    they are looked at any further, so excluded directories are never
+    scanned.  `ignore_rules` are the rules of the directories above this one.
+
+    Returns None if `directory` is not a directory.  This function is safe to
+    call from several threads at the same time.
+    """
+    directory = directory + "/"
+    if not os.path.isdir(directory):
+        print(f"{directory} is NOT a directory!")
+        return None
+    files: List[os.DirEntry] = []
+    subdirectories: List[str] = []
+    stat_calls = 0
+    stat_time = 0.0
+    # Loop through all the files in the directory
+    try:
+        dir_entries = os.scandir(directory)
+    except (OSError, PermissionError) as exc:
+        print(
+            f"Error: Unable to do an os.scandir on: {directory}  Skipping...",
+            exc,
+        )
+        return DirectoryScan(files=files, subdirectories=subdirectories)
+    sorted_entries = sorted(dir_entries, key=lambda x: x.name)
+    if args.ignore_file and any(
+        dir_entry.name == args.ignore_file for dir_entry in sorted_entries
+    ):
+        ignore_rules = ignore_rules + tuple(
+            read_ignore_file(filename=directory + args.ignore_file, base=directory)
+        )
+    for dir_entry in sorted_entries:
+        pathname = dir_entry.path
+        # Look at files/dirs beginning with "."
+        if dir_entry.name.startswith("."):
+            if MIRROR_PL_REGEX.match(dir_entry.name):
+                continue
+            if RSYNC_TEMP_REGEX.match(dir_entry.name):
+                continue
+        if dir_entry.is_symlink():
+            if debug1:
+                print(f"{pathname}: is a symbolic link, ignoring")
+            continue
+
+        is_dir = dir_entry.is_dir()
+        if is_excluded(
+            path=pathname, is_dir=is_dir, args=args, ignore_rules=ignore_rules
+        ):
+            continue
+
+        if is_dir:
+            subdirectories.append(pathname)
+            continue
+
+        start_time = time.perf_counter()
+        stat_result = dir_entry.stat(follow_symlinks=False)
+        stat_time += time.perf_counter() - start_time
+        stat_calls += 1
+        if stat_result.st_size < args.min_size:
+            if debug1:
+                print(f"{pathname}: Size is not large enough, ignoring")
+            continue
+        files.append(dir_entry)
+    return DirectoryScan(
+        files=files,
+        subdirectories=subdirectories,
+        stat_calls=stat_calls,
+        stat_time=stat_time,
+        ignore_rules=ignore_rules,
+    )
+
+
+def walk_directories(*, args: argparse.Namespace) -> Iterator[os.DirEntry]:
+    """Walk all the directories in args.directories
+
+    Yields a DirEntry for each file which is a candidate for hardlinking.
+    Directories are gone through in alphabetical order.
+    """
+    if args.scan_workers > 1:
+        yield from walk_directories_parallel(args=args)
+        return
+
+    state = current_state()
+    if state.pending_directories is None:
+        state.pending_directories = args.directories.copy()
+    directories = state.pending_directories
+    # The ignore rules for each pending directory.
+    ignore_rules: Dict[str, IgnoreRules] = {}
+    while directories:
+        if state.checkpoint is not None:
+            state.checkpoint.save_if_due(args=args)
+        # Get the last directory in the list
+        directory = directories.pop()
+        directory_scan = scan_directory(
+            directory=directory,
+            args=args,
+            ignore_rules=pop_ignore_rules(
+                directory=directory, ignore_rules=ignore_rules, args=args
+            ),
+        )
+        if directory_scan is None:
+            continue
+        current_state().stats.found_directory(directory_scan)
+        yield from directory_scan.files
+        # Add our found directories in reverse order because we pop them off
+        # the end. Goal is to go through our directories in alphabetical
+        # order.
+        directories.extend(reversed(directory_scan.subdirectories))
+        for subdirectory in directory_scan.subdirectories:
+            ignore_rules[subdirectory] = directory_scan.ignore_rules
+    state.pending_directories = None
+
+
+def pop_ignore_rules(
+    *,
+    directory: str,
+    ignore_rules: Dict[str, IgnoreRules],
+    args: argparse.Namespace,
+) -> IgnoreRules:
+    """Take the ignore rules for a directory which is about to be scanned
+
+    The rules of the top directories, and of directories taken from a
+    checkpoint, are read from the ignore files above them.
+    """
+    rules = ignore_rules.pop(directory, None)
+    if rules is None:
+        rules = inherited_ignore_rules(directory=directory, args=args)
+    return rules
+
+
+# How many directory scans each --scan-workers thread may do ahead of the
+# directory being used.
+SCAN_LOOKAHEAD = 64
+
+
+def walk_directories_parallel(*, args: argparse.Namespace) -> Iterator[os.DirEntry]:
+    """Walk all the directories in args.directories using several threads
+
+    Every directory is scanned by a pool of args.scan_workers threads.  A
+    thread which finds subdirectories submits their scans right away, up to
+    SCAN_LOOKAHEAD scans per thread ahead of the directory being used, so
+    deep trees keep all the threads busy.  The results are used in the same
+    order as walk_directories() does, so the files are yielded in the same
+    order.
+    """
+    state = current_state()
+    if state.pending_directories is None:
+        state.pending_directories = args.directories.copy()
+    # The directories still to be used, the next one last.
+    directories = state.pending_directories
+    # The ignore rules for each pending directory.
+    ignore_rules: Dict[str, IgnoreRules] = {}
+    lookahead = args.scan_workers * SCAN_LOOKAHEAD
+    # The submitted scans which were not used yet, by directory.
+    scans: Dict[str, "concurrent.futures.Future[Optional[DirectoryScan]]"] = {}
+    lock = threading.Lock()
+    stopped = False
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.scan_workers
+    ) as executor:
+
+        # Called with the lock held.
+        def submit(*, directory: str, rules: IgnoreRules) -> None:
+            scans[directory] = executor.submit(
+                contextvars.copy_context().run,
+                scan_ahead,
+                directory=directory,
+                rules=rules,
+            )
+
+        def scan_ahead(
+            *, directory: str, rules: IgnoreRules
+        ) -> Optional[DirectoryScan]:
+            directory_scan = scan_directory(
+                directory=directory, args=args, ignore_rules=rules
+            )
+            if directory_scan is None:
+                return None
+            # The scans of the subdirectories are submitted before the result
+            # is returned, so they are never submitted twice.
+            with lock:
+                for subdirectory in directory_scan.subdirectories:
+                    if stopped or len(scans) >= lookahead:
+                        break
+                    submit(directory=subdirectory, rules=directory_scan.ignore_rules)
+            return directory_scan
+
+        try:
+            while directories:
+                if state.checkpoint is not None:
+                    state.checkpoint.save_if_due(args=args)
+                directory = directories.pop()
+                rules = pop_ignore_rules(
+                    directory=directory, ignore_rules=ignore_rules, args=args
+                )
+                with lock:
+                    if directory not in scans:
+                        submit(directory=directory, rules=rules)
+                    future = scans.pop(directory)
+                directory_scan = future.result()
+                if directory_scan is None:
+                    continue
+                current_state().stats.found_directory(directory_scan)
+                yield from directory_scan.files
+                directories.extend(reversed(directory_scan.subdirectories))
+                for subdirectory in directory_scan.subdirectories:
+                    ignore_rules[subdirectory] = directory_scan.ignore_rules
+        finally:
+            # The walk may be left early, the scans ahead are not needed then.
+            with lock:
+                stopped = True
+                for future in scans.values():
+                    future.cancel()
+    state.pending_directories = None
+
+
+class Shard(NamedTuple):
+    # 1 based, from 1 to shards
+    number: int
+    shards: int
+
+
+def parse_shard(value: str) -> Shard:
+    """Parse the I/N value of --shard"""
+    number, _, shards = value.partition("/")
+    try:
+        shard = Shard(number=int(number), shards=int(shards))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard, expected I/N: {value!r}")
+    if not 1 <= shard.number <= shard.shards:
+        raise argparse.ArgumentTypeError(
+            f"shard number must be from 1 to the number of shards: {value!r}"
         )
+    return shard
+
+
+def size_shard(*, size: int, shards: int) -> int:
+    """Return the shard which compares the files of this size
+
+    Files of different sizes are never identical, so each shard can compare
+    its sizes on its own.  The size is hashed, as the sizes of most trees are
+    crowded together at the small end and ranges would give uneven shards.
+    """
+    digest = hashlib.blake2b(size.to_bytes(8, "little"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shards + 1
+
+
+def in_shard(*, stat_info: StatLike, args: argparse.Namespace) -> bool:
+    """Determine if the file is compared by this process with --shard"""
+    if args.shard is None:
+        return True
+    return size_shard(size=stat_info.st_size, shards=args.shard.shards) == (
+        args.shard.number
+    )
+
+
+def collect_files(*, args: argparse.Namespace) -> None:
+    """Walk the directories and add every regular file to file_index
+
+    No file is opened during this phase.  Only the information returned by
+    stat() is used.  With --resume the files and the directories which are
+    still to be scanned are taken from the checkpoint, if there is one.  With
+    --shard the files of the sizes of the other shards are left out.
+    """
+    state = current_state()
+    if args.resume and state.checkpoint is not None:
+        state.checkpoint.load(args=args)
+    for dir_entry in walk_directories(args=args):
+        stat_info = StatInfo(dir_entry.stat(follow_symlinks=False))
+        # Is it a regular file?
+        if not stat.S_ISREG(stat_info.st_mode):
+            continue
+        if not in_shard(stat_info=stat_info, args=args):
+            continue
         # Bump statistics count of regular files found.
-        gStats.found_regular_file()
+        current_state().stats.found_regular_file()
         if args.verbose >= 2:
             print(f"File: {dir_entry.path}")
-        work_file_info = (dir_entry.path, stat_info)
-        work_file_info = FileInfo(filename=dir_entry.path, stat_info=stat_info)
-        if file_hash in file_hashes:
-            # We have file(s) that have the same hash as our current file.
-            # Let's go through the list of files with the same hash and see if
-            # we are already hardlinked to any of them.
-            for temp_file_info in file_hashes[file_hash]:
-                if is_already_hardlinked(st1=stat_info, st2=temp_file_info.stat_info):
-                    gStats.found_hardlink(
-                        temp_file_info.filename,
-                        dir_entry.path,
-                        temp_file_info.stat_info,
+        add_file(filename=dir_entry.path, stat_info=stat_info, args=args)
+    if state.checkpoint is not None:
+        state.checkpoint.save(args=args)
+
+
+def add_file(*, filename: str, stat_info: StatLike, args: argparse.Namespace) -> None:
+    """Add a file to inode_index, and its inode to file_index if it is new"""
+    state = current_state()
+    if state.spill_index is not None:
+        state.spill_index.add(filename=filename, stat_info=stat_info, args=args)
+        return
+    inode_key: InodeKey = (stat_info.st_dev, stat_info.st_ino)
+    if args.samename:
+        inode_key += (os.path.basename(filename),)
+    inode_group = state.inode_index.get(inode_key)
+    if inode_group is not None:
+        # Already hardlinked to a file we found, nothing else to do.
+        inode_group.filenames.append(filename)
+        return
+    inode_group = InodeGroup(filename=filename, stat_info=stat_info)
+    state.inode_index[inode_key] = inode_group
+    state.file_index.setdefault(
+        index_key(file_info=inode_group.file_info, args=args), []
+    ).append(inode_group)
+
+
+def candidate_inode_lists() -> Iterator[List[InodeGroup]]:
+    """Yield the lists of inodes in file_index which need to be compared
+
+    An inode which is the only one with its key can't be hardlinked to any
+    other inode, so it is skipped without ever being opened.
+    """
+    state = current_state()
+    if state.spill_index is not None:
+        inode_lists: Iterator[List[InodeGroup]] = state.spill_index.inode_lists()
+    else:
+        inode_lists = iter(state.file_index.values())
+    candidate_lists = skip_unique_inodes(inode_lists)
+    if state.read_order == "disk" and state.spill_index is None:
+        # Compare the lists in the order of their first inode on the disk, so
+        # the disk is read from start to end instead of seeking all over it.
+        candidate_lists = iter(
+            sorted(
+                candidate_lists,
+                key=lambda inode_groups: min(map(physical_offset, inode_groups)),
+            )
+        )
+    for inode_groups in candidate_lists:
+        current_state().stats.found_candidates(len(inode_groups))
+        yield inode_groups
+
+
+def skip_unique_inodes(
+    inode_lists: Iterator[List[InodeGroup]],
+) -> Iterator[List[InodeGroup]]:
+    """Yield the lists of inodes with more than one inode"""
+    for inode_groups in inode_lists:
+        if len(inode_groups) < 2:
+            current_state().stats.skipped_unique_file()
+            found_existing_hardlinks(inode_group=inode_groups[0])
+            current_state().finished_lists.add(id(inode_groups))
+            continue
+        yield inode_groups
+
+
+def hardlink_collected_files(*, args: argparse.Namespace) -> Iterator[LinkAction]:
+    """Go through file_index and hardlink the identical files
+
+    Yields every hardlink which was made, or which failed.
+    """
+    state = current_state()
+    for identical_files in find_collected_identical_files(args=args):
+        start_time = time.time()
+        link_actions = link_identical_files(identical_files=identical_files, args=args)
+        state.stats.hardlink_time += time.time() - start_time
+        state.finished_lists.add(id(identical_files.inode_groups))
+        if state.checkpoint is not None:
+            state.checkpoint.save_if_due(args=args)
+        yield from link_actions
+    if state.checkpoint is not None:
+        state.checkpoint.remove()
+
+
+def find_collected_identical_files(
+    *, args: argparse.Namespace
+) -> Iterator[IdenticalFiles]:
+    """Go through file_index and yield the identical files in each list"""
+    if args.compare_workers > 1:
+        yield from find_collected_identical_files_parallel(args=args)
+        return
+    for inode_groups in candidate_inode_lists():
+        yield find_identical_files(inode_groups=inode_groups, args=args)
+
+
+def find_collected_identical_files_parallel(
+    *, args: argparse.Namespace
+) -> Iterator[IdenticalFiles]:
+    """Go through file_index using several threads to compare the files
+
+    The lists of files are compared by a pool of args.compare_workers
+    threads.  The results are yielded to the calling thread, which does all
+    the hardlinking, in the same order as find_collected_identical_files().
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.compare_workers
+    ) as executor:
+        # Limit how many results are waiting to be hardlinked.
+        max_pending = args.compare_workers * 4
+        pending: Deque["concurrent.futures.Future[IdenticalFiles]"] = (
+            collections.deque()
+        )
+        for inode_groups in candidate_inode_lists():
+            # The workers use the state of the scan which submitted the work.
+            context = contextvars.copy_context()
+            pending.append(
+                executor.submit(
+                    context.run,
+                    find_identical_files,
+                    inode_groups=inode_groups,
+                    args=args,
+                )
+            )
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class CachedDigests(NamedTuple):
+    sample_digest: bytes
+    full_digest: Optional[bytes]
+
+
+class DigestCache(object):
+    """A cache of the digests of files, kept in an SQLite database.
+
+    The digests are stored by the device and inode of a file.  They are only
+    used while the size and modification time of the inode are the same as
+    when the digests were stored.  Not the change time, which hardlinking the
+    inode changes without changing its contents.
+    """
+
+    # How many changes are made before they are committed to the database.
+    COMMIT_INTERVAL = 10000
+
+    def __init__(self, filename: str) -> None:
+        # The cache can be used by several threads when comparing files, so
+        # all use of the connection is guarded by a lock.
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            " st_dev INTEGER NOT NULL,"
+            " st_ino INTEGER NOT NULL,"
+            " st_size INTEGER NOT NULL,"
+            " st_mtime_ns INTEGER NOT NULL,"
+            " sample_digest BLOB NOT NULL,"
+            " full_digest BLOB,"
+            " last_seen REAL NOT NULL,"
+            " PRIMARY KEY (st_dev, st_ino))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS digests_last_seen ON digests (last_seen)"
+        )
+        self.start_time = time.time()
+        self.pending_changes = 0
+        # The inodes found in the cache, whose last_seen time needs updating.
+        self.seen: List[Tuple[int, int]] = []
+
+    def lookup(self, stat_info: StatLike) -> Optional[CachedDigests]:
+        with self.lock:
+            return self._lookup(stat_info)
+
+    def _lookup(self, stat_info: StatLike) -> Optional[CachedDigests]:
+        row = self.connection.execute(
+            "SELECT st_size, st_mtime_ns, sample_digest, full_digest"
+            " FROM digests WHERE st_dev = ? AND st_ino = ?",
+            (stat_info.st_dev, stat_info.st_ino),
+        ).fetchone()
+        if row is None:
+            return None
+        if row[:2] != (stat_info.st_size, stat_info.st_mtime_ns):
+            # The inode has changed since its digests were stored.
+            return None
+        self.seen.append((stat_info.st_dev, stat_info.st_ino))
+        if len(self.seen) >= self.COMMIT_INTERVAL:
+            self.commit()
+        return CachedDigests(sample_digest=row[2], full_digest=row[3])
+
+    def store(
+        self,
+        stat_info: StatLike,
+        *,
+        sample_digest: Optional[bytes],
+        full_digest: Optional[bytes] = None,
+    ) -> None:
+        if sample_digest is None:
+            return
+        with self.lock:
+            self._store(stat_info, sample_digest=sample_digest, full_digest=full_digest)
+
+    def _store(
+        self,
+        stat_info: StatLike,
+        *,
+        sample_digest: bytes,
+        full_digest: Optional[bytes],
+    ) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                stat_info.st_dev,
+                stat_info.st_ino,
+                stat_info.st_size,
+                stat_info.st_mtime_ns,
+                sample_digest,
+                full_digest,
+                self.start_time,
+            ),
+        )
+        self.pending_changes = self.pending_changes + 1
+        if self.pending_changes >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self) -> None:
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE digests SET last_seen = ? WHERE st_dev = ? AND st_ino = ?",
+                ((self.start_time, dev, ino) for dev, ino in self.seen),
+            )
+            self.seen = []
+            self.connection.commit()
+            self.pending_changes = 0
+
+    def prune(
+        self, *, max_age: Optional[float] = None, max_entries: Optional[int] = None
+    ) -> int:
+        """Remove entries from the cache, returning how many were removed.
+
+        Entries which have not been used for max_age seconds are removed.  If
+        there are more than max_entries entries, the ones which were used
+        longest ago are removed.
+        """
+        self.commit()
+        removed = 0
+        if max_age is not None:
+            cursor = self.connection.execute(
+                "DELETE FROM digests WHERE last_seen < ?", (self.start_time - max_age,)
+            )
+            removed = removed + cursor.rowcount
+        if max_entries is not None:
+            cursor = self.connection.execute(
+                "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests"
+                " ORDER BY last_seen DESC LIMIT -1 OFFSET ?)",
+                (max_entries,),
+            )
+            removed = removed + cursor.rowcount
+        self.connection.commit()
+        return removed
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+
+# A file in a spill file: its index key, its number in the order in which the
+# files were found, its name and StatInfo.to_record() of it.
+SpillRecord = Tuple[IndexKey, int, str, List[int]]
+
+
+class SpillIndex(object):
+    """Keep the collected files in sorted files on disk instead of in memory.
+
+    The files are collected in memory until they take about `memory_limit`
+    bytes.  They are then sorted by their index key and written to a spill
+    file.  Afterwards the spill files are merged, so only the files of one
+    index key are in memory at a time.
+    """
+
+    # About how much memory a collected file takes, besides its name.
+    RECORD_SIZE = 400
+
+    def __init__(self, *, directory: str, memory_limit: int) -> None:
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.records: List[SpillRecord] = []
+        self.memory_used = 0
+        self.spill_files: List[IO[bytes]] = []
+        self.files_added = 0
+
+    def add(
+        self, *, filename: str, stat_info: StatLike, args: argparse.Namespace
+    ) -> None:
+        file_info = FileInfo(filename=filename, stat_info=stat_info)
+        self.records.append(
+            (
+                index_key(file_info=file_info, args=args),
+                self.files_added,
+                filename,
+                StatInfo.to_record(stat_info),
+            )
+        )
+        self.files_added += 1
+        self.memory_used += self.RECORD_SIZE + len(filename)
+        if self.memory_used >= self.memory_limit:
+            self.spill()
+
+    def spill(self) -> None:
+        """Write the records in memory to a new sorted spill file"""
+        self.records.sort()
+        spill_file = tempfile.TemporaryFile(
+            dir=self.directory, prefix="hardlinkpy-spill-"
+        )
+        for record in self.records:
+            marshal.dump(cast(Any, record), spill_file)
+        spill_file.seek(0)
+        self.spill_files.append(spill_file)
+        self.records = []
+        self.memory_used = 0
+        current_state().stats.wrote_spill_file()
+
+    def inode_lists(self) -> Iterator[List[InodeGroup]]:
+        """Yield the inodes of each index key, in the order of the keys
+
+        The inodes of a key are in the order in which they were found.
+        """
+        self.records.sort()
+        merged_records = heapq.merge(
+            *[read_spill_file(spill_file) for spill_file in self.spill_files],
+            self.records,
+        )
+        for _, records in itertools.groupby(merged_records, key=lambda r: r[0]):
+            inode_groups: Dict[Tuple[int, int], InodeGroup] = {}
+            for _, _, filename, stat_record in records:
+                stat_info = StatInfo.from_record(stat_record)
+                inode_key = (stat_info.st_dev, stat_info.st_ino)
+                inode_group = inode_groups.get(inode_key)
+                if inode_group is None:
+                    inode_groups[inode_key] = InodeGroup(
+                        filename=filename, stat_info=stat_info
                     )
-                    break
-            else:
-                # We did not find this file as hardlinked to any other file
-                # yet.  So now lets see if our file should be hardlinked to any
-                # of the other files with the same hash.
-                for temp_file_info in file_hashes[file_hash]:
-                    if are_files_hardlinkable(
-                        file_info_1=work_file_info,
-                        # file_info_2=(temp_filename, temp_stat_info),
-                        file_info_2=temp_file_info,
-                        args=args,
-                    ):
-                        hardlink_files(
-                            sourcefile=temp_file_info.filename,
-                            destfile=dir_entry.path,
-                            stat_info=temp_file_info.stat_info,
-                            args=args,
-                        )
-                        break
                 else:
-                    # The file should NOT be hardlinked to any of the other
-                    # files with the same hash.  So we will add it to the list
-                    # of files.
-                    file_hashes[file_hash].append(work_file_info)
-        else:
-            # There weren't any other files with the same hash value so we will
-            # create a new entry and store our file.
-            file_hashes[file_hash] = [work_file_info]
+                    inode_group.filenames.append(filename)
+            yield list(inode_groups.values())
+        self.records = []
+
+    def close(self) -> None:
+        for spill_file in self.spill_files:
+            spill_file.close()
+        self.spill_files = []
+
+
+def read_spill_file(spill_file: IO[bytes]) -> Iterator[SpillRecord]:
+    while True:
+        try:
+            yield marshal.load(spill_file)
+        except EOFError:
+            return
+
+
+class Checkpoint(object):
+    """Save the progress of a run to a file, so it can be resumed.
+
+    The file holds the directories which are still to be scanned, the inodes
+    which still have to be compared and the statistics.  During the scan it
+    is saved between directories, and while hardlinking between lists of
+    candidates, at most every `interval` seconds.
+    """
+
+    VERSION = 1
+
+    # The options which change how files are grouped, a checkpoint can only be
+    # resumed with the same ones.
+    OPTIONS = (
+        "directories",
+        "content_only",
+        "notimestamp",
+        "samename",
+        "min_size",
+        "shard",
+    )
+
+    def __init__(self, filename: str, *, interval: float) -> None:
+        self.filename = filename
+        self.interval = interval
+        self.last_save = time.time()
+
+    def save_if_due(self, *, args: argparse.Namespace) -> None:
+        if time.time() - self.last_save >= self.interval:
+            self.save(args=args)
+
+    def save(self, *, args: argparse.Namespace) -> None:
+        """Save the state of the running scan, replacing the file atomically"""
+        state = current_state()
+        inodes = [
+            [inode_group.filenames, StatInfo.to_record(inode_group.stat_info)]
+            for inode_groups in state.file_index.values()
+            if id(inode_groups) not in state.finished_lists
+            for inode_group in inode_groups
+        ]
+        checkpoint = {
+            "version": self.VERSION,
+            "options": self.options(args=args),
+            # Checkpoints are only saved while scanning or after the scan.
+            "pending_directories": state.pending_directories or [],
+            "inodes": inodes,
+            "stats": state.stats.counters(),
+        }
+        temp_name = self.filename + ".$$$___cleanit___$$$"
+        try:
+            with open(temp_name, "w") as out_file:
+                json.dump(checkpoint, out_file)
+            os.replace(temp_name, self.filename)
+        except OSError as exc:
+            print(f"Error saving checkpoint to: {self.filename}")
+            print("When an exception occurred: {}".format(exc))
+        self.last_save = time.time()
+
+    def load(self, *, args: argparse.Namespace) -> None:
+        """Continue from the saved state, if the file exists
+
+        Every file in the checkpoint is checked with lstat().  Files which were
+        changed or replaced are added with their current information, and
+        files which were removed are left out.
+        """
+        try:
+            with open(self.filename) as in_file:
+                checkpoint = json.load(in_file)
+        except FileNotFoundError:
+            return
+        if checkpoint.get("version") != self.VERSION:
+            raise ValueError(f"Unsupported checkpoint version in: {self.filename}")
+        if checkpoint["options"] != self.options(args=args):
+            raise ValueError(
+                f"The checkpoint in {self.filename} was saved with other options"
+            )
+
+        state = current_state()
+        state.stats.restore_counters(checkpoint["stats"])
+        state.pending_directories = checkpoint["pending_directories"]
+        for filenames, record in checkpoint["inodes"]:
+            saved_stat_info = StatInfo.from_record(record)
+            for filename in filenames:
+                try:
+                    stat_info = StatInfo(os.lstat(filename))
+                except OSError:
+                    state.stats.changed_since_checkpoint()
+                    continue
+                if not is_unchanged(stat_info=stat_info, saved=saved_stat_info):
+                    state.stats.changed_since_checkpoint()
+                    if not stat.S_ISREG(stat_info.st_mode):
+                        continue
+                    if stat_info.st_size < args.min_size:
+                        continue
+                    if not in_shard(stat_info=stat_info, args=args):
+                        continue
+                add_file(filename=filename, stat_info=stat_info, args=args)
+
+    @classmethod
+    def options(cls, *, args: argparse.Namespace) -> Dict[str, Any]:
+        """Return the OPTIONS as they are saved, with tuples turned into lists"""
+        options = {name: getattr(args, name) for name in cls.OPTIONS}
+        return cast(Dict[str, Any], json.loads(json.dumps(options)))
+
+    def remove(self) -> None:
+        """Remove the file once the run has finished"""
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+def is_unchanged(*, stat_info: StatLike, saved: StatLike) -> bool:
+    """Determine if a file is still the one saved in a checkpoint"""
+    return (
+        stat_info.st_dev == saved.st_dev
+        and stat_info.st_ino == saved.st_ino
+        and stat_info.st_mode == saved.st_mode
+        and stat_info.st_uid == saved.st_uid
+        and stat_info.st_gid == saved.st_gid
+        and stat_info.st_size == saved.st_size
+        and stat_info.st_mtime_ns == saved.st_mtime_ns
+    )
 
 
 class cStatistics(object):
@@ -369,21 +2242,149 @@ class cStatistics(object):
             Tuple[str, str]
         ] = []  # list of files hardlinked this run
         self.starttime = time.time()  # track how long it takes
+        self.scan_time = 0.0  # how long it took to walk the directories
+        self.link_time = 0.0  # how long it took to compare and hardlink
+        self.unique_files = 0  # files skipped as nothing else could match
+        self.sample_rejections = 0  # comparisons avoided by the sample digest
+        self.content_rejections = 0  # full comparisons which found a difference
+        self.cached_digests = 0  # digests found in the digest cache
+        self.bytes_read = 0  # bytes read from files to compare them
+        # Bytes the process had read from storage when it started, if known
+        self.storage_bytes_at_start = storage_bytes_read()
+        # Bytes read from storage by device worker processes, which the
+        # storage_bytes_read() of this process leaves out.
+        self.worker_storage_bytes = 0
+        # inodes with files relinked to another inode, their blocks are only
+        # freed if all of their files were relinked
+        self.inodes_merged = 0
+        self.stat_calls = 0  # stat() calls made while scanning directories
+        self.stat_time = 0.0  # time spent in stat(), part of the scan_time
+        self.hardlink_time = 0.0  # time spent hardlinking, part of the link_time
+        self.files_opened = 0  # files opened to compare them
+        self.syscalls = 0  # system calls made for directories and files
+        # How many lists of candidates had up to each number of inodes
+        self.candidate_buckets: Dict[float, int] = {}
+        self.candidates = 0  # inodes in all the lists of candidates
+        self.changed_files = 0  # files changed since the checkpoint resumed
+        self.spill_files = 0  # spill files written with --spill-dir
+        self.blocks_freed = 0  # 512 byte blocks freed by merging inodes
+        # Guards the counters which are updated while comparing files, as that
+        # can be done by several threads.
+        self.lock = threading.Lock()
         self.previouslyhardlinked: Dict[
-            str, Tuple[os.stat_result, List[str]]
+            str, Tuple[StatLike, List[str]]
         ] = {}  # list of files hardlinked previously
 
-    def found_directory(self) -> None:
+    def counters(self) -> Dict[str, Union[int, float]]:
+        """Return the counters, for saving them in a checkpoint"""
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if isinstance(value, (int, float))
+            and name not in ("starttime", "storage_bytes_at_start")
+        }
+
+    def merge(self, other: "cStatistics") -> None:
+        """Add the statistics of a device worker process"""
+        for name, value in other.counters().items():
+            setattr(self, name, getattr(self, name) + value)
+        for bound, count in other.candidate_buckets.items():
+            self.candidate_buckets[bound] = self.candidate_buckets.get(bound, 0) + count
+        self.hardlinkstats.extend(other.hardlinkstats)
+        self.previouslyhardlinked.update(other.previouslyhardlinked)
+
+    def fit_times(self, elapsed: float) -> None:
+        """Scale the times down to the `elapsed` wall-clock time
+
+        The times of processes which ran at the same time add up to more than
+        the time they took.  They are scaled so the scan and the link time add
+        up to `elapsed`, keeping their share of the time.
+        """
+        total = self.scan_time + self.link_time
+        if total <= elapsed:
+            return
+        scale = elapsed / total
+        self.scan_time = self.scan_time * scale
+        self.link_time = self.link_time * scale
+        self.stat_time = self.stat_time * scale
+        self.hardlink_time = self.hardlink_time * scale
+
+    # The lock can't be pickled, which device worker processes need to send
+    # their statistics.
+    def __getstate__(self) -> Dict[str, Any]:
+        state = vars(self).copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        vars(self).update(state)
+        self.lock = threading.Lock()
+
+    def restore_counters(self, counters: Dict[str, Union[int, float]]) -> None:
+        for name, value in counters.items():
+            if hasattr(self, name):
+                setattr(self, name, value)
+
+    def wrote_spill_file(self) -> None:
+        self.spill_files = self.spill_files + 1
+
+    def changed_since_checkpoint(self) -> None:
+        self.changed_files = self.changed_files + 1
+
+    def found_directory(self, directory_scan: "DirectoryScan") -> None:
         self.dircount = self.dircount + 1
+        # Opening, reading and closing the directory, and the stat() calls.
+        self.syscalls = self.syscalls + 3 + directory_scan.stat_calls
+        self.stat_calls = self.stat_calls + directory_scan.stat_calls
+        self.stat_time = self.stat_time + directory_scan.stat_time
 
     def found_regular_file(self) -> None:
         self.regularfiles = self.regularfiles + 1
 
-    def did_comparison(self) -> None:
-        self.comparisons = self.comparisons + 1
+    def skipped_unique_file(self) -> None:
+        self.unique_files = self.unique_files + 1
+
+    def rejected_by_sample(self) -> None:
+        with self.lock:
+            self.sample_rejections = self.sample_rejections + 1
+
+    def rejected_by_content(self) -> None:
+        with self.lock:
+            self.content_rejections = self.content_rejections + 1
+
+    def found_cached_digest(self) -> None:
+        with self.lock:
+            self.cached_digests = self.cached_digests + 1
+
+    def found_candidates(self, count: int) -> None:
+        bucket = next(
+            (bound for bound in CANDIDATE_BUCKETS if count <= bound), float("inf")
+        )
+        with self.lock:
+            self.candidate_buckets[bucket] = self.candidate_buckets.get(bucket, 0) + 1
+            self.candidates = self.candidates + count
+
+    def opened_file(self) -> None:
+        with self.lock:
+            self.files_opened = self.files_opened + 1
+            # Opening and closing the file
+            self.syscalls = self.syscalls + 2
+
+    def did_read(self, count: int, *, reads: int = 1) -> None:
+        with self.lock:
+            self.bytes_read = self.bytes_read + count
+            self.syscalls = self.syscalls + reads
+
+    def did_syscalls(self, count: int) -> None:
+        with self.lock:
+            self.syscalls = self.syscalls + count
+
+    def did_comparison(self, count: int = 1) -> None:
+        with self.lock:
+            self.comparisons = self.comparisons + count
 
     def found_hardlink(
-        self, sourcefile: str, destfile: str, stat_info: os.stat_result
+        self, sourcefile: str, destfile: str, stat_info: StatLike
     ) -> None:
         filesize = stat_info.st_size
         self.hardlinked_previously = self.hardlinked_previously + 1
@@ -393,14 +2394,81 @@ class cStatistics(object):
         else:
             self.previouslyhardlinked[sourcefile][1].append(destfile)
 
-    def did_hardlink(
-        self, sourcefile: str, destfile: str, stat_info: os.stat_result
-    ) -> None:
+    def merged_inode(self, *, blocks_freed: int) -> None:
+        self.inodes_merged = self.inodes_merged + 1
+        self.blocks_freed = self.blocks_freed + blocks_freed
+
+    def did_hardlink(self, sourcefile: str, destfile: str, stat_info: StatLike) -> None:
         filesize = stat_info.st_size
         self.hardlinked_thisrun = self.hardlinked_thisrun + 1
         self.bytes_saved_thisrun = self.bytes_saved_thisrun + filesize
         self.hardlinkstats.append((sourcefile, destfile))
 
+    def metrics(self, *, completed: bool) -> Dict[str, object]:
+        """Return the statistics as numbers, for writing them as JSON"""
+        with self.lock:
+            candidate_buckets = dict(self.candidate_buckets)
+        # Like Prometheus, each bucket counts the lists of candidates with up
+        # to that many inodes.
+        cumulative_buckets: Dict[str, int] = {}
+        lists = 0
+        for bound in CANDIDATE_BUCKETS + (float("inf"),):
+            lists = lists + candidate_buckets.get(bound, 0)
+            label = "+Inf" if bound == float("inf") else str(bound)
+            cumulative_buckets[label] = lists
+        disk_bytes, cache_bytes = self.disk_and_cache_bytes()
+        return {
+            "completed": completed,
+            "timestamp_seconds": time.time(),
+            "run_seconds": time.time() - self.starttime,
+            "phase_seconds": {
+                # With several scan workers the stat() time is summed over the
+                # threads, so it can be more than the scan time.
+                "walk": max(self.scan_time - self.stat_time, 0.0),
+                "stat": self.stat_time,
+                "compare": max(self.link_time - self.hardlink_time, 0.0),
+                "link": self.hardlink_time,
+            },
+            "directories": self.dircount,
+            "regular_files": self.regularfiles,
+            "unique_files": self.unique_files,
+            "sample_rejections": self.sample_rejections,
+            "comparisons": self.comparisons,
+            "content_rejections": self.content_rejections,
+            "cached_digests": self.cached_digests,
+            "hardlinked": self.hardlinked_thisrun,
+            "hardlinked_previously": self.hardlinked_previously,
+            "bytes_saved": self.bytes_saved_thisrun,
+            "bytes_saved_previously": self.bytes_saved_previously,
+            "inodes_merged": self.inodes_merged,
+            "blocks_freed": self.blocks_freed,
+            "bytes_read": self.bytes_read,
+            "bytes_read_from_disk": disk_bytes,
+            "bytes_read_from_cache": cache_bytes,
+            "files_opened": self.files_opened,
+            "syscalls": self.syscalls,
+            "candidates_per_bucket": {
+                "buckets": cumulative_buckets,
+                "count": lists,
+                "sum": self.candidates,
+            },
+            "peak_rss_bytes": peak_rss(),
+        }
+
+    def disk_and_cache_bytes(self) -> Tuple[Optional[int], Optional[int]]:
+        """How many of the bytes read came from storage and from the page cache
+
+        This can only be told on systems with /proc/self/io, which counts all
+        of the reads of the process, including those of the digest cache.
+        """
+        storage_bytes = storage_bytes_read()
+        if storage_bytes is None or self.storage_bytes_at_start is None:
+            return None, None
+        disk_bytes = (
+            storage_bytes - self.storage_bytes_at_start + self.worker_storage_bytes
+        )
+        return disk_bytes, max(self.bytes_read - disk_bytes, 0)
+
     def print_stats(self, args: argparse.Namespace) -> None:
         if args.show_progress:
             print("")
@@ -431,30 +2499,778 @@ class cStatistics(object):
             print()
         print(f"Directories           : {self.dircount:,}")
         print(f"Regular files         : {self.regularfiles:,}")
+        print(f"Unique files skipped  : {self.unique_files:,}")
+        print(f"Rejected by sample    : {self.sample_rejections:,}")
         print(f"Comparisons           : {self.comparisons:,}")
+        print(f"Rejected by content   : {self.content_rejections:,}")
+        if args.digest_cache:
+            print(f"Digests from cache    : {self.cached_digests:,}")
+        if args.resume:
+            print(f"Changed since resume  : {self.changed_files:,}")
+        if args.spill_dir:
+            print(f"Spill files           : {self.spill_files:,}")
         print(f"Hardlinked this run   : {self.hardlinked_thisrun:,}")
         print(
             "Total hardlinks       : {:,}".format(
                 self.hardlinked_previously + self.hardlinked_thisrun
             )
         )
-        print(
-            "Bytes saved this run  : {:,} ({})".format(
-                self.bytes_saved_thisrun, humanize_number(self.bytes_saved_thisrun)
+        print(
+            "Bytes saved this run  : {:,} ({})".format(
+                self.bytes_saved_thisrun, humanize_number(self.bytes_saved_thisrun)
+            )
+        )
+        totalbytes = self.bytes_saved_thisrun + self.bytes_saved_previously
+        print(
+            "Total bytes saved     : {:,} ({})".format(
+                totalbytes, humanize_number(totalbytes)
+            )
+        )
+        print(f"Inodes merged         : {self.inodes_merged:,}")
+        print(
+            "Blocks freed          : {:,} ({})".format(
+                self.blocks_freed, humanize_number(self.blocks_freed * 512)
+            )
+        )
+        print(
+            "Scan time             : {:,.2f} seconds ({})".format(
+                self.scan_time, humanize_time(self.scan_time)
+            )
+        )
+        print(
+            "Compare/link time     : {:,.2f} seconds ({})".format(
+                self.link_time, humanize_time(self.link_time)
+            )
+        )
+        print(f"Files opened          : {self.files_opened:,}")
+        print(
+            "Bytes read            : {:,} ({})".format(
+                self.bytes_read, humanize_number(self.bytes_read)
+            )
+        )
+        disk_bytes, cache_bytes = self.disk_and_cache_bytes()
+        if disk_bytes is not None and cache_bytes is not None:
+            print(
+                "Read from disk        : {:,} ({})".format(
+                    disk_bytes, humanize_number(disk_bytes)
+                )
+            )
+            print(
+                "Read from cache       : {:,} ({})".format(
+                    cache_bytes, humanize_number(cache_bytes)
+                )
+            )
+        if self.link_time:
+            throughput = int(self.bytes_read / self.link_time)
+            print(f"Read throughput       : {humanize_number(throughput)}/second")
+        run_time = time.time() - self.starttime
+        print(
+            "Total run time        : {:,.2f} seconds ({})".format(
+                run_time, humanize_time(run_time)
+            )
+        )
+
+
+def storage_bytes_read() -> Optional[int]:
+    """Return how many bytes the process has read from storage, if known"""
+    try:
+        with open("/proc/self/io") as in_file:
+            for line in in_file:
+                name, _, value = line.partition(":")
+                if name == "read_bytes":
+                    return int(value)
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss() -> Optional[int]:
+    """Return the peak resident set size of the process in bytes, if known"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def format_prometheus_metrics(metrics: Dict[str, object]) -> str:
+    """Format metrics from cStatistics.metrics() for the node exporter"""
+    lines = []
+    for name, value in metrics.items():
+        metric = f"hardlinkpy_{name}"
+        if name == "phase_seconds":
+            assert isinstance(value, dict)
+            lines.append(f"# TYPE {metric} gauge")
+            for phase, seconds in value.items():
+                lines.append(f'{metric}{{phase="{phase}"}} {seconds}')
+        elif name == "candidates_per_bucket":
+            assert isinstance(value, dict)
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, count in value["buckets"].items():
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{metric}_sum {value['sum']}")
+            lines.append(f"{metric}_count {value['count']}")
+        elif value is not None:
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {int(value) if isinstance(value, bool) else value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(
+    *, stats: cStatistics, args: argparse.Namespace, completed: bool
+) -> None:
+    """Write the metrics to the files given by --metrics-json/--metrics-prom
+
+    Each file is replaced atomically, so a reader never sees a partial file.
+    """
+    metrics = stats.metrics(completed=completed)
+    outputs = []
+    if args.metrics_json:
+        outputs.append((args.metrics_json, json.dumps(metrics, indent=2) + "\n"))
+    if args.metrics_prom:
+        outputs.append((args.metrics_prom, format_prometheus_metrics(metrics)))
+    for filename, text in outputs:
+        temp_name = filename + ".$$$___cleanit___$$$"
+        try:
+            with open(temp_name, "w") as out_file:
+                out_file.write(text)
+            os.replace(temp_name, filename)
+        except OSError as exc:
+            print(f"Error writing metrics to: {filename}")
+            print("When an exception occurred: {}".format(exc))
+
+
+class MetricsReporter(object):
+    """Write the metrics of a run while it is running, and when it is done.
+
+    While running the metrics are written every args.metrics_interval seconds
+    by a background thread, if an interval was given.
+    """
+
+    def __init__(self, *, stats: cStatistics, args: argparse.Namespace) -> None:
+        self.stats = stats
+        self.args = args
+        self.enabled = bool(args.metrics_json or args.metrics_prom)
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "MetricsReporter":
+        if self.enabled and self.args.metrics_interval:
+            self.thread = threading.Thread(target=self.report, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type: Optional[type], *exc_info: object) -> None:
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+        if self.enabled:
+            write_metrics(stats=self.stats, args=self.args, completed=exc_type is None)
+
+    def report(self) -> None:
+        while not self.stopped.wait(self.args.metrics_interval):
+            write_metrics(stats=self.stats, args=self.args, completed=False)
+
+
+class Profiler(object):
+    """Profile a scan with cProfile and time the functions on the hot path.
+
+    The functions decorated with @timed are timed while the Timers of the
+    scan are set, so other scans running at the same time are not timed.
+    The cProfile data only covers the thread which runs main().
+    """
+
+    def __init__(self, *, state: "ScanState", args: argparse.Namespace) -> None:
+        self.state = state
+        self.args = args
+        self.profile: Optional[cProfile.Profile] = None
+
+    def __enter__(self) -> "Profiler":
+        if self.args.profile:
+            self.state.timers = Timers()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        if self.profile is None:
+            return
+        self.profile.disable()
+        try:
+            self.profile.dump_stats(self.args.profile)
+        except OSError as exc:
+            print(f"Error writing profile to: {self.args.profile}")
+            print("When an exception occurred: {}".format(exc))
+        self.print_timers()
+        self.state.timers = None
+
+    def print_timers(self) -> None:
+        assert self.state.timers is not None
+        timers = dict(self.state.timers.timers)
+        stats = self.state.stats
+        # stat() is a method of os.DirEntry, so it is timed by scan_directory()
+        timers["stat"] = [stats.stat_calls, stats.stat_time]
+        print(f"Profile written to: {self.args.profile}")
+        print(f"{'Timer':<28} {'Calls':>12} {'Seconds':>12} {'ms/call':>10}")
+        for name, (calls, seconds) in sorted(
+            timers.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            per_call = seconds / calls * 1000 if calls else 0.0
+            print(f"{name:<28} {int(calls):>12,} {seconds:>12.3f} {per_call:>10.3f}")
+
+
+# The chunk sizes measured by --calibrate, from 64 KiB to 16 MiB.
+CALIBRATION_SIZES = [FIRST_CHUNK_SIZE << power for power in range(9)]
+
+# How many bytes of the largest files found are read at each size.
+CALIBRATION_BYTES = 256 * 1024 ** 2
+
+
+# The --tuning-file which main() uses when none is given.
+def default_tuning_file() -> str:
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_home, "hardlinkpy", "tuning.json")
+
+
+def mount_point(path: str) -> str:
+    """Return the mount point of the file system which a path is on"""
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def read_tuning_file(filename: str) -> Dict[str, Any]:
+    """Read the settings saved by --calibrate, by mount point
+
+    Raises ValueError if the file is not a JSON object.
+    """
+    try:
+        with open(filename) as in_file:
+            tuning = json.load(in_file)
+    except FileNotFoundError:
+        return {}
+    if not isinstance(tuning, dict):
+        raise ValueError("The tuning file is not a JSON object")
+    return tuning
+
+
+def tuned_chunk_size(*, filename: str, directory: str) -> Optional[int]:
+    """Return the --max-chunk-size calibrated for the file system of a directory"""
+    try:
+        tuning = read_tuning_file(filename)
+    except (OSError, ValueError) as exc:
+        print(f"Error reading tuning file: {filename}")
+        print("When an exception occurred: {}".format(exc))
+        return None
+    directory = mount_point(directory)
+    settings = tuning.get(directory)
+    if settings is None:
+        return None
+    max_chunk_size = (
+        settings.get("max_chunk_size") if isinstance(settings, dict) else None
+    )
+    # Checked like --max-chunk-size, as O_DIRECT reads have to be a multiple of
+    # the page size.
+    if type(max_chunk_size) is not int or max_chunk_size < 4 or max_chunk_size % 4:
+        print(f"Error: Invalid max_chunk_size for {directory} in: {filename}")
+        print(f"Using the default --max-chunk-size of {BUFFER_SIZE // 1024}")
+        return None
+    return max_chunk_size
+
+
+def list_mount_points() -> List[str]:
+    """Return the mount points of the system, if they can be listed"""
+    try:
+        with open("/proc/self/mountinfo") as in_file:
+            lines = in_file.readlines()
+    except OSError:
+        return []
+    # Spaces and some other characters are escaped as octal numbers.
+    return [
+        re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), path)
+        for path in (line.split()[4] for line in lines)
+    ]
+
+
+def device_directories(*, args: argparse.Namespace) -> Dict[int, List[str]]:
+    """Split the directories up by the device they are on, for --device-workers
+
+    The mount points of other devices below the directories are added to the
+    directories of their device.  Without a list of the mount points, the
+    files on them are left to the device of the directory they are mounted
+    in.
+    """
+    directories: Dict[int, List[str]] = {}
+    for directory in args.directories:
+        directories.setdefault(os.lstat(directory).st_dev, []).append(directory)
+    for path in list_mount_points():
+        top_directory = next(
+            (top for top in args.directories if path.startswith(top + "/")), None
+        )
+        if top_directory is None:
+            continue
+        try:
+            device = os.lstat(path).st_dev
+            parent_device = os.lstat(os.path.dirname(path)).st_dev
+        except OSError:
+            continue
+        # A bind mount of the same device is scanned with its parent.
+        if device != parent_device and is_walked(
+            path=path, top_directory=top_directory, args=args
+        ):
+            directories.setdefault(device, []).append(path)
+    return directories
+
+
+def is_walked(*, path: str, top_directory: str, args: argparse.Namespace) -> bool:
+    """Determine if walking top_directory reaches the directory `path`"""
+    while path != top_directory:
+        ignore_rules = inherited_ignore_rules(directory=path, args=args)
+        if is_excluded(path=path, is_dir=True, args=args, ignore_rules=ignore_rules):
+            return False
+        path = os.path.dirname(path)
+    return True
+
+
+def link_devices(*, stats: cStatistics, args: argparse.Namespace) -> None:
+    """Hardlink the files of each device in its own process
+
+    Each process walks the directories of its device, skipping the mount
+    points of the other devices, and has its own indexes.  The statistics of
+    the processes are merged into `stats` as they finish.
+    """
+    directories = device_directories(args=args)
+    all_directories = {
+        directory for paths in directories.values() for directory in paths
+    }
+    worker_args_list = []
+    for paths in directories.values():
+        worker_args = argparse.Namespace(**vars(args))
+        worker_args.directories = paths
+        worker_args.pruned_directories = frozenset(all_directories - set(paths))
+        worker_args.device_workers = 0
+        # Only the merged statistics are reported.
+        worker_args.metrics_json = worker_args.metrics_prom = None
+        worker_args.profile = None
+        worker_args_list.append(worker_args)
+    start_time = time.time()
+    # The metrics and the scan threads of this process may be running, which
+    # a forked process would inherit in the middle of whatever they do.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.device_workers, mp_context=worker_context()
+    ) as executor:
+        for device_stats in executor.map(link_device, worker_args_list):
+            stats.merge(device_stats)
+    stats.fit_times(time.time() - start_time)
+
+
+def worker_context() -> multiprocessing.context.BaseContext:
+    """Return the context which starts processes without forking this one"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def link_device(args: argparse.Namespace) -> cStatistics:
+    """Hardlink the files of one device, in a device worker process"""
+    with Hardlinker(args=args) as hardlinker:
+        hardlinker.collect()
+        for _ in hardlinker.link_actions():
+            pass
+    stats = hardlinker.stats
+    disk_bytes, _ = stats.disk_and_cache_bytes()
+    stats.worker_storage_bytes = disk_bytes or 0
+    return stats
+
+
+class Manifest(NamedTuple):
+    filename: str
+    shard: Optional[Shard]
+    # The Checkpoint.OPTIONS the shard was run with, other than the shard.
+    options: Dict[str, Any]
+    dry_run: bool
+    # How long the shard ran.
+    run_seconds: float
+    stats: "cStatistics"
+
+
+MANIFEST_VERSION = 1
+
+
+def write_manifest(*, stats: "cStatistics", args: argparse.Namespace) -> None:
+    """Write the link actions and the statistics of the run to --manifest
+
+    The manifests of the shards of a run are combined by merge_main().  The
+    file is replaced atomically, so a reader never sees a partial file.
+    """
+    counters = stats.counters()
+    # The storage read by this process, as its storage_bytes_at_start is
+    # meaningless in the process merging the manifests.
+    disk_bytes, _ = stats.disk_and_cache_bytes()
+    counters["worker_storage_bytes"] = disk_bytes or 0
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "shard": args.shard,
+        "options": Checkpoint.options(args=args),
+        "dry_run": args.dry_run,
+        "run_seconds": time.time() - stats.starttime,
+        "link_actions": stats.hardlinkstats,
+        "previously_hardlinked": [
+            [sourcefile, StatInfo.to_record(stat_info), filenames]
+            for sourcefile, (stat_info, filenames) in stats.previouslyhardlinked.items()
+        ],
+        # JSON has no infinity, the last bucket is saved as null.
+        "candidate_buckets": [
+            [None if bound == float("inf") else bound, count]
+            for bound, count in stats.candidate_buckets.items()
+        ],
+        "stats": counters,
+    }
+    temp_name = args.manifest + ".$$$___cleanit___$$$"
+    try:
+        with open(temp_name, "w") as out_file:
+            json.dump(manifest, out_file)
+        os.replace(temp_name, args.manifest)
+    except OSError as exc:
+        print(f"Error writing manifest to: {args.manifest}")
+        print("When an exception occurred: {}".format(exc))
+
+
+def read_manifest(filename: str) -> Manifest:
+    """Read a manifest written with --manifest"""
+    with open(filename) as in_file:
+        manifest = json.load(in_file)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version in: {filename}")
+    stats = cStatistics()
+    stats.restore_counters(manifest["stats"])
+    stats.hardlinkstats = [
+        (sourcefile, destfile) for sourcefile, destfile in manifest["link_actions"]
+    ]
+    for sourcefile, record, filenames in manifest["previously_hardlinked"]:
+        stats.previouslyhardlinked[sourcefile] = (
+            StatInfo.from_record(record),
+            filenames,
+        )
+    for bound, count in manifest["candidate_buckets"]:
+        stats.candidate_buckets[float("inf") if bound is None else bound] = count
+    shard = manifest["shard"]
+    return Manifest(
+        filename=filename,
+        shard=None if shard is None else Shard(*shard),
+        # The shards of a run differ only in their shard.
+        options={
+            name: value
+            for name, value in manifest["options"].items()
+            if name != "shard"
+        },
+        dry_run=manifest["dry_run"],
+        run_seconds=manifest["run_seconds"],
+        stats=stats,
+    )
+
+
+def merge_manifests(manifests: List[Manifest]) -> "cStatistics":
+    """Merge the statistics of the manifests of all the shards of a run
+
+    Raises ValueError if the manifests are not those of one run, or if a
+    shard is missing.
+    """
+    first = manifests[0]
+    for manifest in manifests[1:]:
+        if manifest.options != first.options:
+            raise ValueError(
+                f"{manifest.filename} was written with other options than "
+                f"{first.filename}"
             )
-        )
-        totalbytes = self.bytes_saved_thisrun + self.bytes_saved_previously
-        print(
-            "Total bytes saved     : {:,} ({})".format(
-                totalbytes, humanize_number(totalbytes)
+    # A run without --shard is a single shard.
+    shards = [manifest.shard or Shard(number=1, shards=1) for manifest in manifests]
+    if len({shard.shards for shard in shards}) != 1:
+        raise ValueError("The manifests are of runs with different numbers of shards")
+    numbers = [shard.number for shard in shards]
+    if len(set(numbers)) != len(numbers):
+        raise ValueError("A shard is given more than once")
+    count = shards[0].shards
+    missing = sorted(set(range(1, count + 1)) - set(numbers))
+    if missing:
+        raise ValueError(
+            "Missing the manifests of shards: {}".format(
+                ", ".join(f"{number}/{count}" for number in missing)
             )
         )
-        run_time = time.time() - self.starttime
-        print(
-            "Total run time        : {:,.2f} seconds ({})".format(
-                run_time, humanize_time(run_time)
+
+    stats = cStatistics()
+    for manifest in manifests:
+        stats.merge(manifest.stats)
+    # Every shard walks all the directories.
+    stats.dircount = max(manifest.stats.dircount for manifest in manifests)
+    # The shards run at the same time, so the run took as long as the slowest.
+    stats.starttime = time.time() - max(manifest.run_seconds for manifest in manifests)
+    return stats
+
+
+def calibration_files(*, directories: List[str]) -> List[str]:
+    """Find the largest files in the directories, up to CALIBRATION_BYTES"""
+    sizes: Dict[str, int] = {}
+    for directory in directories:
+        for dirpath, _, filenames in os.walk(directory):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    stat_result = os.lstat(filename)
+                except OSError:
+                    continue
+                if stat.S_ISREG(stat_result.st_mode):
+                    sizes[filename] = stat_result.st_size
+    files = []
+    total_size = 0
+    for filename in sorted(sizes, key=sizes.__getitem__, reverse=True):
+        if total_size >= CALIBRATION_BYTES:
+            break
+        files.append(filename)
+        total_size = total_size + sizes[filename]
+    return files
+
+
+def measure_throughput(*, filenames: List[str], size: int, direct: bool) -> float:
+    """Read the files in chunks of `size` bytes, returning the bytes per second
+
+    The files are dropped from the page cache before they are read, so the
+    storage is measured and not the memory.
+    """
+    bytes_read = 0
+    start_time = time.time()
+    # Anonymous memory maps are aligned for O_DIRECT.
+    with mmap.mmap(-1, size) as buffer:
+        for filename in filenames:
+            try:
+                with UncachedFile(filename, direct=direct) as in_file:
+                    advise(fd=in_file.fileno(), offset=0, length=0, advice="DONTNEED")
+                    while True:
+                        length = readinto_buffer(
+                            in_file=in_file, buffer=buffer, size=size
+                        )
+                        bytes_read = bytes_read + length
+                        if length < size:
+                            break
+            except OSError as exc:
+                print(f"Error reading file: {filename}")
+                print("When an exception occurred: {}".format(exc))
+    return bytes_read / max(time.time() - start_time, 1e-9)
+
+
+def calibrate(*, args: argparse.Namespace) -> int:
+    """Find the fastest --max-chunk-size for the file system and save it
+
+    The largest files in the directories are read at each of the
+    CALIBRATION_SIZES.  The fastest size is saved in the --tuning-file for
+    the mount point of the first directory, where later runs find it.
+    """
+    filenames = calibration_files(directories=args.directories)
+    if not filenames:
+        print("Error: no files found to calibrate the read size with")
+        return 1
+    throughputs = {}
+    for size in CALIBRATION_SIZES:
+        throughputs[size] = measure_throughput(
+            filenames=filenames, size=size, direct=args.cache_policy == "direct"
+        )
+        if args.verbose:
+            print(
+                f"Chunk size {humanize_number(size):>20}: "
+                f"{humanize_number(int(throughputs[size]))}/second"
             )
+    best_size = max(throughputs, key=throughputs.__getitem__)
+    directory = mount_point(args.directories[0])
+    try:
+        tuning = read_tuning_file(args.tuning_file)
+        tuning[directory] = {"max_chunk_size": best_size // 1024}
+        os.makedirs(os.path.dirname(args.tuning_file) or ".", exist_ok=True)
+        temp_name = args.tuning_file + ".$$$___cleanit___$$$"
+        with open(temp_name, "w") as out_file:
+            json.dump(tuning, out_file, indent=2)
+        os.replace(temp_name, args.tuning_file)
+    except (OSError, ValueError) as exc:
+        print(f"Error saving tuning file: {args.tuning_file}")
+        print("When an exception occurred: {}".format(exc))
+        return 1
+    if args.verbose:
+        print(
+            f"Saved --max-chunk-size {best_size // 1024} for {directory} "
+            f"in {args.tuning_file}"
         )
+    return 0
+
+
+class ScanState(object):
+    """Everything which is found and counted during one scan."""
+
+    def __init__(self) -> None:
+        self.stats = cStatistics()
+        self.digest_cache: Optional[DigestCache] = None
+        # The directories kept open to hardlink the files in them.
+        self.directory_fds = DirectoryFds()
+        # The inodes found, by their device and inode number.
+        self.inode_index: Dict[InodeKey, InodeGroup] = {}
+        # The inodes found, by the key of their eligibility to be hardlinked.
+        self.file_index: Dict[IndexKey, List[InodeGroup]] = {}
+        self.checkpoint: Optional[Checkpoint] = None
+        # Used instead of inode_index and file_index with --spill-dir.
+        self.spill_index: Optional[SpillIndex] = None
+        # The directories which are still to be scanned, in the order in which
+        # they are taken from the end of the list.  None if no scan is running.
+        self.pending_directories: Optional[List[str]] = None
+        # The lists in file_index which have been compared and hardlinked, by
+        # their id().
+        self.finished_lists: Set[int] = set()
+        # How files are read to compare them, the --cache-policy.
+        self.cache_policy = "keep"
+        # The largest chunk in which files are read, the --max-chunk-size.
+        self.max_chunk_size = BUFFER_SIZE
+        # The order in which files are compared, the --read-order.
+        self.read_order = "walk"
+        # Where the data of the inodes starts on the disk, by their device and
+        # inode number, for --read-order disk.
+        self.physical_offsets: Dict[Tuple[int, int], int] = {}
+        # The timers of the functions on the hot path, set with --profile.
+        self.timers: Optional[Timers] = None
+        # The most files which each compare worker keeps open at a time.
+        self.max_open_files = MAX_OPEN_FILES
+
+
+# The state of the scan which is running.  The functions which find and
+# hardlink files use the state returned by current_state(), so each Hardlinker
+# runs them in its own context.
+_scan_state: "contextvars.ContextVar[ScanState]" = contextvars.ContextVar("scan_state")
+
+
+def current_state() -> ScanState:
+    """Return the state of the running scan, or a default state if none is"""
+    return _scan_state.get(_default_state)
+
+
+T = TypeVar("T")
+
+
+class Hardlinker(object):
+    """Find and hardlink the identical files in some directories.
+
+    All the state of the scan is kept in this object, so several scans can be
+    done in one process, also at the same time in different threads.  Nothing
+    is printed unless the options ask for it.
+
+        args = make_args(directories=["/srv/backups"], content_only=True)
+        with Hardlinker(args=args) as hardlinker:
+            for link_action in hardlinker.run():
+                ...
+    """
+
+    def __init__(self, *, args: argparse.Namespace) -> None:
+        self.args = args
+        self.state = ScanState()
+        if args.digest_cache:
+            self.state.digest_cache = DigestCache(args.digest_cache)
+        self.state.cache_policy = args.cache_policy
+        self.state.max_chunk_size = args.max_chunk_size * 1024
+        self.state.read_order = args.read_order
+        self.state.max_open_files = max_open_files(workers=args.compare_workers)
+        if args.spill_dir:
+            self.state.spill_index = SpillIndex(
+                directory=args.spill_dir, memory_limit=args.spill_memory * 1024 ** 2
+            )
+        if args.checkpoint:
+            self.state.checkpoint = Checkpoint(
+                args.checkpoint, interval=args.checkpoint_interval
+            )
+        self._context = contextvars.copy_context()
+        self._context.run(_scan_state.set, self.state)
+
+    @property
+    def stats(self) -> cStatistics:
+        return self.state.stats
+
+    def collect(self) -> None:
+        """Walk the directories and collect the files which could be linked"""
+        start_time = time.time()
+        self._context.run(collect_files, args=self.args)
+        self.stats.scan_time += time.time() - start_time
+
+    def duplicate_groups(self) -> Iterator[List[InodeGroup]]:
+        """Yield the lists of inodes with identical contents, without linking
+
+        collect() must have been called first.
+        """
+        for identical_files in self._in_context(
+            find_collected_identical_files(args=self.args)
+        ):
+            yield from identical_files.identical_groups
+
+    def link_actions(self) -> Iterator[LinkAction]:
+        """Hardlink the identical files and yield every hardlink made
+
+        collect() must have been called first.
+        """
+        start_time = time.time()
+        yield from self._in_context(hardlink_collected_files(args=self.args))
+        self.stats.link_time += time.time() - start_time
+
+    def run(self) -> Iterator[LinkAction]:
+        """Collect the files, hardlink them and yield every hardlink made"""
+        self.collect()
+        yield from self.link_actions()
+
+    def close(self) -> None:
+        """Close the directories and the digest cache used by the scan"""
+        digest_cache = self.state.digest_cache
+        if digest_cache is not None:
+            max_age = self.args.digest_cache_max_age
+            digest_cache.prune(
+                max_age=None if max_age is None else max_age * 24 * 3600,
+                max_entries=self.args.digest_cache_max_entries,
+            )
+            digest_cache.close()
+            self.state.digest_cache = None
+        if self.state.spill_index is not None:
+            self.state.spill_index.close()
+        self.state.directory_fds.close()
+
+    def __enter__(self) -> "Hardlinker":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    # Run each step of an iterator in the context of this scan, so the caller
+    # runs in its own context between the steps.
+    def _in_context(self, iterator: Iterator[T]) -> Iterator[T]:
+        while True:
+            try:
+                item = self._context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+
+
+def make_args(*, directories: List[str], **options: object) -> argparse.Namespace:
+    """Create the options of a Hardlinker, like parse_args() does
+
+    The options have the names of the attributes set by parse_args(), like
+    content_only or dry_run.  Nothing is printed by default, and unlike
+    main() no --tuning-file is read unless one is given.  The options
+    are checked like parse_args() does, raising TypeError for an unknown
+    option and ValueError for an invalid one.
+    """
+    args = make_parser().parse_args(args=["--quiet"])
+    apply_quiet(args)
+    args.directories = list(directories)
+    for name, value in options.items():
+        if not hasattr(args, name):
+            raise TypeError(f"Unknown option: {name}")
+        setattr(args, name, value)
+    check_options(args=args)
+    prepare_args(args)
+    return args
 
 
 def humanize_time(seconds: float) -> str:
@@ -477,11 +3293,9 @@ def humanize_number(number: int) -> str:
     return f"{number} bytes"
 
 
-def parse_args(passed_args: Optional[List[str]] = None) -> argparse.Namespace:
+def make_parser() -> argparse.ArgumentParser:
+    """Create the parser of the options, without the directories"""
     parser = argparse.ArgumentParser()  # usage=usage)
-    parser.add_argument(
-        "directories", nargs="+", metavar="DIRECTORY", help="Directory name"
-    )
     parser.add_argument("--version", action="version", version=VERSION)
     parser.add_argument(
         "-f",
@@ -555,6 +3369,253 @@ def parse_args(passed_args: Optional[List[str]] = None) -> argparse.Namespace:
         default=[],
     )
 
+    parser.add_argument(
+        "--ignore-file",
+        help=(
+            "Name of gitignore style files, like .hardlinkignore, whose patterns "
+            "exclude files and directories in the directory of the file and "
+            "below it"
+        ),
+        metavar="NAME",
+    )
+
+    parser.add_argument(
+        "--prefer-root",
+        help=(
+            "Keep the files under this directory and hardlink identical files "
+            "to them, instead of keeping the file with the most links (may "
+            "specify multiple times, the first one is preferred most)"
+        ),
+        metavar="DIRECTORY",
+        action="append",
+        dest="prefer_roots",
+        default=[],
+    )
+
+    parser.add_argument(
+        "--device-workers",
+        help=(
+            "Hardlink the files of each device, including the devices mounted "
+            "below the directories, in its own process, with this many "
+            "processes at the same time (default: %(default)s, all devices in "
+            "this process)"
+        ),
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--link-strategy",
+        help=(
+            "How a file is replaced by a hardlink. 'atomic' links to a temporary "
+            "name and renames it over the file, so the file always exists. "
+            "'rename' renames the file away, links and removes the renamed file "
+            "(default: %(default)s)"
+        ),
+        choices=("atomic", "rename"),
+        default="atomic",
+    )
+
+    parser.add_argument(
+        "--digest-cache",
+        help=(
+            "Keep the digests of compared files in this SQLite database, so "
+            "unchanged files do not have to be read again. Files are then "
+            "considered identical when the BLAKE2b digests of their contents "
+            "are equal"
+        ),
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--digest-cache-max-age",
+        help="Remove digests which have not been used for this many days",
+        metavar="DAYS",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--digest-cache-max-entries",
+        help="Only keep the digests of this many of the most recently used files",
+        metavar="COUNT",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--metrics-json",
+        help="Write metrics of the run, like the time of each phase, as JSON",
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--metrics-prom",
+        help=(
+            "Write metrics of the run in the Prometheus text format, for the "
+            "textfile collector of the node exporter"
+        ),
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--metrics-interval",
+        help="Also write the metrics every SECONDS seconds during the run",
+        metavar="SECONDS",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--cache-policy",
+        help=(
+            "How files are read to compare them: 'keep' leaves them in the page "
+            "cache, 'drop' reads them ahead and drops them from the page cache "
+            "once they were read, 'direct' also bypasses the page cache with "
+            "O_DIRECT where it is supported (default: %(default)s)"
+        ),
+        choices=("keep", "drop", "direct"),
+        default="keep",
+    )
+
+    parser.add_argument(
+        "--max-chunk-size",
+        help=(
+            "The largest chunk in which files are read to compare them, in KiB. "
+            "The chunks start small and grow up to it (default: the size saved "
+            f"by --calibrate, or {BUFFER_SIZE // 1024})"
+        ),
+        metavar="KIB",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--read-order",
+        help=(
+            "The order in which files are compared: 'walk' in the order they "
+            "were found, 'disk' in the order of their data on the disk, with "
+            "chunks of the --max-chunk-size from the start, which avoids "
+            "seeking on rotational disks (default: %(default)s)"
+        ),
+        choices=("walk", "disk"),
+        default="walk",
+    )
+
+    parser.add_argument(
+        "--calibrate",
+        help=(
+            "Measure how fast the largest files in the directories are read at "
+            "several chunk sizes, and save the fastest as the --max-chunk-size "
+            "of their file system in the --tuning-file, instead of hardlinking"
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--tuning-file",
+        help=(
+            "The file where --calibrate saves its results, and from which the "
+            "--max-chunk-size of the file system is read (default: "
+            "$XDG_CONFIG_HOME/hardlinkpy/tuning.json or "
+            "~/.config/hardlinkpy/tuning.json)"
+        ),
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--spill-dir",
+        help=(
+            "Keep the collected files in sorted files in this directory instead "
+            "of in memory, for trees with more files than fit in memory"
+        ),
+        metavar="DIR",
+    )
+
+    parser.add_argument(
+        "--spill-memory",
+        help=(
+            "With --spill-dir, about how much memory the collected files may "
+            "take before they are written to a spill file (default: %(default)s)"
+        ),
+        metavar="MIB",
+        type=int,
+        default=256,
+    )
+
+    parser.add_argument(
+        "--shard",
+        help=(
+            "Compare only the files of the sizes of shard I of N, to split a run "
+            "over N processes or nodes. Every shard walks all the directories"
+        ),
+        metavar="I/N",
+        type=parse_shard,
+    )
+
+    parser.add_argument(
+        "--manifest",
+        help=(
+            "Write the hardlinks made and the statistics of the run to this "
+            "file, for merging the shards of a run with hardlinkpy-merge"
+        ),
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        help=(
+            "Save the progress of the run to this file from time to time, so an "
+            "interrupted run can be continued with --resume. The file is removed "
+            "when the run finishes"
+        ),
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--checkpoint-interval",
+        help="Save the checkpoint every SECONDS seconds (default: %(default)s)",
+        metavar="SECONDS",
+        type=float,
+        default=300.0,
+    )
+
+    parser.add_argument(
+        "--resume",
+        help=(
+            "Continue the run saved in the --checkpoint file, if it exists. Files "
+            "which changed since then are checked again"
+        ),
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--profile",
+        help=(
+            "Write cProfile data of the run to this file, and print how much "
+            "time was spent in the functions on the hot path"
+        ),
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--scan-workers",
+        help=(
+            "Number of threads used to scan directories. More than one helps on "
+            "filesystems with a high latency, like NFS"
+        ),
+        metavar="N",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--compare-workers",
+        help=(
+            "Number of threads used to compare files. More than one keeps more "
+            "reads in flight on fast or networked storage"
+        ),
+        metavar="N",
+        type=int,
+        default=1,
+    )
+
     verbosity_group = parser.add_mutually_exclusive_group()
     verbosity_group.add_argument(
         "-v",
@@ -568,23 +3629,139 @@ def parse_args(passed_args: Optional[List[str]] = None) -> argparse.Namespace:
         "--quiet", help="Minimizes output", action="store_true"
     )
 
+    return parser
+
+
+def parse_args(
+    passed_args: Optional[List[str]] = None, *, tuning_file: Optional[str] = None
+) -> argparse.Namespace:
+    """Parse the command line options
+
+    `tuning_file` is the --tuning-file used when none is given, if any.  Only
+    main() passes one, so nothing else reads the tuning file of the user.
+    """
+    parser = make_parser()
+    parser.add_argument(
+        "directories", nargs="+", metavar="DIRECTORY", help="Directory name"
+    )
     args = parser.parse_args(args=passed_args)
+    if args.tuning_file is None:
+        args.tuning_file = tuning_file
+    apply_quiet(args)
+    try:
+        check_options(args=args)
+    except ValueError as exc:
+        parser.error(str(exc))
+    for dirname in args.directories:
+        dirname = os.path.abspath(os.path.expanduser(dirname))
+        if not os.path.isdir(dirname):
+            parser.print_help()
+            print()
+            print(f"Error: {dirname} is NOT a directory")
+            sys.exit(1)
+    try:
+        prepare_args(args)
+    except ValueError as exc:
+        parser.error(str(exc))
+    return args
+
+
+def apply_quiet(args: argparse.Namespace) -> None:
     if args.quiet:
         args.verbose = 0
         args.show_progress = False
         args.printstats = False
+
+
+def check_options(*, args: argparse.Namespace) -> None:
+    """Raise ValueError if options have invalid values or can't be combined"""
     if args.min_size < 1:
-        parser.error("-s/--min-size must be 1 or greater")
+        raise ValueError("-s/--min-size must be 1 or greater")
+    if args.scan_workers < 1:
+        raise ValueError("--scan-workers must be 1 or greater")
+    if args.compare_workers < 1:
+        raise ValueError("--compare-workers must be 1 or greater")
+    if args.device_workers < 0:
+        raise ValueError("--device-workers must be 0 or greater")
+    if args.device_workers and (args.checkpoint or args.digest_cache):
+        raise ValueError(
+            "--device-workers can't be used with --checkpoint or --digest-cache"
+        )
+    if args.spill_dir and args.checkpoint:
+        raise ValueError("--spill-dir can't be used with --checkpoint")
+    if args.spill_memory < 1:
+        raise ValueError("--spill-memory must be 1 or greater")
+    if args.resume and not args.checkpoint:
+        raise ValueError("--resume requires --checkpoint")
+    if args.metrics_interval is not None and args.metrics_interval <= 0:
+        raise ValueError("--metrics-interval must be greater than 0")
+    # O_DIRECT reads have to be a multiple of the page size.
+    if args.max_chunk_size is not None and (
+        args.max_chunk_size < 4 or args.max_chunk_size % 4
+    ):
+        raise ValueError("--max-chunk-size must be a multiple of 4")
+
+
+def prepare_args(args: argparse.Namespace) -> None:
+    """Fill in the options which are derived from the others
+
+    Raises ValueError if a directory does not exist or an --exclude is not a
+    valid regular expression.
+    """
+    for exclude in args.excludes:
+        try:
+            re.compile(exclude)
+        except re.error as exc:
+            raise ValueError(
+                f"Invalid -x/--exclude regular expression {exclude!r}: {exc}"
+            )
+    args.exclude_patterns = compile_excludes(args.excludes)
     args.directories = [
         os.path.abspath(os.path.expanduser(dirname)) for dirname in args.directories
     ]
+    args.prefer_roots = [
+        os.path.abspath(os.path.expanduser(dirname)) for dirname in args.prefer_roots
+    ]
+    if not args.directories:
+        raise ValueError("No directories given")
     for dirname in args.directories:
         if not os.path.isdir(dirname):
-            parser.print_help()
-            print()
-            print(f"Error: {dirname} is NOT a directory")
-            sys.exit(1)
-    return args
+            raise ValueError(f"{dirname} is NOT a directory")
+    args.directories = drop_nested_directories(args.directories)
+    # The directories given, which --device-workers split up into the
+    # directories of each device.
+    args.top_directories = args.directories
+    # The directories which are not scanned as another device worker does.
+    args.pruned_directories = frozenset()
+    if args.max_chunk_size is None:
+        tuned_size = None
+        if args.tuning_file:
+            tuned_size = tuned_chunk_size(
+                filename=args.tuning_file, directory=args.directories[0]
+            )
+        args.max_chunk_size = tuned_size or BUFFER_SIZE // 1024
+
+
+def drop_nested_directories(directories: List[str]) -> List[str]:
+    """Leave out the directories which are the same as, or inside, another one
+
+    The files in them would otherwise be found once for each of the
+    directories they are in.  The directories are compared by their real
+    paths, the ones which are kept are returned as they were given.
+    """
+    real_paths = [
+        os.path.join(os.path.realpath(dirname), "") for dirname in directories
+    ]
+    kept = []
+    for index, (dirname, real_path) in enumerate(zip(directories, real_paths)):
+        if any(
+            real_path.startswith(other) and (real_path != other or other_index < index)
+            for other_index, other in enumerate(real_paths)
+            if other_index != index
+        ):
+            continue
+        kept.append(dirname)
+    return kept
 
 
 def check_python_version() -> None:
@@ -608,76 +3785,91 @@ def setup_logger(verbose_level: int) -> None:
 debug = None
 debug1 = None
 
+# The statistics of the last run of main()
 gStats = cStatistics()
 
-file_hashes: Dict[int, List[FileInfo]] = {}
+_default_state = ScanState()
 
 VERSION = "0.7.0 - 2020-05-13 (13-May-2020)"
 
 
 def main(passed_args: Optional[List[str]] = None) -> int:
+    global gStats
     check_python_version()
 
     # Parse our argument list and get our list of directories
-    args = parse_args(passed_args=passed_args)
-    # Compile up our regexes ahead of time
-    MIRROR_PL_REGEX = re.compile(r"^\.in\.")
-    RSYNC_TEMP_REGEX = re.compile((r"^\..*\.\?{6,6}$"))
-    # Now go through all the directories that have been added.
-    # NOTE: hardlink_identical_files() will add more directories to the
-    #       directories list as it finds them.
-    directories = args.directories.copy()
-    while directories:
-        # Get the last directory in the list
-        directory = directories.pop() + "/"
-        if not os.path.isdir(directory):
-            print(f"{directory} is NOT a directory!")
-        else:
-            gStats.found_directory()
-            # Loop through all the files in the directory
-            try:
-                dir_entries = os.scandir(directory)
-            except (OSError, PermissionError) as exc:
-                print(
-                    f"Error: Unable to do an os.scandir on: {directory}  Skipping...",
-                    exc,
-                )
-                continue
-            directories_found = []
-            for dir_entry in sorted(dir_entries, key=lambda x: x.name):
-                pathname = dir_entry.path
-                # Look at files/dirs beginning with "."
-                if dir_entry.name.startswith("."):
-                    # Ignore any mirror.pl files.  These are the files that
-                    # start with ".in."
-                    if MIRROR_PL_REGEX.match(dir_entry.name):
-                        continue
-                    # Ignore any RSYNC files.  These are files that have the
-                    # format .FILENAME.??????
-                    if RSYNC_TEMP_REGEX.match(dir_entry.name):
-                        continue
-                if dir_entry.is_symlink():
-                    if debug1:
-                        print(f"{pathname}: is a symbolic link, ignoring")
-                    continue
-
-                if dir_entry.is_dir():
-                    directories_found.append(pathname)
-                    continue
+    args = parse_args(passed_args=passed_args, tuning_file=default_tuning_file())
+    if args.calibrate:
+        return calibrate(args=args)
+    with Hardlinker(args=args) as hardlinker:
+        gStats = hardlinker.stats
+        with MetricsReporter(stats=hardlinker.stats, args=args), Profiler(
+            state=hardlinker.state, args=args
+        ):
+            if args.device_workers:
+                link_devices(stats=hardlinker.stats, args=args)
+            else:
+                # Phase 1: Walk all the directories and collect the file
+                # information.
+                hardlinker.collect()
+                # Phase 2: Compare the files which could be identical and
+                # hardlink them.
+                for _ in hardlinker.link_actions():
+                    pass
 
-                if dir_entry.stat(follow_symlinks=False).st_size < args.min_size:
-                    if debug1:
-                        print(f"{pathname}: Size is not large enough, ignoring")
-                    continue
-                hardlink_identical_files(dir_entry=dir_entry, args=args)
-            # Add our found directories in reverse order because we pop them
-            # off the end. Goal is to go through our directories in
-            # alphabetical order.
-            directories.extend(reversed(directories_found))
+    if args.manifest:
+        write_manifest(stats=gStats, args=args)
     if args.printstats:
         gStats.print_stats(args)
     return 0
 
 
+def merge_main(passed_args: Optional[List[str]] = None) -> int:
+    """Merge the manifests of the shards of a run and print its statistics"""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Merge the manifests written with --shard and --manifest by the "
+            "shards of a run, and print the statistics of the whole run"
+        )
+    )
+    parser.add_argument(
+        "manifests", help="Manifest files", metavar="MANIFEST", nargs="+"
+    )
+    parser.add_argument(
+        "-p",
+        "--print-previous",
+        help="Print previously created hardlinks",
+        action="store_true",
+        dest="printprevious",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="Write metrics of the merged run as JSON",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        help="Write metrics of the merged run in the Prometheus text format",
+        metavar="FILE",
+    )
+    args = parser.parse_args(args=passed_args)
+
+    try:
+        manifests = [read_manifest(filename) for filename in args.manifests]
+        stats = merge_manifests(manifests)
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        print("Error merging the manifests")
+        print("When an exception occurred: {}".format(exc))
+        return 1
+    write_metrics(stats=stats, args=args, completed=True)
+    report_args = make_args(
+        directories=[os.curdir],
+        printprevious=args.printprevious,
+        dry_run=any(manifest.dry_run for manifest in manifests),
+    )
+    stats.print_stats(report_args)
+    return 0
+
+
 if __name__ == "__main__":
     main()
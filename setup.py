@@ -17,6 +17,7 @@ setuptools.setup(
         "console_scripts": [
             "hardlinkpy=hardlinkpy.hardlink:main",
             "hardlink.py=hardlinkpy.hardlink:main",
+            "hardlinkpy-merge=hardlinkpy.hardlink:merge_main",
         ]
     },
     long_description=long_description,
@@ -1,8 +1,15 @@
 import datetime
+import errno
+import io
+import json
 import os
 import pathlib
+import pstats
 import tempfile
-from typing import List, NamedTuple
+import threading
+import time
+import unittest.mock as mock
+from typing import Any, Generator, List, NamedTuple, Optional, cast
 
 import testtools
 
@@ -114,6 +121,15 @@ class TestFunctional(testtools.TestCase):
         self.default_options = ["--quiet"]
         # self.default_options = []
 
+        # main() reads the tuning file in the configuration directory of the
+        # user, which the tests must not depend on or change.
+        config_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(config_dir.cleanup)
+        self.config_directory = pathlib.Path(config_dir.name)
+        environ = mock.patch.dict(os.environ, {"XDG_CONFIG_HOME": config_dir.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+
     def verify_file_data(self, *, link_counts: List[int]) -> None:
         result_link_counts = []
         for file_data in self.test_file_data:
@@ -132,6 +148,797 @@ class TestFunctional(testtools.TestCase):
         self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
         self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
 
+    def test_hardlink_overlapping_directories(self) -> None:
+        top = self.test_directory.as_posix()
+        for directories in ([top, top], [top, top + "/dir1"], [top + "/dir1", top]):
+            hardlink.main(self.default_options + directories)
+            self.assertEqual(10, hardlink.gStats.regularfiles)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_overlapping_directories_extra_link(self) -> None:
+        # fileA_D1_T1 has a second link, and identical files without one.
+        os.link(
+            self.test_directory / "dir0/fileA_D1_T1.test",
+            self.test_directory / "dir0/fileA_D1_T1.link",
+        )
+        top = self.test_directory.as_posix()
+        hardlink.main(self.default_options + [top, top + "/dir0"])
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        leftovers = [
+            filename
+            for _, _, filenames in os.walk(top)
+            for filename in filenames
+            if "cleanit" in filename
+        ]
+        self.assertEqual([], leftovers)
+
+    def test_hardlink_unique_files_skipped(self) -> None:
+        hardlink.main(self.default_options + [self.test_directory.as_posix()])
+        # The two small files and the only file with the second timestamp and
+        # second data can't match any other file.
+        self.assertEqual(3, hardlink.gStats.unique_files)
+        self.assertEqual(10, hardlink.gStats.regularfiles)
+
+    def test_hardlink_sample_rejections(self) -> None:
+        # A file with the same size and timestamp as the first data but
+        # different contents.
+        first_file = self.test_directory / self.test_file_data[0].pathname
+        other_file = self.test_directory / "dir4/fileC_D3_T1.test"
+        with open(other_file, "w") as out_file:
+            out_file.write("x" * len(self.test_data_1))
+        os.chmod(other_file, 0o644)
+        first_stat = os.stat(first_file)
+        os.utime(other_file, ns=(first_stat.st_atime_ns, first_stat.st_mtime_ns))
+
+        hardlink.main(self.default_options + [self.test_directory.as_posix()])
+        self.assertEqual(1, hardlink.gStats.sample_rejections)
+        self.assertEqual(0, hardlink.gStats.content_rejections)
+        self.assertEqual(5, hardlink.gStats.comparisons)
+        self.assertEqual(1, get_link_count(other_file))
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_merge_inode_groups(self) -> None:
+        # A second path of the dir1 inode with the first data, and a link to
+        # the dir2 inode from outside of the directories which are searched.
+        os.link(
+            self.test_directory / "dir1/fileB_D1_T1.test",
+            self.test_directory / "dir1/fileC_D1_T1.test",
+        )
+        os.mkdir(self.test_directory / "outside")
+        os.link(
+            self.test_directory / "dir2/fileA_D1_T1.test",
+            self.test_directory / "outside/file",
+        )
+        block_sizes = {
+            file_data.pathname: os.lstat(
+                self.test_directory / file_data.pathname
+            ).st_blocks
+            for file_data in self.test_file_data
+        }
+        directories = [
+            (self.test_directory / f"dir{index}").as_posix() for index in range(5)
+        ]
+
+        hardlink.main(self.default_options + directories)
+        # The dir1 inode with the first data has the most links, so the other
+        # files are linked to it.
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(5, hardlink.gStats.inodes_merged)
+        # The dir2 inode is still linked from outside of the directories.
+        self.assertEqual(
+            block_sizes["dir0/fileA_D1_T1.test"]
+            + block_sizes["dir2/fileB_D1_T1.test"]
+            + block_sizes["dir3/fileB_D1_T1.test"]
+            + block_sizes["dir1/fileA_D2_T1.test"],
+            hardlink.gStats.blocks_freed,
+        )
+        self.assertEqual(
+            6, get_link_count(self.test_directory / "dir1/fileC_D1_T1.test")
+        )
+        self.assertEqual(1, get_link_count(self.test_directory / "outside/file"))
+
+    def test_hardlink_already_hardlinked(self) -> None:
+        hardlink.main(self.default_options + [self.test_directory.as_posix()])
+        # Everything is hardlinked now, the paths of each inode are grouped
+        # together without comparing any of them.  Only the samples of the two
+        # inodes with the first timestamp and the same size are read.
+        args = hardlink.make_args(directories=[self.test_directory.as_posix()])
+        with hardlink.Hardlinker(args=args) as hardlinker:
+            self.assertEqual([], list(hardlinker.run()))
+        self.assertEqual(0, hardlinker.stats.hardlinked_thisrun)
+        self.assertEqual(0, hardlinker.stats.comparisons)
+        self.assertEqual(2 * 3 * hardlink.SAMPLE_SIZE, hardlinker.stats.bytes_read)
+        self.assertEqual(5, hardlinker.stats.hardlinked_previously)
+        self.assertEqual(5, len(hardlinker.state.inode_index))
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlinker_duplicate_groups(self) -> None:
+        args = hardlink.make_args(directories=[self.test_directory.as_posix()])
+        with hardlink.Hardlinker(args=args) as hardlinker:
+            hardlinker.collect()
+            duplicate_groups = [
+                sorted(
+                    os.path.relpath(inode_group.filenames[0], self.test_directory)
+                    for inode_group in inode_groups
+                )
+                for inode_groups in hardlinker.duplicate_groups()
+            ]
+        self.assertEqual(
+            [
+                [
+                    "dir0/fileA_D1_T1.test",
+                    "dir1/fileB_D1_T1.test",
+                    "dir2/fileA_D1_T1.test",
+                    "dir2/fileB_D1_T1.test",
+                    "dir3/fileB_D1_T1.test",
+                ],
+                ["dir0/fileB_D2_T1.test", "dir1/fileA_D2_T1.test"],
+            ],
+            sorted(duplicate_groups, key=len, reverse=True),
+        )
+        self.assertEqual(0, hardlinker.stats.hardlinked_thisrun)
+        self.verify_file_data(link_counts=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+
+    def test_hardlinker_separate_scans(self) -> None:
+        args1 = hardlink.make_args(
+            directories=[(self.test_directory / "dir0").as_posix()], dry_run=True
+        )
+        args2 = hardlink.make_args(
+            directories=[(self.test_directory / "dir2").as_posix()]
+        )
+        with hardlink.Hardlinker(args=args1) as hardlinker1:
+            with hardlink.Hardlinker(args=args2) as hardlinker2:
+                hardlinker1.collect()
+                hardlinker2.collect()
+                link_actions = list(hardlinker2.link_actions())
+                self.assertEqual([], list(hardlinker1.link_actions()))
+        self.assertEqual(
+            [
+                hardlink.LinkAction(
+                    sourcefile=(
+                        self.test_directory / "dir2/fileA_D1_T1.test"
+                    ).as_posix(),
+                    destfile=(self.test_directory / "dir2/fileB_D1_T1.test").as_posix(),
+                    size=len(self.test_data_1),
+                    linked=True,
+                )
+            ],
+            link_actions,
+        )
+        self.assertEqual(2, hardlinker1.stats.regularfiles)
+        self.assertEqual(2, hardlinker2.stats.regularfiles)
+        self.assertEqual(1, hardlinker2.stats.hardlinked_thisrun)
+
+    def test_make_args_unknown_option(self) -> None:
+        self.assertRaises(
+            TypeError,
+            hardlink.make_args,
+            directories=[self.test_directory.as_posix()],
+            no_such_option=True,
+        )
+
+    def test_make_args_invalid_options(self) -> None:
+        directories = [self.test_directory.as_posix()]
+        for options in (
+            dict(min_size=0),
+            dict(scan_workers=0),
+            dict(spill_dir=self.test_directory.as_posix(), checkpoint="checkpoint"),
+            dict(excludes=["("]),
+        ):
+            self.assertRaises(
+                ValueError, hardlink.make_args, directories=directories, **options
+            )
+
+    def test_make_args_missing_directory(self) -> None:
+        self.assertRaises(
+            ValueError,
+            hardlink.make_args,
+            directories=[(self.test_directory / "missing").as_posix()],
+        )
+        self.assertRaises(ValueError, hardlink.make_args, directories=[])
+
+    def test_make_args_prepared(self) -> None:
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.test_directory)
+        args = hardlink.make_args(directories=["dir0"], prefer_roots=["dir1"])
+        self.assertEqual([os.path.join(os.getcwd(), "dir0")], args.directories)
+        self.assertEqual([os.path.join(os.getcwd(), "dir1")], args.prefer_roots)
+        self.assertEqual(args.directories, args.top_directories)
+        # The tuning file of the user is not read.
+        self.assertIsNone(args.tuning_file)
+        self.assertEqual(hardlink.BUFFER_SIZE // 1024, args.max_chunk_size)
+
+    def test_hardlink_link_strategy_rename(self) -> None:
+        hardlink.main(
+            self.default_options
+            + ["--link-strategy", "rename", self.test_directory.as_posix()]
+        )
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_metrics(self) -> None:
+        metrics_json = self.test_directory / "metrics.json"
+        metrics_prom = self.test_directory / "metrics.prom"
+        hardlink.main(
+            self.default_options
+            + [
+                "--metrics-json",
+                metrics_json.as_posix(),
+                "--metrics-prom",
+                metrics_prom.as_posix(),
+                (self.test_directory / "dir0").as_posix(),
+                (self.test_directory / "dir1").as_posix(),
+            ]
+        )
+        with open(metrics_json) as in_file:
+            metrics = json.load(in_file)
+        self.assertTrue(metrics["completed"])
+        self.assertEqual(2, metrics["hardlinked"])
+        # Each file is opened to read its sample and then to compare it.
+        self.assertEqual(8, metrics["files_opened"])
+        self.assertEqual(
+            {"walk", "stat", "compare", "link"}, set(metrics["phase_seconds"])
+        )
+        # One list of candidates with the four files.
+        self.assertEqual(
+            {"count": 1, "sum": 4},
+            {key: metrics["candidates_per_bucket"][key] for key in ("count", "sum")},
+        )
+        self.assertEqual(0, metrics["candidates_per_bucket"]["buckets"]["2"])
+        self.assertEqual(1, metrics["candidates_per_bucket"]["buckets"]["4"])
+        with open(metrics_prom) as in_file:
+            prom_lines = in_file.read().splitlines()
+        self.assertIn("hardlinkpy_hardlinked 2", prom_lines)
+        self.assertIn("hardlinkpy_completed 1", prom_lines)
+        self.assertIn(
+            'hardlinkpy_candidates_per_bucket_bucket{le="+Inf"} 1', prom_lines
+        )
+
+    def test_hardlink_profile(self) -> None:
+        profile_file = self.test_directory / "hardlink.prof"
+        split_identical_files = hardlink.split_identical_files
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+            hardlink.main(
+                self.default_options
+                + [
+                    "--profile",
+                    profile_file.as_posix(),
+                    (self.test_directory / "dir0").as_posix(),
+                    (self.test_directory / "dir1").as_posix(),
+                ]
+            )
+        self.assertIs(split_identical_files, hardlink.split_identical_files)
+        profile_stats = pstats.Stats(profile_file.as_posix())
+        self.assertIn(
+            "link_actions",
+            [function for _, _, function in profile_stats.stats],  # type: ignore
+        )
+        timer_lines = {
+            line.split()[0]: line.split()[1:]
+            for line in mock_stdout.getvalue().splitlines()
+        }
+        self.assertEqual("2", timer_lines["split_identical_files"][0])
+        self.assertGreater(float(timer_lines["split_identical_files"][2]), 0)
+        self.assertEqual("2", timer_lines["hardlink_files"][0])
+        self.assertEqual("4", timer_lines["stat"][0])
+
+    def test_hardlink_profile_many_files(self) -> None:
+        profile_file = self.test_directory / "hardlink.prof"
+        with mock.patch.object(hardlink, "max_open_files", return_value=1):
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                hardlink.main(
+                    self.default_options
+                    + [
+                        "--profile",
+                        profile_file.as_posix(),
+                        (self.test_directory / "dir0").as_posix(),
+                        (self.test_directory / "dir1").as_posix(),
+                    ]
+                )
+        timer_lines = {
+            line.split()[0]: line.split()[1:]
+            for line in mock_stdout.getvalue().splitlines()
+        }
+        for name in ["split_many_identical_files", "sample_digest"]:
+            self.assertGreater(int(timer_lines[name][0]), 0)
+            self.assertGreater(float(timer_lines[name][2]), 0)
+
+    def test_profiler_times_only_its_scan(self) -> None:
+        profile_file = self.test_directory / "hardlink.prof"
+        args1 = hardlink.make_args(
+            directories=[(self.test_directory / "dir0").as_posix()],
+            profile=profile_file.as_posix(),
+        )
+        args2 = hardlink.make_args(
+            directories=[(self.test_directory / "dir2").as_posix()]
+        )
+        with hardlink.Hardlinker(args=args1) as hardlinker1:
+            with hardlink.Hardlinker(args=args2) as hardlinker2:
+                with mock.patch("sys.stdout", new_callable=io.StringIO):
+                    with hardlink.Profiler(state=hardlinker1.state, args=args1):
+                        assert hardlinker1.state.timers is not None
+                        timers = hardlinker1.state.timers.timers
+                        hardlinker2.collect()
+                        list(hardlinker2.link_actions())
+                        self.assertEqual({}, timers)
+                        hardlinker1.collect()
+                        list(hardlinker1.link_actions())
+                self.assertIsNone(hardlinker1.state.timers)
+                self.assertIsNone(hardlinker2.state.timers)
+        self.assertEqual(1, timers["scan_directory"][0])
+        self.assertEqual(1, hardlinker2.stats.hardlinked_thisrun)
+
+    def test_hardlink_resume_scan(self) -> None:
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        checkpoint = pathlib.Path(checkpoint_dir.name) / "checkpoint.json"
+        options = self.default_options + [
+            "--checkpoint",
+            checkpoint.as_posix(),
+            "--checkpoint-interval",
+            "0",
+            "--resume",
+            self.test_directory.as_posix(),
+        ]
+        scan_directory = hardlink.scan_directory
+
+        def interrupted_scan_directory(
+            *, directory: str, **kwargs: Any
+        ) -> Optional[hardlink.DirectoryScan]:
+            if directory.endswith("dir3"):
+                raise KeyboardInterrupt
+            return scan_directory(directory=directory, **kwargs)
+
+        with mock.patch.object(
+            hardlink, "scan_directory", side_effect=interrupted_scan_directory
+        ):
+            self.assertRaises(KeyboardInterrupt, hardlink.main, options)
+        self.assertTrue(checkpoint.exists())
+
+        # A file which was saved in the checkpoint is changed before resuming.
+        changed_file = self.test_directory / self.test_file_data[0].pathname
+        os.utime(changed_file, (0, 0))
+        hardlink.main(options)
+        self.assertFalse(checkpoint.exists())
+        self.assertEqual(1, hardlink.gStats.changed_files)
+        self.assertEqual(6, hardlink.gStats.dircount)
+        self.assertEqual(10, hardlink.gStats.regularfiles)
+        self.assertEqual(4, hardlink.gStats.hardlinked_thisrun)
+        self.verify_file_data(link_counts=[1, 2, 2, 4, 4, 4, 1, 4, 1, 1])
+
+    def test_hardlink_resume_link(self) -> None:
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        checkpoint = pathlib.Path(checkpoint_dir.name) / "checkpoint.json"
+        options = self.default_options + [
+            "--checkpoint",
+            checkpoint.as_posix(),
+            "--checkpoint-interval",
+            "0",
+            "--resume",
+            "--content-only",
+            self.test_directory.as_posix(),
+        ]
+        link_identical_files = hardlink.link_identical_files
+        calls = []
+
+        def interrupted_link_identical_files(
+            **kwargs: Any,
+        ) -> List[hardlink.LinkAction]:
+            calls.append(kwargs)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return link_identical_files(**kwargs)
+
+        with mock.patch.object(
+            hardlink,
+            "link_identical_files",
+            side_effect=interrupted_link_identical_files,
+        ):
+            self.assertRaises(KeyboardInterrupt, hardlink.main, options)
+        self.assertTrue(checkpoint.exists())
+        linked_previously = hardlink.gStats.hardlinked_thisrun
+
+        hardlink.main(options)
+        self.assertFalse(checkpoint.exists())
+        self.assertLess(0, linked_previously)
+        self.assertEqual(7, hardlink.gStats.hardlinked_thisrun)
+        self.verify_file_data(link_counts=[5, 3, 3, 5, 5, 5, 2, 5, 2, 3])
+
+    def test_hardlink_cache_policy(self) -> None:
+        for cache_policy in ("drop", "direct"):
+            metrics_json = self.test_directory / f"{cache_policy}.json"
+            hardlink.main(
+                self.default_options
+                + [
+                    "--dry-run",
+                    "--cache-policy",
+                    cache_policy,
+                    "--metrics-json",
+                    metrics_json.as_posix(),
+                    self.test_directory.as_posix(),
+                ]
+            )
+            self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+            with open(metrics_json) as in_file:
+                metrics = json.load(in_file)
+            if os.path.exists("/proc/self/io"):
+                self.assertLessEqual(
+                    metrics["bytes_read_from_cache"], metrics["bytes_read"]
+                )
+        hardlink.main(
+            self.default_options
+            + ["--cache-policy", "direct", self.test_directory.as_posix()]
+        )
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_calibrate(self) -> None:
+        tuning_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tuning_dir.cleanup)
+        tuning_file = os.path.join(tuning_dir.name, "hardlinkpy", "tuning.json")
+        options = ["--tuning-file", tuning_file, self.test_directory.as_posix()]
+        self.assertEqual(
+            0, hardlink.main(self.default_options + ["--calibrate"] + options)
+        )
+        # Nothing is hardlinked while calibrating.
+        self.verify_file_data(link_counts=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+        with open(tuning_file) as in_file:
+            tuning = json.load(in_file)
+        settings = tuning[hardlink.mount_point(self.test_directory.as_posix())]
+        self.assertIn(settings["max_chunk_size"] * 1024, hardlink.CALIBRATION_SIZES)
+        args = hardlink.parse_args(passed_args=options)
+        self.assertEqual(settings["max_chunk_size"], args.max_chunk_size)
+        args = hardlink.parse_args(passed_args=["--max-chunk-size", "8"] + options)
+        self.assertEqual(8, args.max_chunk_size)
+
+        hardlink.main(self.default_options + options)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_calibrate_default_tuning_file(self) -> None:
+        self.assertEqual(
+            0,
+            hardlink.main(
+                self.default_options + ["--calibrate", self.test_directory.as_posix()]
+            ),
+        )
+        tuning_file = self.config_directory / "hardlinkpy" / "tuning.json"
+        with open(tuning_file) as in_file:
+            tuning = json.load(in_file)
+        settings = tuning[hardlink.mount_point(self.test_directory.as_posix())]
+
+        with mock.patch.object(
+            hardlink, "Hardlinker", side_effect=RuntimeError
+        ) as mock_hardlinker:
+            self.assertRaises(
+                RuntimeError,
+                hardlink.main,
+                self.default_options + [self.test_directory.as_posix()],
+            )
+        args = mock_hardlinker.call_args[1]["args"]
+        self.assertEqual(tuning_file.as_posix(), args.tuning_file)
+        self.assertEqual(settings["max_chunk_size"], args.max_chunk_size)
+
+        # Only main() reads the tuning file of the user.
+        with mock.patch.object(hardlink, "read_tuning_file") as mock_read:
+            args = hardlink.parse_args(passed_args=[self.test_directory.as_posix()])
+        mock_read.assert_not_called()
+        self.assertIsNone(args.tuning_file)
+        self.assertEqual(hardlink.BUFFER_SIZE // 1024, args.max_chunk_size)
+
+    def test_invalid_tuning_file(self) -> None:
+        tuning_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tuning_dir.cleanup)
+        tuning_file = os.path.join(tuning_dir.name, "tuning.json")
+        options = [
+            "--quiet",
+            "--tuning-file",
+            tuning_file,
+            self.test_directory.as_posix(),
+        ]
+        mount_point = hardlink.mount_point(self.test_directory.as_posix())
+        for tuning in (
+            {mount_point: {"max_chunk_size": 0}},
+            {mount_point: {"max_chunk_size": 6}},
+            {mount_point: {"max_chunk_size": "64"}},
+            {mount_point: {"chunk_size": 64}},
+            {mount_point: 64},
+            [64],
+        ):
+            with open(tuning_file, "w") as out_file:
+                json.dump(tuning, out_file)
+            with mock.patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+                args = hardlink.parse_args(passed_args=options)
+            self.assertEqual(hardlink.BUFFER_SIZE // 1024, args.max_chunk_size)
+            self.assertIn(tuning_file, mock_stdout.getvalue())
+
+    def test_hardlink_read_order_disk(self) -> None:
+        first_inode = os.lstat(
+            self.test_directory / self.test_file_data[0].pathname
+        ).st_ino
+        hardlink.main(
+            self.default_options
+            + ["--read-order", "disk", self.test_directory.as_posix()]
+        )
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        # The files are still linked to the first one found.
+        self.assertEqual(
+            first_inode,
+            os.lstat(self.test_directory / "dir3/fileB_D1_T1.test").st_ino,
+        )
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_device_workers(self) -> None:
+        # dir3 is the mount point of another device.
+        mounted_dir = (self.test_directory / "dir3").as_posix()
+        lstat = os.lstat
+
+        def device_lstat(path: str) -> Any:
+            stat_result = lstat(path)
+            if path == mounted_dir:
+                return mock.Mock(st_dev=stat_result.st_dev + 1)
+            return stat_result
+
+        with mock.patch.object(
+            hardlink, "list_mount_points", return_value=["/", mounted_dir]
+        ), mock.patch.object(os, "lstat", side_effect=device_lstat):
+            hardlink.main(
+                self.default_options
+                + ["--device-workers", "2", self.test_directory.as_posix()]
+            )
+        # The statistics of both devices are merged.
+        self.assertEqual(6, hardlink.gStats.dircount)
+        self.assertEqual(10, hardlink.gStats.regularfiles)
+        # The file in dir3 is on another device than the identical files.
+        self.assertEqual(4, hardlink.gStats.hardlinked_thisrun)
+        # The times are wall-clock times of the whole run, not the sum of the
+        # times of the workers.
+        self.assertLessEqual(
+            hardlink.gStats.scan_time + hardlink.gStats.link_time,
+            time.time() - hardlink.gStats.starttime,
+        )
+        self.verify_file_data(link_counts=[4, 2, 2, 4, 4, 4, 1, 1, 1, 1])
+
+    def test_hardlink_spill_dir(self) -> None:
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        options = self.default_options + [
+            "--spill-dir",
+            spill_dir.name,
+            "--spill-memory",
+            "1",
+            self.test_directory.as_posix(),
+        ]
+        # Every four files take the whole memory and are spilled, the last two
+        # files are merged from memory.
+        with mock.patch.object(hardlink.SpillIndex, "RECORD_SIZE", 300 * 1024):
+            hardlink.main(options)
+        self.assertEqual(2, hardlink.gStats.spill_files)
+        self.assertEqual([], os.listdir(spill_dir.name))
+        self.assertEqual(10, hardlink.gStats.regularfiles)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_shards(self) -> None:
+        manifest_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(manifest_dir.cleanup)
+        manifests = [
+            os.path.join(manifest_dir.name, f"shard{number}.json")
+            for number in (1, 2, 3)
+        ]
+        shard_stats = []
+        for number, manifest in enumerate(manifests, start=1):
+            hardlink.main(
+                self.default_options
+                + [
+                    "--shard",
+                    f"{number}/3",
+                    "--manifest",
+                    manifest,
+                    self.test_directory.as_posix(),
+                ]
+            )
+            shard_stats.append(hardlink.gStats)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+        # Each file is kept by exactly one of the shards, the small files by the
+        # second shard and the large ones by the third.
+        self.assertEqual([0, 2, 8], [stats.regularfiles for stats in shard_stats])
+
+        metrics_json = os.path.join(manifest_dir.name, "metrics.json")
+        self.assertEqual(
+            0, hardlink.merge_main(manifests + ["--metrics-json", metrics_json])
+        )
+        with open(metrics_json) as in_file:
+            metrics = json.load(in_file)
+        self.assertEqual(10, metrics["regular_files"])
+        self.assertEqual(
+            sum(stats.hardlinked_thisrun for stats in shard_stats),
+            metrics["hardlinked"],
+        )
+
+        # A missing shard fails the merge.
+        self.assertEqual(1, hardlink.merge_main(manifests[:1]))
+
+    def test_hardlink_prefer_root(self) -> None:
+        preferred_file = self.test_directory / "dir3/fileB_D1_T1.test"
+        preferred_inode = os.lstat(preferred_file).st_ino
+        hardlink.main(
+            self.default_options
+            + [
+                "--prefer-root",
+                (self.test_directory / "dir3").as_posix(),
+                self.test_directory.as_posix(),
+            ]
+        )
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(
+            preferred_inode,
+            os.lstat(self.test_directory / self.test_file_data[0].pathname).st_ino,
+        )
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_link_fails(self) -> None:
+        with mock.patch.object(
+            os, "link", side_effect=OSError(errno.EACCES, os.strerror(errno.EACCES))
+        ), mock.patch("sys.stdout", new_callable=io.StringIO):
+            hardlink.main(self.default_options + [self.test_directory.as_posix()])
+        self.assertEqual(0, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(0, hardlink.gStats.inodes_merged)
+        self.assertEqual(0, hardlink.gStats.blocks_freed)
+        self.verify_file_data(link_counts=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+
+    def test_hardlink_too_many_links(self) -> None:
+        # The file system allows at most three links to an inode.
+        link = os.link
+
+        def limited_link(source: str, dest: str, **kwargs: Any) -> None:
+            source_stat = os.stat(source, dir_fd=kwargs.get("src_dir_fd"))
+            if source_stat.st_nlink >= 3:
+                raise OSError(errno.EMLINK, os.strerror(errno.EMLINK))
+            link(source, dest, **kwargs)
+
+        with mock.patch.object(os, "link", side_effect=limited_link):
+            hardlink.main(self.default_options + [self.test_directory.as_posix()])
+        # The fourth file with the first data can't be linked to the first
+        # one, so the fifth is linked to it instead.
+        self.assertEqual(4, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(4, hardlink.gStats.inodes_merged)
+        self.assertEqual(
+            os.lstat(self.test_directory / "dir2/fileB_D1_T1.test").st_ino,
+            os.lstat(self.test_directory / "dir3/fileB_D1_T1.test").st_ino,
+        )
+        self.verify_file_data(link_counts=[3, 2, 2, 3, 3, 2, 1, 2, 1, 1])
+
+    def test_hardlink_exclude_directory(self) -> None:
+        os.makedirs(self.test_directory / "dir0/node_modules/sub")
+        with open(self.test_directory / "dir0/node_modules/sub/file", "w") as f:
+            f.write(self.test_data_1)
+        hardlink.main(
+            self.default_options
+            + ["-x", "/node_modules/", "-x", "^$", self.test_directory.as_posix()]
+        )
+        # The excluded directory is not even scanned.
+        self.assertEqual(6, hardlink.gStats.dircount)
+        self.assertEqual(10, hardlink.gStats.regularfiles)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_ignore_file(self) -> None:
+        with open(self.test_directory / ".hardlinkignore", "w") as f:
+            f.write("# Not these\n/dir1/\n*_DS1_*\n!dir4/*_T2.test\n")
+        with open(self.test_directory / "dir2/.hardlinkignore", "w") as f:
+            f.write("fileA*\n")
+        hardlink.main(
+            self.default_options
+            + [
+                "--ignore-file",
+                ".hardlinkignore",
+                "--scan-workers",
+                "2",
+                self.test_directory.as_posix(),
+            ]
+        )
+        self.assertEqual(5, hardlink.gStats.dircount)
+        # dir0/fileA, dir0/fileB, dir2/fileB, dir3/fileB, dir4/fileA, dir4/fileB
+        # and the two ignore files.
+        self.assertEqual(8, hardlink.gStats.regularfiles)
+        self.verify_file_data(link_counts=[3, 1, 1, 1, 1, 3, 1, 3, 1, 1])
+
+    def test_hardlink_scan_workers(self) -> None:
+        hardlink.main(
+            self.default_options
+            + ["--scan-workers", "4", self.test_directory.as_posix()]
+        )
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(6, hardlink.gStats.dircount)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_compare_workers(self) -> None:
+        hardlink.main(
+            self.default_options
+            + ["--compare-workers", "4", self.test_directory.as_posix()]
+        )
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(5, hardlink.gStats.comparisons)
+        # The sample and the full contents of the seven files of the same size.
+        self.assertEqual(
+            7 * (3 * hardlink.SAMPLE_SIZE + len(self.test_data_1)),
+            hardlink.gStats.bytes_read,
+        )
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_walk_directories_parallel_order(self) -> None:
+        for index in range(3):
+            os.makedirs(self.test_directory / f"dir{index}" / "sub" / f"sub{index}")
+            with open(self.test_directory / f"dir{index}" / "sub" / "file", "w") as f:
+                f.write("data")
+        args = hardlink.parse_args([self.test_directory.as_posix()])
+        serial_paths = [entry.path for entry in hardlink.walk_directories(args=args)]
+        args.scan_workers = 4
+        parallel_paths = [entry.path for entry in hardlink.walk_directories(args=args)]
+        self.assertEqual(serial_paths, parallel_paths)
+        self.assertEqual(13, len(parallel_paths))
+        # Without scanning ahead each directory is scanned when it is used.
+        with mock.patch.object(hardlink, "SCAN_LOOKAHEAD", 0):
+            parallel_paths = [
+                entry.path for entry in hardlink.walk_directories(args=args)
+            ]
+        self.assertEqual(serial_paths, parallel_paths)
+
+    def test_walk_directories_parallel_scans_ahead(self) -> None:
+        os.makedirs(self.test_directory / "zdeep" / "deeper" / "deepest")
+        args = hardlink.parse_args([self.test_directory.as_posix()])
+        args.scan_workers = 4
+        walk = cast(Generator[Any, None, None], hardlink.walk_directories(args=args))
+        scanned = threading.Event()
+        deepest = (self.test_directory / "zdeep" / "deeper" / "deepest").as_posix()
+        scan_directory = hardlink.scan_directory
+
+        def record_scan(*, directory: str, **kwargs: Any) -> Any:
+            if directory == deepest:
+                scanned.set()
+            return scan_directory(directory=directory, **kwargs)
+
+        with mock.patch.object(hardlink, "scan_directory", record_scan):
+            # Only the files of the top directory are used.
+            next(walk)
+            # The scans of the subdirectories go on without waiting for them
+            # to be used.
+            self.assertTrue(scanned.wait(timeout=10))
+            walk.close()
+
+    def test_hardlink_digest_cache(self) -> None:
+        cache_options = [
+            "--digest-cache",
+            (self.test_directory / "digests.sqlite").as_posix(),
+            self.test_directory.as_posix(),
+        ]
+        hardlink.main(self.default_options + ["--dry-run"] + cache_options)
+        self.verify_file_data(link_counts=[1, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+
+        # Nothing has changed, so no file has to be read again.
+        with mock.patch.object(hardlink, "open_for_reading") as mock_open:
+            hardlink.main(self.default_options + cache_options)
+        mock_open.assert_not_called()
+        self.assertEqual(5, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(14, hardlink.gStats.cached_digests)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+    def test_hardlink_digest_cache_after_linking(self) -> None:
+        cache_options = [
+            "--digest-cache",
+            (self.test_directory / "digests.sqlite").as_posix(),
+            self.test_directory.as_posix(),
+        ]
+        hardlink.main(self.default_options + cache_options)
+        self.verify_file_data(link_counts=[5, 2, 2, 5, 5, 5, 1, 5, 1, 1])
+
+        # Linking changed the ctime of the files which were kept, but not their
+        # contents, so the second run over the same tree reads no bytes.
+        with mock.patch.object(hardlink, "open_for_reading") as mock_open:
+            hardlink.main(self.default_options + cache_options)
+        mock_open.assert_not_called()
+        self.assertEqual(0, hardlink.gStats.bytes_read)
+        self.assertEqual(0, hardlink.gStats.hardlinked_thisrun)
+        self.assertEqual(2, hardlink.gStats.cached_digests)
+
     def test_hardlink_contentonly(self) -> None:
         hardlink.main(
             self.default_options + ["--content-only", self.test_directory.as_posix()]
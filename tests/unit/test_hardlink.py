@@ -1,36 +1,17 @@
+import argparse
+import errno
 import os
+import pathlib
+import tempfile
 import unittest.mock as mock
+from typing import Any, List
 
 import testtools
 
 import hardlinkpy.hardlink as hardlink
 
 
-class TestHash(testtools.TestCase):
-    def test_maxhashes_power_of_2(self) -> None:
-        # MAX_HASHES must be a power of 2, so that MAX_HASHES - 1 will be a
-        # value with all bits set to 1
-        self.assertEqual(0, (hardlink.MAX_HASHES & (hardlink.MAX_HASHES - 1)))
-        # Make sure not 0
-        self.assertNotEqual(0, hardlink.MAX_HASHES)
-
-    def test_hash_size(self) -> None:
-        self.assertEqual(12, hardlink.hash_size(12))
-        self.assertEqual(12, hardlink.hash_size(hardlink.MAX_HASHES + 12))
-        self.assertEqual(
-            hardlink.MAX_HASHES - 1, hardlink.hash_size(hardlink.MAX_HASHES - 1)
-        )
-
-    def test_hash_size_time(self) -> None:
-        self.assertEqual(12, hardlink.hash_size_time(size=12, time=0.0))
-        self.assertEqual(44, hardlink.hash_size_time(size=12, time=32.4))
-
-    def test_hash_value(self) -> None:
-        self.assertEqual(12, hardlink.hash_value(size=12, time=32.4, notimestamp=True))
-        self.assertEqual(44, hardlink.hash_value(size=12, time=32.4, notimestamp=False))
-
-
-class TestEligibleForHardlink(testtools.TestCase):
+class TestIndexKey(testtools.TestCase):
     def setUp(self) -> None:
         super().setUp()
         cmd_line = ["/tmp/hardlinkpy/directory"]
@@ -38,256 +19,803 @@ class TestEligibleForHardlink(testtools.TestCase):
         with mock.patch("os.path.isdir", lambda path: True):
             self.args = hardlink.parse_args(passed_args=cmd_line)
 
-    def test_eligibile_for_hardlink(self) -> None:
+    def index_key(self, filename: str, st_file: os.stat_result) -> hardlink.IndexKey:
+        return hardlink.index_key(
+            file_info=hardlink.FileInfo(filename, st_file), args=self.args
+        )
+
+    def test_index_key(self) -> None:
+        key = self.index_key("/dir1/file", make_st_result(st_ino=100))
+        # Eligible files have the same key
+        self.assertEqual(key, self.index_key("/dir2/file", make_st_result(st_ino=101)))
+        for st_file in (
+            make_st_result(st_size=1),
+            make_st_result(st_dev=1),
+            make_st_result(st_mode=0o100755),
+            make_st_result(st_uid=1),
+            make_st_result(st_gid=1),
+            make_st_result(st_mtime=1),
+        ):
+            self.assertNotEqual(key, self.index_key("/dir1/file", st_file))
+
+    def test_index_key_content_only(self) -> None:
+        self.args.content_only = True
+        key = self.index_key("/dir1/file", make_st_result())
+        for st_file in (
+            make_st_result(st_mode=0o100755),
+            make_st_result(st_uid=1),
+            make_st_result(st_gid=1),
+            make_st_result(st_mtime=1),
+        ):
+            self.assertEqual(key, self.index_key("/dir1/file", st_file))
+        self.assertNotEqual(
+            key, self.index_key("/dir1/file", make_st_result(st_size=1))
+        )
+        self.assertNotEqual(key, self.index_key("/dir1/file", make_st_result(st_dev=1)))
 
+    def test_index_key_notimestamp(self) -> None:
+        self.args.notimestamp = True
+        key = self.index_key("/dir1/file", make_st_result())
+        self.assertEqual(key, self.index_key("/dir1/file", make_st_result(st_mtime=1)))
+        self.assertNotEqual(key, self.index_key("/dir1/file", make_st_result(st_uid=1)))
+
+    def test_index_key_samename(self) -> None:
+        key = self.index_key("/dir1/file1", make_st_result())
+        self.assertEqual(key, self.index_key("/dir2/file2", make_st_result()))
+        self.args.samename = True
+        key = self.index_key("/dir1/file1", make_st_result())
+        self.assertNotEqual(key, self.index_key("/dir2/file2", make_st_result()))
+        self.assertEqual(key, self.index_key("/dir2/file1", make_st_result()))
+
+
+class TestAlreadyHardlinked(testtools.TestCase):
+    def test_already_hardlinked_same_device(self) -> None:
         # Different inodes but same device
         st_file_1 = make_st_result(st_ino=100)
         st_file_2 = make_st_result(st_ino=101)
 
         # Identical files except for inode
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
-        )
+        self.assertFalse(hardlink.is_already_hardlinked(st1=st_file_1, st2=st_file_2))
 
         # Files that are already hardlinked since same inode
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_1, args=self.args)
-        )
-
-    def test_eligibile_for_hardlink_different_sizes(self) -> None:
+        self.assertTrue(hardlink.is_already_hardlinked(st1=st_file_1, st2=st_file_1))
 
-        # Different inodes and different sizes
-        st_file_1 = make_st_result(st_ino=100, st_size=1024)
-        st_file_2 = make_st_result(st_ino=101, st_size=2048)
+    def test_already_hardlinked_different_device(self) -> None:
+        # Same inode but different device
+        st_file_1 = make_st_result(st_ino=100, st_dev=1)
+        st_file_2 = make_st_result(st_ino=100, st_dev=2)
 
-        # Different size files, should be False
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
-        )
+        # Identical files except for different device, not hardlinked
+        self.assertFalse(hardlink.is_already_hardlinked(st1=st_file_1, st2=st_file_2))
 
-    def test_eligibile_for_hardlink_different_dev(self) -> None:
 
-        # Different inodes and different devices
-        st_file_1 = make_st_result(st_ino=100, st_dev=100)
-        st_file_2 = make_st_result(st_ino=101, st_dev=200)
+class TestStatInfo(testtools.TestCase):
+    def test_stat_info(self) -> None:
+        st_file = make_st_result(st_ino=100, st_size=2048, st_mtime=1554498399)
+        stat_info = hardlink.StatInfo(st_file)
+        for field in hardlink.StatInfo.__slots__:
+            self.assertEqual(getattr(st_file, field), getattr(stat_info, field))
+        self.assertEqual(st_file.st_mtime, stat_info.st_mtime)
+        self.assertFalse(hasattr(stat_info, "__dict__"))
 
-        # Different size files, should be False
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
-        )
+    def test_index_key(self) -> None:
+        with mock.patch("os.path.isdir", lambda path: True):
+            args = hardlink.parse_args(passed_args=["/tmp/hardlinkpy/directory"])
+        keys = [
+            hardlink.index_key(
+                file_info=hardlink.FileInfo("/dir1/file", hardlink.StatInfo(st_file)),
+                args=args,
+            )
+            for st_file in (
+                make_st_result(st_ino=100),
+                make_st_result(st_ino=101),
+                make_st_result(st_ino=102, st_mtime=1),
+            )
+        ]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
 
-    def test_eligibile_for_hardlink_different_modes(self) -> None:
 
-        # Different inodes and different modes
-        st_file_1 = make_st_result(st_ino=100, st_mode=0o644)
-        st_file_2 = make_st_result(st_ino=101, st_mode=0o755)
+class FileTestCase(testtools.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        temp_dir_obj = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir_obj.cleanup)
+        self.test_directory = pathlib.Path(temp_dir_obj.name)
+        cmd_line = [self.test_directory.as_posix(), "--quiet"]
+        self.args = hardlink.parse_args(passed_args=cmd_line)
+
+    def make_file(self, name: str, data: bytes) -> str:
+        filename = (self.test_directory / name).as_posix()
+        with open(filename, "wb") as out_file:
+            out_file.write(data)
+        return filename
+
+
+class TestSampleDigest(FileTestCase):
+    def test_sample_digest_tail_differs(self) -> None:
+        data = b"x" * (hardlink.SAMPLE_SIZE * 10)
+        filename1 = self.make_file("file1", data)
+        filename2 = self.make_file("file2", data[:-1] + b"y")
+        self.assertNotEqual(
+            hardlink.sample_digest(filename=filename1, size=len(data)),
+            hardlink.sample_digest(filename=filename2, size=len(data)),
+        )
 
-        # Different file modes, should be False
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+    def test_sample_digest_unsampled_region_differs(self) -> None:
+        # A difference outside of the samples is only found by the full
+        # comparison.
+        data = b"x" * (hardlink.SAMPLE_SIZE * 10)
+        offset = hardlink.SAMPLE_SIZE * 2
+        filename1 = self.make_file("file1", data)
+        changed_data = data[:offset] + b"y" + data[offset + 1 :]  # noqa: E203
+        filename2 = self.make_file("file2", changed_data)
+        self.assertEqual(
+            hardlink.sample_digest(filename=filename1, size=len(data)),
+            hardlink.sample_digest(filename=filename2, size=len(data)),
         )
 
-        self.args.content_only = True
-        # Different file modes, content_only=True, should be True
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+    def test_sample_digest_small_file(self) -> None:
+        filename1 = self.make_file("file1", b"abc")
+        filename2 = self.make_file("file2", b"abd")
+        self.assertNotEqual(
+            hardlink.sample_digest(filename=filename1, size=3),
+            hardlink.sample_digest(filename=filename2, size=3),
         )
 
-    def test_eligibile_for_hardlink_different_uid(self) -> None:
 
-        # Different inodes and different UIDs
-        st_file_1 = make_st_result(st_ino=100, st_uid=1000)
-        st_file_2 = make_st_result(st_ino=101, st_uid=2000)
+class TestCompareContents(FileTestCase):
+    def assert_contents_equal(self, expected: bool, data1: bytes, data2: bytes) -> None:
+        filenames = [self.make_file("file1", data1), self.make_file("file2", data2)]
+        self.assertEqual(
+            [filenames] if expected else [[filenames[0]], [filenames[1]]],
+            hardlink.split_identical_files(filenames=filenames, args=self.args),
+        )
 
-        # Different UIDs should be False
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+    def test_small_files(self) -> None:
+        self.assert_contents_equal(True, b"abc", b"abc")
+        self.assert_contents_equal(False, b"abc", b"abd")
+
+    def test_large_files(self) -> None:
+        # Larger than the buffer, so the last chunk only partly fills it.
+        size = hardlink.BUFFER_SIZE * 2 + 10
+        data = b"a" * size
+        self.assert_contents_equal(True, data, data)
+        self.assert_contents_equal(False, data, data[:-1] + b"b")
+        self.assert_contents_equal(False, data, b"b" + data[1:])
+        self.assert_contents_equal(False, data, data + b"a")
+
+    def test_large_files_buffer_multiple(self) -> None:
+        data = b"a" * hardlink.BUFFER_SIZE
+        self.assert_contents_equal(True, data, data)
+        self.assert_contents_equal(False, data, data[:-1] + b"b")
+
+
+class TestCachePolicy(FileTestCase):
+    def set_cache_policy(self, cache_policy: str) -> None:
+        state = hardlink.current_state()
+        self.addCleanup(setattr, state, "cache_policy", state.cache_policy)
+        state.cache_policy = cache_policy
+
+    @testtools.skipUnless(hasattr(os, "posix_fadvise"), "needs posix_fadvise()")
+    def test_drop(self) -> None:
+        self.set_cache_policy("drop")
+        size = hardlink.BUFFER_SIZE + 10
+        filename1 = self.make_file("file1", b"a" * size)
+        filename2 = self.make_file("file2", b"a" * size)
+        with mock.patch.object(os, "posix_fadvise", wraps=os.posix_fadvise) as advise:
+            self.assertEqual(
+                [[filename1, filename2]],
+                hardlink.split_identical_files(
+                    filenames=[filename1, filename2], args=self.args
+                ),
+            )
+        # The hints given for the first file: each chunk is read ahead before
+        # and dropped after it is read, and the chunks grow.
+        fd = advise.call_args_list[0][0][0]
+        calls = [call[0][1:] for call in advise.call_args_list if call[0][0] == fd]
+        self.assertEqual((0, 0, os.POSIX_FADV_SEQUENTIAL), calls[0])
+        self.assertEqual((0, 0, os.POSIX_FADV_DONTNEED), calls[-1])
+        chunk = hardlink.FIRST_CHUNK_SIZE
+        self.assertEqual(
+            [
+                (chunk, chunk, os.POSIX_FADV_WILLNEED),
+                (0, chunk, os.POSIX_FADV_DONTNEED),
+                (chunk * 3, chunk * 2, os.POSIX_FADV_WILLNEED),
+                (chunk, chunk * 2, os.POSIX_FADV_DONTNEED),
+            ],
+            calls[1:5],
+        )
+        dropped = sum(call[1] for call in calls if call[2] == os.POSIX_FADV_DONTNEED)
+        self.assertEqual(size, dropped)
+
+    def test_direct(self) -> None:
+        self.set_cache_policy("direct")
+        size = hardlink.BUFFER_SIZE * 2 + 10
+        data = b"a" * size
+        filenames = [
+            self.make_file("file1", data),
+            self.make_file("file2", data[:-1] + b"b"),
+            self.make_file("file3", data),
+        ]
+        self.assertEqual(
+            [[filenames[0], filenames[2]], [filenames[1]]],
+            hardlink.split_identical_files(filenames=filenames, args=self.args),
+        )
+        self.assertEqual(
+            hardlink.file_digest(filename=filenames[0]),
+            hardlink.file_digest(filename=filenames[2]),
         )
 
-        self.args.content_only = True
-        # Different UIDs, content_only=True, should be True
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+
+class TestChunkSize(testtools.TestCase):
+    def test_next_chunk_size(self) -> None:
+        state = hardlink.current_state()
+        self.addCleanup(setattr, state, "max_chunk_size", state.max_chunk_size)
+        state.max_chunk_size = hardlink.FIRST_CHUNK_SIZE * 5
+        sizes = [hardlink.next_chunk_size()]
+        for _ in range(4):
+            sizes.append(hardlink.next_chunk_size(sizes[-1]))
+        self.assertEqual(
+            [1, 2, 4, 5, 5], [size // hardlink.FIRST_CHUNK_SIZE for size in sizes]
         )
 
-    def test_eligibile_for_hardlink_different_gid(self) -> None:
+        state.max_chunk_size = hardlink.FIRST_CHUNK_SIZE // 2
+        self.assertEqual(hardlink.FIRST_CHUNK_SIZE // 2, hardlink.next_chunk_size())
 
-        # Different inodes and different GIDs
-        st_file_1 = make_st_result(st_ino=100, st_gid=1000)
-        st_file_2 = make_st_result(st_ino=101, st_gid=2000)
 
-        # Different GIDs should be False
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+class TestShard(testtools.TestCase):
+    def test_parse_shard(self) -> None:
+        self.assertEqual(
+            hardlink.Shard(number=2, shards=3), hardlink.parse_shard("2/3")
         )
+        for value in ("0/3", "4/3", "2", "a/3"):
+            self.assertRaises(argparse.ArgumentTypeError, hardlink.parse_shard, value)
 
-        self.args.content_only = True
-        # Different GIDs, content_only=True, should be True
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+    def test_size_shard(self) -> None:
+        shards = [hardlink.size_shard(size=size, shards=4) for size in range(1000)]
+        self.assertEqual({1, 2, 3, 4}, set(shards))
+        # The same size is always in the same shard.
+        self.assertEqual(
+            shards, [hardlink.size_shard(size=size, shards=4) for size in range(1000)]
         )
 
-    def test_eligibile_for_hardlink_different_mtime(self) -> None:
-
-        # Different inodes and different GIDs
-        st_file_1 = make_st_result(st_ino=100, st_mtime=1000)
-        st_file_2 = make_st_result(st_ino=101, st_mtime=2000)
 
-        # Different mtimes should be False
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
-        )
+class TestAddFile(FileTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.state = hardlink.current_state()
+        self.state.inode_index.clear()
+        self.state.file_index.clear()
+        self.addCleanup(self.state.inode_index.clear)
+        self.addCleanup(self.state.file_index.clear)
 
-        self.args.content_only = True
-        self.args.notimestamp = False
-        # Different mtimes, content_only=True, should be True
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
-        )
+    def add_file(self, filename: str) -> None:
+        stat_info = hardlink.StatInfo(os.lstat(filename))
+        hardlink.add_file(filename=filename, stat_info=stat_info, args=self.args)
 
-        self.args.content_only = False
+    def test_add_file_known_inode(self) -> None:
         self.args.notimestamp = True
-        # Different mtimes, content_only=True, should be True
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+        filename1 = self.make_file("file1", b"abc")
+        filename2 = (self.test_directory / "file2").as_posix()
+        os.link(filename1, filename2)
+        filename3 = self.make_file("file3", b"abc")
+        for filename in (filename1, filename2, filename3):
+            self.add_file(filename)
+
+        self.assertEqual(2, len(self.state.inode_index))
+        (inode_groups,) = self.state.file_index.values()
+        self.assertEqual(
+            [[filename1, filename2], [filename3]],
+            [inode_group.filenames for inode_group in inode_groups],
         )
 
-    def test_eligibile_for_hardlink_min_size(self) -> None:
-
-        # File must be at least 1024 bytes in size
-        self.args.min_size = 1024
+    def test_add_file_known_inode_samename(self) -> None:
+        self.args.samename = True
+        filename1 = self.make_file("file1", b"abc")
+        os.mkdir(self.test_directory / "dir")
+        filename2 = (self.test_directory / "dir" / "file1").as_posix()
+        filename3 = (self.test_directory / "dir" / "file2").as_posix()
+        os.link(filename1, filename2)
+        os.link(filename1, filename3)
+        for filename in (filename1, filename2, filename3):
+            self.add_file(filename)
+
+        # A path with a different name is kept apart from the others.
+        self.assertEqual(2, len(self.state.inode_index))
+        self.assertEqual(2, len(self.state.file_index))
+
+
+class TestSplitInodeGroups(FileTestCase):
+    def make_inode_group(self, name: str, data: bytes) -> hardlink.InodeGroup:
+        filename = self.make_file(name, data)
+        return hardlink.InodeGroup(filename=filename, stat_info=os.lstat(filename))
+
+    def split_inode_groups(
+        self, inode_groups: List[hardlink.InodeGroup]
+    ) -> List[List[hardlink.InodeGroup]]:
+        return hardlink.split_inode_groups(inode_groups=inode_groups, args=self.args)
+
+    def test_split_inode_groups(self) -> None:
+        inode_groups = [
+            self.make_inode_group("file1", b"abc"),
+            self.make_inode_group("file2", b"abc"),
+            self.make_inode_group("file3", b"abc"),
+        ]
+        self.assertEqual([inode_groups], self.split_inode_groups(inode_groups))
+
+    def test_split_inode_groups_sample_differs(self) -> None:
+        data = b"x" * (hardlink.SAMPLE_SIZE * 10)
+        inode_groups = [
+            self.make_inode_group("file1", data),
+            self.make_inode_group("file2", data[:-1] + b"y"),
+        ]
+        stats = hardlink.current_state().stats
+        sample_rejections = stats.sample_rejections
+        with mock.patch.object(
+            hardlink, "split_identical_files", autospec=True
+        ) as split_identical_files:
+            self.assertEqual([], self.split_inode_groups(inode_groups))
+        # The files are not compared once their samples differ.
+        split_identical_files.assert_not_called()
+        self.assertEqual(2, stats.sample_rejections - sample_rejections)
+
+    def test_split_inode_groups_content_differs(self) -> None:
+        # A difference outside of the samples is only found by the full
+        # comparison.
+        data = b"x" * (hardlink.SAMPLE_SIZE * 10)
+        offset = hardlink.SAMPLE_SIZE * 2
+        changed_data = data[:offset] + b"y" + data[offset + 1 :]  # noqa: E203
+        inode_groups = [
+            self.make_inode_group("file1", data),
+            self.make_inode_group("file2", changed_data),
+            self.make_inode_group("file3", data),
+        ]
+        stats = hardlink.current_state().stats
+        content_rejections = stats.content_rejections
+        self.assertEqual(
+            [[inode_groups[0], inode_groups[2]]], self.split_inode_groups(inode_groups)
+        )
+        self.assertEqual(1, stats.content_rejections - content_rejections)
 
-        # Different inodes but size is too small
-        st_small_1 = make_st_result(st_ino=100, st_size=1023)
-        st_small_2 = make_st_result(st_ino=101, st_size=1023)
 
-        self.assertFalse(
-            hardlink.eligible_for_hardlink(
-                st1=st_small_1, st2=st_small_2, args=self.args
+class TestReadOrder(FileTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        state = hardlink.current_state()
+        self.addCleanup(setattr, state, "read_order", state.read_order)
+        self.addCleanup(state.physical_offsets.clear)
+        state.read_order = "disk"
+
+    def make_inode_group(self, name: str, data: bytes) -> hardlink.InodeGroup:
+        filename = self.make_file(name, data)
+        return hardlink.InodeGroup(filename=filename, stat_info=os.lstat(filename))
+
+    def test_physical_offset_fallback(self) -> None:
+        inode_group = self.make_inode_group("file1", b"abc")
+        with mock.patch.object(
+            hardlink, "first_extent_offset", return_value=None
+        ) as first_extent_offset:
+            self.assertEqual(
+                inode_group.stat_info.st_ino, hardlink.physical_offset(inode_group)
+            )
+            # The offset is only looked up once.
+            hardlink.physical_offset(inode_group)
+        first_extent_offset.assert_called_once_with(inode_group.filenames[0])
+
+    def test_split_inode_groups_in_disk_order(self) -> None:
+        inode_groups = [
+            self.make_inode_group(f"file{index}", b"abc" if index % 2 else b"abd")
+            for index in range(4)
+        ]
+        offsets = {
+            group.filenames[0]: 100 - index for index, group in enumerate(inode_groups)
+        }
+        read_files = []
+        sample_digest = hardlink.sample_digest
+
+        def recording_sample_digest(*, filename: str, size: int) -> bytes:
+            read_files.append(filename)
+            return sample_digest(filename=filename, size=size)
+
+        with mock.patch.object(
+            hardlink, "first_extent_offset", side_effect=offsets.__getitem__
+        ), mock.patch.object(
+            hardlink, "sample_digest", side_effect=recording_sample_digest
+        ):
+            identical_groups = hardlink.split_inode_groups(
+                inode_groups=inode_groups, args=self.args
             )
+        # The files are read from the last one, which is first on the disk, but
+        # the identical inodes keep the order they were found in.
+        self.assertEqual(
+            [group.filenames[0] for group in reversed(inode_groups)], read_files
         )
-
-        # Files are large enough
-        st_file_1 = make_st_result(st_ino=101, st_size=1024)
-        st_file_2 = make_st_result(st_ino=102, st_size=1024)
-
-        self.assertTrue(
-            hardlink.eligible_for_hardlink(st1=st_file_1, st2=st_file_2, args=self.args)
+        self.assertEqual(
+            [[inode_groups[1], inode_groups[3]], [inode_groups[0], inode_groups[2]]],
+            identical_groups,
         )
 
 
-class TestAlreadyHardlinked(testtools.TestCase):
-    def test_already_hardlinked_same_device(self) -> None:
-        # Different inodes but same device
-        st_file_1 = make_st_result(st_ino=100)
-        st_file_2 = make_st_result(st_ino=101)
-
-        # Identical files except for inode
-        self.assertFalse(hardlink.is_already_hardlinked(st1=st_file_1, st2=st_file_2))
-
-        # Files that are already hardlinked since same inode
-        self.assertTrue(hardlink.is_already_hardlinked(st1=st_file_1, st2=st_file_1))
+class TestSplitIdenticalFiles(FileTestCase):
+    def test_split_identical_files(self) -> None:
+        size = hardlink.BUFFER_SIZE + 10
+        data_1 = b"a" * size
+        data_2 = b"a" * (size - 1) + b"b"
+        data_3 = b"c" * size
+        filenames = [
+            self.make_file("file1", data_1),
+            self.make_file("file2", data_2),
+            self.make_file("file3", data_1),
+            self.make_file("file4", data_3),
+            self.make_file("file5", data_2),
+        ]
+        self.assertEqual(
+            [
+                [filenames[0], filenames[2]],
+                [filenames[1], filenames[4]],
+                [filenames[3]],
+            ],
+            hardlink.split_identical_files(filenames=filenames, args=self.args),
+        )
 
-    def test_already_hardlinked_different_device(self) -> None:
-        # Same inode but different device
-        st_file_1 = make_st_result(st_ino=100, st_dev=1)
-        st_file_2 = make_st_result(st_ino=100, st_dev=2)
+    def test_split_identical_files_missing_file(self) -> None:
+        filenames = [
+            self.make_file("file1", b"abc"),
+            (self.test_directory / "missing").as_posix(),
+            self.make_file("file2", b"abc"),
+        ]
+        self.assertEqual(
+            [[filenames[0], filenames[2]]],
+            hardlink.split_identical_files(filenames=filenames, args=self.args),
+        )
 
-        # Identical files except for different device, not hardlinked
-        self.assertFalse(hardlink.is_already_hardlinked(st1=st_file_1, st2=st_file_2))
+    def set_max_open_files(self, max_open_files: int) -> None:
+        state = hardlink.current_state()
+        self.addCleanup(setattr, state, "max_open_files", state.max_open_files)
+        state.max_open_files = max_open_files
+
+    def test_split_many_identical_files(self) -> None:
+        self.set_max_open_files(3)
+        filenames = [
+            self.make_file(f"file{index}", b"abc" if index % 2 else b"abd")
+            for index in range(7)
+        ]
+        self.assertEqual(
+            [filenames[0::2], filenames[1::2]],
+            hardlink.split_identical_files(filenames=filenames, args=self.args),
+        )
 
+    def test_split_many_identical_files_read_once(self) -> None:
+        count = hardlink.current_state().max_open_files + 44
+        size = hardlink.FIRST_CHUNK_SIZE + 10
+        filenames = [
+            self.make_file(f"file{index}", bytes([index % 3]) * size)
+            for index in range(count)
+        ]
+        stats = hardlink.current_state().stats
+        bytes_read = stats.bytes_read
+        files_opened = stats.files_opened
+        identical_files = hardlink.split_identical_files(
+            filenames=filenames, args=self.args
+        )
+        self.assertEqual(
+            [filenames[0::3], filenames[1::3], filenames[2::3]], identical_files
+        )
+        self.assertEqual(count * size, stats.bytes_read - bytes_read)
+        self.assertEqual(count, stats.files_opened - files_opened)
+
+    def test_split_identical_files_out_of_file_descriptors(self) -> None:
+        filenames = [
+            self.make_file(f"file{index}", b"abc" if index % 2 else b"abd")
+            for index in range(4)
+        ]
+        open_for_reading = hardlink.open_for_reading
+        opened = []
+
+        def failing_open_for_reading(*, filename: str, direct: bool) -> Any:
+            opened.append(filename)
+            if len(opened) == 3:
+                raise OSError(errno.EMFILE, "Too many open files")
+            return open_for_reading(filename=filename, direct=direct)
+
+        with mock.patch.object(
+            hardlink, "open_for_reading", side_effect=failing_open_for_reading
+        ):
+            identical_files = hardlink.split_identical_files(
+                filenames=filenames, args=self.args
+            )
+        # The files are compared one at a time instead of being left out.
+        self.assertEqual([filenames[0::2], filenames[1::2]], identical_files)
+        self.assertEqual(filenames[:3] + filenames, opened)
 
-class TestAreFilesHardlinkable(testtools.TestCase):
+    @mock.patch("time.sleep", autospec=True)
+    def test_split_many_identical_files_retries(
+        self, mock_sleep: mock.MagicMock
+    ) -> None:
+        self.set_max_open_files(1)
+        filenames = [self.make_file("file1", b"abc"), self.make_file("file2", b"abc")]
+        file_digest = hardlink.file_digest
+        with mock.patch.object(
+            hardlink,
+            "file_digest",
+            side_effect=[OSError(errno.EMFILE, "Too many open files")]
+            + [file_digest(filename=filename) for filename in filenames],
+        ):
+            self.assertEqual(
+                [filenames],
+                hardlink.split_identical_files(filenames=filenames, args=self.args),
+            )
+        mock_sleep.assert_called_once_with(hardlink.OPEN_FILE_RETRY_DELAY)
+
+
+class TestMaxOpenFiles(testtools.TestCase):
+    @testtools.skipIf(hardlink.resource is None, "needs the resource module")
+    def test_max_open_files(self) -> None:
+        for soft_limit, workers, expected in [
+            (1024, 1, hardlink.MAX_OPEN_FILES),
+            (1024, 8, (1024 - hardlink.OPEN_FILES_HEADROOM) // 8),
+            (100, 1, 2),
+            (hardlink.resource.RLIM_INFINITY, 8, hardlink.MAX_OPEN_FILES),
+        ]:
+            with mock.patch.object(
+                hardlink.resource,
+                "getrlimit",
+                return_value=(soft_limit, hardlink.resource.RLIM_INFINITY),
+            ):
+                self.assertEqual(expected, hardlink.max_open_files(workers=workers))
+
+    def test_hardlinker_max_open_files(self) -> None:
+        with mock.patch.object(hardlink, "max_open_files", return_value=10) as limit:
+            with hardlink.Hardlinker(
+                args=hardlink.make_args(directories=["/"], compare_workers=4)
+            ) as hardlinker:
+                self.assertEqual(10, hardlinker.state.max_open_files)
+        limit.assert_called_once_with(workers=4)
+
+
+class TestDigestCache(FileTestCase):
     def setUp(self) -> None:
         super().setUp()
-        cmd_line = ["/tmp/hardlinkpy/directory"]
-        # Make it so it doesn't care if directory doesn't exist
-        with mock.patch("os.path.isdir", lambda path: True):
-            self.args = hardlink.parse_args(passed_args=cmd_line)
-
-    @mock.patch("hardlinkpy.hardlink.are_file_contents_equal", autospec=True)
-    def test_are_files_hardlinkable(self, mock_are_equal: mock.MagicMock) -> None:
-        filename1 = "/tmp/hardlinkpy/directory/file1"
-        filename2 = "/tmp/hardlinkpy/directory/file2"
+        self.cache = hardlink.DigestCache((self.test_directory / "cache").as_posix())
+        self.addCleanup(self.cache.connection.close)
 
+    def test_lookup(self) -> None:
         st_file_1 = make_st_result(st_ino=100)
         st_file_2 = make_st_result(st_ino=101)
+        self.assertIsNone(self.cache.lookup(st_file_1))
+        self.cache.store(st_file_1, sample_digest=b"sample", full_digest=b"full")
+        self.assertEqual(
+            hardlink.CachedDigests(sample_digest=b"sample", full_digest=b"full"),
+            self.cache.lookup(st_file_1),
+        )
+        self.assertIsNone(self.cache.lookup(st_file_2))
 
-        mock_are_equal.return_value = True
-        self.assertTrue(
-            hardlink.are_files_hardlinkable(
-                file_info_1=hardlink.FileInfo(filename1, st_file_1),
-                file_info_2=hardlink.FileInfo(filename2, st_file_2),
-                args=self.args,
-            )
+    def test_lookup_changed_file(self) -> None:
+        self.cache.store(make_st_result(st_ino=100), sample_digest=b"sample")
+        self.assertIsNone(self.cache.lookup(make_st_result(st_ino=100, st_size=1)))
+        self.assertIsNone(
+            self.cache.lookup(make_st_result(st_ino=100, st_mtime=1554498399))
+        )
+        # Hardlinking a file changes its change time, but not its contents.
+        self.assertIsNotNone(
+            self.cache.lookup(make_st_result(st_ino=100, st_ctime=1554498399))
         )
 
-    @mock.patch("hardlinkpy.hardlink.are_file_contents_equal", autospec=True)
-    def test_are_files_hardlinkable_not_eligible(
-        self, mock_are_equal: mock.MagicMock
-    ) -> None:
-        filename1 = "/tmp/hardlinkpy/directory/file1"
-        filename2 = "/tmp/hardlinkpy/directory/file2"
+    def test_prune_max_entries(self) -> None:
+        for st_ino in range(10):
+            self.cache.start_time = st_ino
+            self.cache.store(make_st_result(st_ino=st_ino), sample_digest=b"sample")
+        self.assertEqual(7, self.cache.prune(max_entries=3))
+        self.assertIsNone(self.cache.lookup(make_st_result(st_ino=6)))
+        self.assertIsNotNone(self.cache.lookup(make_st_result(st_ino=7)))
+
+    def test_prune_max_age(self) -> None:
+        self.cache.start_time = 1000
+        self.cache.store(make_st_result(st_ino=1), sample_digest=b"sample")
+        self.cache.start_time = 2000
+        self.cache.store(make_st_result(st_ino=2), sample_digest=b"sample")
+        self.assertEqual(1, self.cache.prune(max_age=500))
+        self.assertIsNone(self.cache.lookup(make_st_result(st_ino=1)))
+        self.assertIsNotNone(self.cache.lookup(make_st_result(st_ino=2)))
+
+
+class TestLinkAndRename(FileTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.addCleanup(hardlink.current_state().directory_fds.close)
+        self.source = self.make_file("source", b"abc")
+        os.mkdir(self.test_directory / "dir")
+        self.dest = self.make_file("dir/dest", b"abc")
 
-        # File sizes differ, so not eligible for hardlinking
-        st_file_1 = make_st_result(st_ino=100, st_size=2500)
-        st_file_2 = make_st_result(st_ino=101, st_size=1500)
+    def test_link_and_rename(self) -> None:
+        self.assertTrue(
+            hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
+        )
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual(["dest"], os.listdir(self.test_directory / "dir"))
+
+    def test_link_and_rename_without_dir_fd(self) -> None:
+        directory_fds = hardlink.current_state().directory_fds
+        with mock.patch.object(directory_fds, "supported", False):
+            self.assertTrue(
+                hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
+            )
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual(["dest"], os.listdir(self.test_directory / "dir"))
 
-        mock_are_equal.return_value = True
+    def test_link_and_rename_missing_source(self) -> None:
+        os.unlink(self.source)
         self.assertFalse(
-            hardlink.are_files_hardlinkable(
-                file_info_1=hardlink.FileInfo(filename1, st_file_1),
-                file_info_2=hardlink.FileInfo(filename2, st_file_2),
-                args=self.args,
-            )
+            hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
         )
+        self.assertEqual(["dest"], os.listdir(self.test_directory / "dir"))
 
-    @mock.patch("hardlinkpy.hardlink.are_file_contents_equal", autospec=True)
-    def test_are_files_hardlinkable_samename(
-        self, mock_are_equal: mock.MagicMock
-    ) -> None:
-        filename1 = "/tmp/hardlinkpy/directory/dir1/file1"
-        filename2 = "/tmp/hardlinkpy/directory/dir2/file1"
-
-        st_file_1 = make_st_result(st_ino=100)
-        st_file_2 = make_st_result(st_ino=101)
-
-        self.args.samename = True
-        mock_are_equal.return_value = True
+    def test_link_and_rename_stale_temporary_file(self) -> None:
+        # Left behind by an interrupted run of an older version.
+        stale = self.make_file("dir/dest.$$$___cleanit___$$$", b"old")
         self.assertTrue(
-            hardlink.are_files_hardlinkable(
-                file_info_1=hardlink.FileInfo(filename1, st_file_1),
-                file_info_2=hardlink.FileInfo(filename2, st_file_2),
-                args=self.args,
+            hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
+        )
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertFalse(os.path.samefile(self.source, stale))
+
+    def test_link_and_rename_temporary_name_exists(self) -> None:
+        stale = self.make_file("dir/dest.stale", b"old")
+        fresh = (self.test_directory / "dir/dest.fresh").as_posix()
+        with mock.patch.object(
+            hardlink, "temporary_name", side_effect=[stale, fresh]
+        ), mock.patch.object(
+            hardlink.current_state().directory_fds, "supported", False
+        ):
+            self.assertTrue(
+                hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
             )
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual(
+            ["dest", "dest.stale"], sorted(os.listdir(self.test_directory / "dir"))
         )
 
-    @mock.patch("hardlinkpy.hardlink.are_file_contents_equal", autospec=True)
-    def test_are_files_hardlinkable_not_samename(
-        self, mock_are_equal: mock.MagicMock
-    ) -> None:
-        filename1 = "/tmp/hardlinkpy/directory/file1"
-        filename2 = "/tmp/hardlinkpy/directory/file2"
+    def test_link_and_rename_no_temporary_name(self) -> None:
+        stale = self.make_file("dir/dest.stale", b"old")
+        with mock.patch.object(
+            hardlink, "temporary_name", return_value=stale
+        ), mock.patch.object(
+            hardlink.current_state().directory_fds, "supported", False
+        ):
+            self.assertFalse(
+                hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
+            )
+        self.assertFalse(os.path.samefile(self.source, self.dest))
 
-        st_file_1 = make_st_result(st_ino=100)
-        st_file_2 = make_st_result(st_ino=101)
+    def test_link_and_rename_same_inode(self) -> None:
+        os.unlink(self.dest)
+        os.link(self.source, self.dest)
+        self.assertFalse(
+            hardlink.link_and_rename(sourcefile=self.source, destfile=self.dest)
+        )
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual(["dest"], os.listdir(self.test_directory / "dir"))
 
-        mock_are_equal.return_value = True
+    def test_rename_and_link(self) -> None:
         self.assertTrue(
-            hardlink.are_files_hardlinkable(
-                file_info_1=hardlink.FileInfo(filename1, st_file_1),
-                file_info_2=hardlink.FileInfo(filename2, st_file_2),
-                args=self.args,
-            )
+            hardlink.rename_and_link(sourcefile=self.source, destfile=self.dest)
+        )
+        self.assertTrue(os.path.samefile(self.source, self.dest))
+        self.assertEqual(["dest"], os.listdir(self.test_directory / "dir"))
+
+
+class TestDirectoryFds(FileTestCase):
+    def test_directory_fds_max_open(self) -> None:
+        directory_fds = hardlink.DirectoryFds(max_open=2)
+        self.addCleanup(directory_fds.close)
+        if not directory_fds.supported:
+            self.skipTest("dir_fd is not supported")
+        for name in ("dir1", "dir2", "dir3"):
+            os.mkdir(self.test_directory / name)
+        dir1 = (self.test_directory / "dir1").as_posix()
+        dir2 = (self.test_directory / "dir2").as_posix()
+        dir3 = (self.test_directory / "dir3").as_posix()
+        fd1 = directory_fds.get(dir1)
+        directory_fds.get(dir2)
+        self.assertEqual(fd1, directory_fds.get(dir1))
+        directory_fds.get(dir3)
+        # dir2 was used least recently.
+        self.assertEqual([dir1, dir3], list(directory_fds.fds))
+
+
+class TestIgnoreRules(FileTestCase):
+    def is_ignored(self, path: str, is_dir: bool = False) -> bool:
+        return hardlink.is_ignored(
+            path="/top/" + path, is_dir=is_dir, ignore_rules=self.ignore_rules
         )
 
-        self.args.samename = True
-        self.assertFalse(
-            hardlink.are_files_hardlinkable(
-                file_info_1=hardlink.FileInfo(filename1, st_file_1),
-                file_info_2=hardlink.FileInfo(filename2, st_file_2),
-                args=self.args,
-            )
+    def test_ignore_rules(self) -> None:
+        filename = self.make_file(
+            ".hardlinkignore",
+            b"# comment\n\n*.log\n!keep.log\n/build\ncache/\ndocs/**/*.tmp\n",
+        )
+        self.ignore_rules = tuple(
+            hardlink.read_ignore_file(filename=filename, base="/top/")
+        )
+        self.assertTrue(self.is_ignored("a.log"))
+        self.assertTrue(self.is_ignored("sub/dir/a.log"))
+        self.assertFalse(self.is_ignored("sub/keep.log"))
+        self.assertTrue(self.is_ignored("build", is_dir=True))
+        self.assertFalse(self.is_ignored("sub/build", is_dir=True))
+        self.assertTrue(self.is_ignored("sub/cache", is_dir=True))
+        self.assertFalse(self.is_ignored("sub/cache"))
+        self.assertTrue(self.is_ignored("docs/a.tmp"))
+        self.assertTrue(self.is_ignored("docs/a/b/c.tmp"))
+        self.assertFalse(self.is_ignored("other/docs/a.tmp"))
+        self.assertFalse(self.is_ignored("a.logs"))
+
+
+class TestCompileExcludes(testtools.TestCase):
+    def is_excluded(self, excludes: List[str], path: str) -> bool:
+        patterns = hardlink.compile_excludes(excludes)
+        return any(pattern.search(path) for pattern in patterns)
+
+    def test_compile_excludes(self) -> None:
+        patterns = hardlink.compile_excludes([r"\.cache/", r"\.tmp$"])
+        # Joined into one expression.
+        self.assertEqual(1, len(patterns))
+        self.assertTrue(patterns[0].search("/a/.cache/"))
+        self.assertTrue(patterns[0].search("/a/b.tmp"))
+        self.assertFalse(patterns[0].search("/a/b.tmp2"))
+
+    def test_compile_excludes_none(self) -> None:
+        self.assertEqual([], hardlink.compile_excludes([]))
+
+    def test_compile_excludes_inline_flags(self) -> None:
+        excludes = [r"(?i)\.tmp$", r"\.cache/"]
+        self.assertTrue(self.is_excluded(excludes, "/a/B.TMP"))
+        self.assertTrue(self.is_excluded(excludes, "/a/.cache/"))
+        # The flag applies only to its own expression.
+        self.assertFalse(self.is_excluded(excludes, "/a/.CACHE/"))
+
+    def test_compile_excludes_backreferences(self) -> None:
+        excludes = [r"/(a+)\1/", r"/(b+)\1/"]
+        self.assertTrue(self.is_excluded(excludes, "/aa/"))
+        self.assertTrue(self.is_excluded(excludes, "/bbbb/"))
+        self.assertFalse(self.is_excluded(excludes, "/bbb/"))
+
+    def test_compile_excludes_named_groups(self) -> None:
+        excludes = [r"/(?P<name>x)(?P=name)/", r"/(?P<name>y)(?P=name)/"]
+        self.assertTrue(self.is_excluded(excludes, "/xx/"))
+        self.assertTrue(self.is_excluded(excludes, "/yy/"))
+        self.assertFalse(self.is_excluded(excludes, "/xy/"))
+
+
+class TestStatistics(testtools.TestCase):
+    def test_fit_times(self) -> None:
+        stats = hardlink.cStatistics()
+        stats.scan_time, stats.stat_time = 6.0, 3.0
+        stats.link_time, stats.hardlink_time = 2.0, 1.0
+        stats.fit_times(4.0)
+        self.assertEqual(
+            [3.0, 1.5, 1.0, 0.5],
+            [stats.scan_time, stats.stat_time, stats.link_time, stats.hardlink_time],
+        )
+        # Times which fit are left alone.
+        stats.fit_times(10.0)
+        self.assertEqual(3.0, stats.scan_time)
+
+
+class TestDropNestedDirectories(FileTestCase):
+    def test_drop_nested_directories(self) -> None:
+        top = self.test_directory.as_posix()
+        os.makedirs(self.test_directory / "a" / "b")
+        os.mkdir(self.test_directory / "ab")
+        os.symlink(top + "/a", top + "/link")
+        self.assertEqual(
+            [top + "/a", top + "/ab"],
+            hardlink.drop_nested_directories(
+                [top + "/a", top + "/a/b", top + "/ab", top + "/a", top + "/link"]
+            ),
+        )
+        self.assertEqual(
+            [top], hardlink.drop_nested_directories([top + "/a/b", top, top + "/ab"])
         )
 
 
@@ -333,5 +861,10 @@ def make_st_result(
             st_atime,
             st_mtime,
             st_ctime,
-        )
+        ),
+        {
+            "st_atime_ns": st_atime * 1_000_000_000,
+            "st_mtime_ns": st_mtime * 1_000_000_000,
+            "st_ctime_ns": st_ctime * 1_000_000_000,
+        },
     )